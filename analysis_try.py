@@ -1,38 +1,19 @@
-from simple_climate_package.mean import CalcMean           # absolute import - run pytest from repo root
-from simple_climate_package.extremes import CalcExtremes
-from simple_climate_package.linear_regression import LinReg
-import xarray as xr
-import matplotlib.pyplot as plt
+# Runs every analysis on the example data without prompting, so it also works in batch jobs.
+# The products are listed in example_job.toml; the same run from the shell is
+#     simple-climate-pipeline example_job.toml
+# Pass another data file as the first argument to analyse it instead, e.g.
+#     python analysis_try.py /path/to/e-obs_file.nc
 import os
-import pandas as pd
+import sys
 
+from simple_climate_package.pipeline import Pipeline, load_spec
 
-print('Example data for the UK can be found here on the github repository: /root/climate_eof_group_project/Data/Example_Data/e-obs_UK_ground_temp.nc' )
-data_path = input('Input the path to the data you want to analyse: ')
+here = os.path.dirname(os.path.abspath(__file__))
+spec = load_spec(os.path.join(here, 'example_job.toml'))
+if len(sys.argv) > 1:
+    spec['data']['path'] = os.path.abspath(sys.argv[1])
 
-tm = CalcMean(data_path)
-'''print(tm.mean_between('1950-01-01', '1955-01-01'))'''
-tm.plot_mean_tot_time()
-tm.plot_monthly_climatology()
-tm.plot_mean_between('1950-01-01', '1955-01-01')
-tm.plot_yearly_mean()
-month_clim = tm.monthly_clim()
-print(month_clim.shape)
-clim_amon = tm.monthly_clim_Anom()
-print(clim_amon.shape)
-day_clim = tm.daily_clim()
-print(day_clim.shape)
-daily_amon = tm.daily_clim_Anom()
-print(daily_amon.shape)
-
-
-tx = CalcExtremes(data_path)
-tx.plot_max_between('1950-01-01', '1955-01-01')
-tx.plot_max_tot()
-tx.plot_min_between('1950-01-01', '1955-01-01')
-tx.plot_min_tot()
-tx.plot_yearly_max()
-tx.plot_yearly_min()
-
-tl = LinReg(data_path)
-tl.quick_plot_signif_stippling()
+outputs = Pipeline(spec, base_dir=here).run()
+for (step, params), result in outputs.items():
+    if isinstance(result, str):
+        print(f'{step}: {result}')
@@ -122,8 +122,16 @@ setup(
         "urllib3>=2.5.0",
         "xarray>=2025.10.1",
     ],
+    # Command line entry points
+    entry_points={
+        'console_scripts': [
+            'simple-climate-pipeline = simple_climate_package.pipeline:main',
+        ],
+    },
     # List of dependencies
     extras_require={
+        # YAML job files for the pipeline (TOML needs nothing extra)
+        'yaml': ['PyYAML'],
         'docs': [
             # Sphinx for doc generation. Version 1.7.3 has a bug:
             'sphinx>=1.5, !=1.7.3',
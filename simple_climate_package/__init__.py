@@ -12,5 +12,8 @@ from .mean import CalcMean
 from .extremes import CalcExtremes
 from .loader import DataReader
 from .linear_regression import LinReg
-__all__ = ["CalcMean", "CalcExtremes",'DataReader','LinReg']
+from .trend import CalcTrend
+from .eof import CalcEOF, EOFBasis
+from .pipeline import Pipeline
+__all__ = ["CalcMean", "CalcExtremes",'DataReader','LinReg','CalcTrend','CalcEOF','EOFBasis','Pipeline']
 __version__ = "1.0.0"   # or import from _version.py
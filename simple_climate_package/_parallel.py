@@ -0,0 +1,78 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+import numpy as np
+
+###Process pool over column tiles of an array held in shared memory###
+
+# the shared input as seen from inside a worker process
+_SHARED = {}
+
+
+def pool_context():
+    """
+    Start method for worker pools: the platform default, except that a
+    process already running other threads (e.g. pipeline steps) starts its
+    workers from a fork server, since forking it can deadlock on locks held
+    by those threads.
+    """
+    if threading.active_count() > 1 and "forkserver" in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context("forkserver")
+        # imported once by the server rather than by every worker it starts
+        ctx.set_forkserver_preload(["simple_climate_package"])
+        return ctx
+    return multiprocessing.get_context()
+
+
+def _attach(name, shape, dtype, start_method):
+    shm = shared_memory.SharedMemory(name=name)
+    # the parent owns the block and unlinks it; a spawned worker has a tracker of
+    # its own that would unlink it again on exit (forked workers share the parent's)
+    if start_method != "fork":
+        resource_tracker.unregister(shm._name, "shared_memory")
+    _SHARED["shm"] = shm
+    _SHARED["array"] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _run_tile(func, c0, c1, kwargs):
+    return c0, c1, func(_SHARED["array"][:, c0:c1], **kwargs)
+
+
+def map_columns(func, Y, tile_size, n_workers=None, **kwargs):
+    """
+    Apply ``func(Y[:, c0:c1], **kwargs)`` to every tile of ``tile_size``
+    columns of the 2D array ``Y``.
+
+    With more than one worker, ``Y`` is copied once into a shared memory
+    block that every worker process maps, so tiles are never pickled.
+    ``func`` must be a module-level function.
+
+    Returns
+    -------
+    list of (c0, c1, result)
+        One entry per tile, in column order.
+    """
+    N = Y.shape[1]
+    tiles = [(c0, min(c0 + tile_size, N)) for c0 in range(0, N, max(int(tile_size), 1))]
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    n_workers = min(n_workers, len(tiles))
+    if n_workers <= 1:
+        return [(c0, c1, func(Y[:, c0:c1], **kwargs)) for c0, c1 in tiles]
+
+    shm = shared_memory.SharedMemory(create=True, size=max(Y.nbytes, 1))
+    try:
+        shared = np.ndarray(Y.shape, dtype=Y.dtype, buffer=shm.buf)
+        shared[...] = Y
+        ctx = pool_context()
+        with ProcessPoolExecutor(n_workers, mp_context=ctx, initializer=_attach,
+                                 initargs=(shm.name, Y.shape, Y.dtype.str, ctx.get_start_method())) as pool:
+            futures = [pool.submit(_run_tile, func, c0, c1, kwargs) for c0, c1 in tiles]
+            results = [f.result() for f in futures]
+        del shared
+    finally:
+        shm.close()
+        shm.unlink()
+    return results
@@ -0,0 +1,157 @@
+import numpy as np
+import xarray as xr
+from simple_climate_package.stats import time_block_size
+
+###Monthly and yearly aggregation with reduceat over precomputed bins###
+
+_UNITS = {"month": "datetime64[M]", "year": "datetime64[Y]", "season": "datetime64[M]"}
+# months per period
+_STEPS = {"month": 1, "year": 1, "season": 3}
+HOW = ("mean", "sum", "count", "min", "max")
+
+
+def runs(keys):
+    """Start index of every run of equal consecutive keys."""
+    keys = np.asarray(keys)
+    if keys.size == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+
+
+def time_bins(times, freq="month"):
+    """
+    Bin edges of a sorted daily time axis, computed once.
+
+    ``freq="season"`` bins meteorological seasons (DJF, MAM, JJA, SON); a
+    DJF season starts in the December of the previous year.
+
+    Returns
+    -------
+    starts : np.ndarray of int
+        Index of the first time step of every bin.
+    periods : np.ndarray of datetime64[M] or datetime64[Y]
+        The month or year of every bin (the first month of a season).
+    calendar_days : np.ndarray of int
+        Number of days the calendar period has (not the number present).
+    """
+    if freq not in _UNITS:
+        raise ValueError(f"freq must be one of {list(_UNITS)}, not {freq!r}")
+    keys = np.asarray(times).astype(_UNITS[freq])
+    if freq == "season":
+        # shift by a month so December joins the following January and February
+        keys = ((keys.astype(np.int64) + 1) // 3 * 3 - 1).astype("datetime64[M]")
+    starts = runs(keys)
+    periods = keys[starts]
+    calendar_days = ((periods + _STEPS[freq]).astype("datetime64[D]")
+                     - periods.astype("datetime64[D]")).astype(int)
+    return starts, periods, calendar_days
+
+
+def bin_labels(periods, label="end", step=1):
+    """
+    Timestamps for bins, at the period start or its last day (like resample
+    '1MS'/'1ME'). ``step`` is the number of periods per bin (3 months for a
+    season).
+    """
+    if label == "start":
+        return periods.astype("datetime64[ns]")
+    return ((periods + step).astype("datetime64[D]") - 1).astype("datetime64[ns]")
+
+
+def reduce_bins(block, starts):
+    """
+    NaN-aware sums, valid counts, minima and maxima of every bin of ``block``
+    (time first), each a single ufunc ``reduceat`` call.
+    """
+    valid = ~np.isnan(block)
+    sums = np.add.reduceat(np.where(valid, block, 0.0), starts, axis=0)
+    counts = np.add.reduceat(valid, starts, axis=0, dtype=np.int64)
+    with np.errstate(invalid="ignore"):
+        mins = np.fmin.reduceat(block, starts, axis=0)
+        maxs = np.fmax.reduceat(block, starts, axis=0)
+    return sums, counts, mins, maxs
+
+
+def aggregate(da, freq="month", how="mean", label="end", min_count=None, min_fraction=None,
+              block_size=None, memory_budget=None):
+    """
+    Monthly, seasonal or yearly aggregate of a daily DataArray, replacing
+    ``da.resample(time=...).<how>()``.
+
+    Bin edges are computed once from the time index and every statistic is
+    a ufunc ``reduceat`` over whole bins, read ``block_size`` days at a time.
+    NaNs are skipped. Only periods present in the time axis get a bin.
+
+    Parameters
+    ----------
+    freq : {"month", "season", "year"}
+    how : {"mean", "sum", "count", "min", "max"}
+    label : {"end", "start"}
+        Label bins by the last day of the period (as '1ME'/'1YE') or by its
+        first day (as '1MS'/'1YS').
+    min_count : int, optional
+        Bins with fewer valid values are set to NaN.
+    min_fraction : float, optional
+        Bins whose valid values cover less than this fraction of the calendar
+        period (e.g. 0.8 of the days in the month) are set to NaN.
+    """
+    da = da.transpose("time", ...)
+    starts, periods, _ = time_bins(da["time"].values, freq)
+    out = np.empty((len(starts),) + da.shape[1:], dtype=float)
+    pos = 0
+    for labels, block in iter_aggregate(da, freq, how, label, min_count, min_fraction,
+                                        block_size, memory_budget):
+        out[pos:pos + len(labels)] = block
+        pos += len(labels)
+
+    dtype = da.dtype if np.issubdtype(da.dtype, np.floating) and how != "count" else out.dtype
+    template = da.isel(time=0, drop=True)
+    return xr.DataArray(
+        out.astype(dtype, copy=False),
+        dims=da.dims,
+        coords={"time": bin_labels(periods, label, _STEPS[freq]), **template.coords},
+        name=da.name,
+    )
+
+
+def iter_aggregate(da, freq="month", how="mean", label="end", min_count=None, min_fraction=None,
+                   block_size=None, memory_budget=None):
+    """
+    ``aggregate`` streamed as ``(labels, array)`` blocks of whole periods,
+    read ``block_size`` days at a time (at least one period per block), for
+    records whose aggregates are not needed all at once.
+    """
+    if how not in HOW:
+        raise ValueError(f"how must be one of {HOW}, not {how!r}")
+    da = da.transpose("time", ...)
+    starts, periods, calendar_days = time_bins(da["time"].values, freq)
+    labels = bin_labels(periods, label, _STEPS[freq])
+    if block_size is None:
+        block_size = time_block_size(da, memory_budget)
+
+    ends = np.r_[starts[1:], da.sizes["time"]]
+    i = 0
+    while i < len(starts):
+        # whole bins per read, at least one
+        j = i + 1
+        while j < len(starts) and ends[j] - starts[i] <= block_size:
+            j += 1
+        block = np.asarray(da.isel(time=slice(starts[i], ends[j - 1])).values, dtype=float)
+        sums, counts, mins, maxs = reduce_bins(block, starts[i:j] - starts[i])
+        if how == "mean":
+            with np.errstate(invalid="ignore", divide="ignore"):
+                out = np.where(counts > 0, sums / counts, np.nan)
+        else:
+            out = {"sum": sums, "count": counts, "min": mins, "max": maxs}[how]
+
+        incomplete = np.zeros(counts.shape, dtype=bool)
+        if min_count is not None:
+            incomplete |= counts < min_count
+        if min_fraction is not None:
+            shape = (-1,) + (1,) * (counts.ndim - 1)
+            incomplete |= counts < min_fraction * calendar_days[i:j].reshape(shape)
+        if incomplete.any():
+            out = out.astype(float, copy=False)
+            out[incomplete] = np.nan
+        yield labels[i:j], out
+        i = j
@@ -0,0 +1,333 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+import xarray as xr
+from simple_climate_package.aggregate import iter_aggregate
+from simple_climate_package.loader import parse_memory
+from simple_climate_package.stats import time_block_size
+
+try:
+    import fcntl
+except ImportError:     # Windows: stores are only locked between threads of one process
+    fcntl = None
+
+###Day-of-year climatology and anomaly kernels###
+
+
+def day_slots(times, drop_feb29=True):
+    """
+    Map every date to a day-of-year climatology slot.
+
+    With ``drop_feb29=True`` the calendar has 365 slots: days after Feb 28
+    in leap years are shifted back by one so every calendar date has the
+    same slot in every year, and Feb 29 is mapped onto the Feb 28 slot.
+    Otherwise the calendar has 366 slots and Feb 29 has a slot of its own.
+
+    Returns
+    -------
+    slots : np.ndarray of int
+        Zero-based slot of every date.
+    n_slots : int
+        365 or 366.
+    feb29 : np.ndarray of bool
+        True on Feb 29.
+    """
+    t = pd.DatetimeIndex(times)
+    doy = np.asarray(t.dayofyear)
+    leap = np.asarray(t.is_leap_year)
+    feb29 = np.asarray((t.month == 2) & (t.day == 29))
+    if drop_feb29:
+        return doy - 1 - (leap & (doy >= 60)), 365, feb29
+    return doy - 1 + (~leap & (doy >= 60)), 366, feb29
+
+
+def daily_slot_sums(da, drop_feb29=True, block_size=None, memory_budget=None):
+    """
+    Sums and valid counts of every day-of-year slot, accumulated with a
+    scatter-add over blocks of the time axis.
+
+    Feb 29 is left out when ``drop_feb29=True``.
+
+    Returns
+    -------
+    sums, counts : np.ndarray
+        Shape ``(n_slots,) + grid``, on the non-time dimensions of ``da``
+        with time first.
+    """
+    da = da.transpose("time", ...)
+    slots, n_slots, feb29 = day_slots(da["time"].values, drop_feb29)
+    if block_size is None:
+        block_size = time_block_size(da, memory_budget)
+
+    sums = np.zeros((n_slots,) + da.shape[1:], dtype=float)
+    counts = np.zeros((n_slots,) + da.shape[1:], dtype=np.int64)
+    use = ~feb29 if drop_feb29 else np.ones(len(slots), dtype=bool)
+    for i0 in range(0, da.sizes["time"], block_size):
+        block = np.asarray(da.isel(time=slice(i0, i0 + block_size)).values, dtype=float)
+        i1 = i0 + block.shape[0]
+        add_slot_sums(sums, counts, block, slots[i0:i1], use[i0:i1])
+    return sums, counts
+
+
+def add_slot_sums(sums, counts, block, slots, use):
+    """Scatter-add the days of ``block`` flagged in ``use`` into their ``slots``."""
+    block, slots = block[use], slots[use]
+    valid = ~np.isnan(block)
+    np.add.at(sums, slots, np.where(valid, block, 0.0))
+    np.add.at(counts, slots, valid)
+
+
+def daily_climatology(da, drop_feb29=True, block_size=None, memory_budget=None):
+    """
+    Mean of every day-of-year slot (see ``daily_slot_sums``).
+
+    Returns
+    -------
+    np.ndarray
+        Climatology with shape ``(n_slots,) + grid`` (float64).
+    """
+    sums, counts = daily_slot_sums(da, drop_feb29, block_size, memory_budget)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+
+def clim_to_dataarray(clim, da):
+    """Wrap a climatology array in a DataArray with a ``dayofyear`` (1..n) dimension."""
+    template = da.transpose("time", ...).isel(time=0, drop=True)
+    dtype = da.dtype if np.issubdtype(da.dtype, np.floating) else np.dtype(float)
+    return xr.DataArray(
+        clim.astype(dtype),
+        dims=("dayofyear",) + template.dims,
+        coords={"dayofyear": np.arange(1, clim.shape[0] + 1), **template.coords},
+        name=da.name,
+    )
+
+
+def _anomaly_blocks(da, clim, drop_feb29, keep_feb29, block_size, memory_budget):
+    # yields (times, values, climatology slots) for each block of days to keep
+    times = da["time"].values
+    slots, n_slots, feb29 = day_slots(times, drop_feb29)
+    if clim.shape[0] != n_slots:
+        raise ValueError(f"climatology has {clim.shape[0]} slots, expected {n_slots}")
+    keep = ~feb29 if not keep_feb29 else np.ones(len(times), dtype=bool)
+    if block_size is None:
+        block_size = time_block_size(da, memory_budget)
+
+    for i0 in range(0, len(times), block_size):
+        i1 = min(i0 + block_size, len(times))
+        k = keep[i0:i1]
+        yield times[i0:i1][k], da.isel(time=slice(i0, i1)).values[k], slots[i0:i1][k]
+
+
+def iter_daily_anomalies(da, clim, drop_feb29=True, keep_feb29=True, block_size=None,
+                         memory_budget=None):
+    """
+    Stream daily anomalies block by block for data that does not fit in memory.
+
+    Yields ``(times, anomalies)`` pairs where ``anomalies`` has shape
+    ``(len(times),) + grid``. Feb 29 uses the Feb 28 climatology when the
+    climatology has 365 slots, and is skipped when ``keep_feb29=False``.
+    """
+    da = da.transpose("time", ...)
+    dtype = da.dtype if np.issubdtype(da.dtype, np.floating) else np.dtype(float)
+    for times, block, slots in _anomaly_blocks(da, clim, drop_feb29, keep_feb29, block_size, memory_budget):
+        out = np.empty(block.shape, dtype=dtype)
+        np.subtract(block, clim[slots], out=out, casting="same_kind")
+        yield times, out
+
+
+def _month_index(labels):
+    # calendar month 0..11 of every monthly label
+    return np.asarray(labels).astype("datetime64[M]").astype(np.int64) % 12
+
+
+def monthly_means_climatology(da, block_size=None, memory_budget=None):
+    """
+    Mean of the monthly means of every calendar month, as
+    ``aggregate(da, "month").groupby("time.month").mean()``, accumulated
+    block by block without holding the monthly means.
+
+    Returns
+    -------
+    xr.DataArray
+        (month, *grid) for the calendar months present in ``da``.
+    """
+    da = da.transpose("time", ...)
+    sums = np.zeros((12,) + da.shape[1:])
+    counts = np.zeros((12,) + da.shape[1:], dtype=np.int64)
+    seen = np.zeros(12, dtype=bool)
+    for labels, block in iter_aggregate(da, "month", "mean", block_size=block_size,
+                                        memory_budget=memory_budget):
+        month = _month_index(labels)
+        valid = ~np.isnan(block)
+        np.add.at(sums, month, np.where(valid, block, 0.0))
+        np.add.at(counts, month, valid)
+        seen[month] = True
+    with np.errstate(invalid="ignore", divide="ignore"):
+        clim = np.where(counts > 0, sums / counts, np.nan)
+    present = np.flatnonzero(seen)
+    template = da.isel(time=0, drop=True)
+    return xr.DataArray(clim[present], dims=("month",) + template.dims,
+                        coords={"month": present + 1, **template.coords}, name=da.name)
+
+
+def iter_monthly_anomalies(da, clim, block_size=None, memory_budget=None):
+    """
+    Stream monthly mean anomalies (monthly mean minus the ``clim`` of its
+    calendar month) as ``(times, anomalies)`` blocks of whole months, read
+    ``block_size`` days at a time.
+    """
+    da = da.transpose("time", ...)
+    clim = clim.transpose("month", *da.dims[1:])
+    by_month = np.full((12,) + clim.shape[1:], np.nan)
+    by_month[clim["month"].values - 1] = clim.values
+    for labels, block in iter_aggregate(da, "month", "mean", block_size=block_size,
+                                        memory_budget=memory_budget):
+        yield labels, block - by_month[_month_index(labels)]
+
+
+def daily_anomalies(da, clim, drop_feb29=True, keep_feb29=True, block_size=None,
+                    memory_budget=None):
+    """
+    Daily anomalies (value minus its day-of-year climatology), written block
+    by block straight into a single preallocated array.
+
+    Returns
+    -------
+    xr.DataArray
+        Anomalies on ``da``'s time axis (without Feb 29 if ``keep_feb29=False``).
+    """
+    da = da.transpose("time", ...)
+    _, _, feb29 = day_slots(da["time"].values, drop_feb29)
+    keep = ~feb29 if not keep_feb29 else np.ones(da.sizes["time"], dtype=bool)
+    dtype = da.dtype if np.issubdtype(da.dtype, np.floating) else np.dtype(float)
+    out = np.empty((int(keep.sum()),) + da.shape[1:], dtype=dtype)
+
+    pos = 0
+    for _, block, slots in _anomaly_blocks(da, clim, drop_feb29, keep_feb29, block_size, memory_budget):
+        n = block.shape[0]
+        np.subtract(block, clim[slots], out=out[pos:pos + n], casting="same_kind")
+        pos += n
+
+    template = da.isel(time=keep) if not keep.all() else da
+    return xr.DataArray(out, dims=template.dims, coords=template.coords, name=da.name)
+
+
+class ClimatologyStore:
+    """
+    On-disk store of computed climatologies, reused between calls and processes.
+
+    Every entry is a NetCDF file in ``directory`` named by a key that hashes
+    the source checksum, the variable and the options (kind, baseline,
+    calendar), listed in a JSON manifest. Storing an entry for a source
+    whose checksum has changed deletes the stale entries of that source,
+    and the least recently used entries are evicted once the store holds
+    more than ``max_bytes``. Manifest updates hold a lock on the folder, so
+    any number of threads and processes can share one store.
+    """
+
+    MANIFEST = "manifest.json"
+    LOCK = ".lock"
+
+    # one thread lock per store folder, shared by every store object on it
+    _thread_locks = {}
+    _thread_locks_guard = threading.Lock()
+
+    def __init__(self, directory, max_bytes="2GB"):
+        self.directory = str(directory)
+        self.max_bytes = parse_memory(max_bytes)
+        os.makedirs(self.directory, exist_ok=True)
+        with self._thread_locks_guard:
+            self._lock = self._thread_locks.setdefault(os.path.realpath(self.directory), threading.Lock())
+
+    @contextmanager
+    def _locked(self):
+        # the manifest is read, changed and written back by threads and processes alike
+        with self._lock, open(os.path.join(self.directory, self.LOCK), "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def _temp_path(self, suffix):
+        # unique per writer, so concurrent writes never share a temporary file
+        with tempfile.NamedTemporaryFile(dir=self.directory, suffix=suffix, delete=False) as f:
+            return f.name
+
+    @classmethod
+    def next_to(cls, filepath, **kwargs):
+        """Store in a ``.climatology`` folder beside the data file."""
+        return cls(os.path.join(os.path.dirname(os.path.abspath(filepath)), ".climatology"), **kwargs)
+
+    @staticmethod
+    def key(checksum, varname, kind, **options):
+        text = json.dumps([checksum, varname, kind, options], sort_keys=True, default=str)
+        return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.nc")
+
+    def _read_manifest(self):
+        try:
+            with open(os.path.join(self.directory, self.MANIFEST)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_manifest(self, manifest):
+        tmp = self._temp_path(".json.tmp")
+        with open(tmp, "w") as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(tmp, os.path.join(self.directory, self.MANIFEST))
+
+    def _remove(self, manifest, key):
+        manifest.pop(key, None)
+        if os.path.exists(self._path(key)):
+            os.remove(self._path(key))
+
+    def get(self, key):
+        """Stored climatology for ``key`` (loaded into memory), or None."""
+        with self._locked():
+            manifest = self._read_manifest()
+            if key not in manifest or not os.path.exists(self._path(key)):
+                return None
+            manifest[key]["last_used"] = time.time()
+            self._write_manifest(manifest)
+            return xr.load_dataarray(self._path(key))
+
+    def put(self, key, clim, source, checksum):
+        """Store ``clim`` under ``key``, dropping stale entries and evicting old ones."""
+        tmp = self._temp_path(".nc.tmp")
+        clim.to_netcdf(tmp)
+        with self._locked():
+            manifest = self._read_manifest()
+            # the source has changed since these were computed
+            for old, entry in list(manifest.items()):
+                if entry["source"] == os.path.abspath(source) and entry["checksum"] != checksum:
+                    self._remove(manifest, old)
+
+            os.replace(tmp, self._path(key))
+            manifest[key] = {"source": os.path.abspath(source), "checksum": checksum,
+                             "bytes": os.path.getsize(self._path(key)), "last_used": time.time()}
+
+            total = sum(e["bytes"] for e in manifest.values())
+            for old in sorted(manifest, key=lambda k: manifest[k]["last_used"]):
+                if total <= self.max_bytes or old == key:
+                    continue
+                total -= manifest[old]["bytes"]
+                self._remove(manifest, old)
+            self._write_manifest(manifest)
+
+    def invalidate(self, source=None):
+        """Delete every entry, or only those computed from ``source``."""
+        with self._locked():
+            manifest = self._read_manifest()
+            for key, entry in list(manifest.items()):
+                if source is None or entry["source"] == os.path.abspath(source):
+                    self._remove(manifest, key)
+            self._write_manifest(manifest)
@@ -0,0 +1,470 @@
+import os
+import numpy as np
+import xarray as xr
+from simple_climate_package.loader import default_memory_budget
+from simple_climate_package.mean import CalcMean
+
+###Empirical orthogonal functions of temperature anomalies###
+
+
+def area_weights(template, lat):
+    """
+    sqrt(cos(latitude)) weights on the grid of ``template`` (a DataArray
+    without a time dimension), so that every cell's contribution to the
+    covariance is proportional to its area.
+    """
+    w = np.sqrt(np.clip(np.cos(np.deg2rad(template[lat])), 0.0, None))
+    return w.broadcast_like(template).transpose(*template.dims)
+
+
+def randomized_svd(A, n_modes, oversample=10, n_iter=4, seed=None):
+    """
+    Leading ``n_modes`` singular triplets of ``A`` by randomized range
+    finding (Halko, Martinsson & Tropp, 2011).
+
+    ``A`` is multiplied by a random test matrix of ``n_modes + oversample``
+    columns, the range is sharpened by ``n_iter`` power iterations
+    (re-orthonormalised with QR) and the small projected matrix is
+    decomposed exactly. The cost is a few passes of matrix products with
+    ``A`` instead of a full decomposition.
+
+    Returns
+    -------
+    U, s, Vt : np.ndarray
+        Shapes (m, n_modes), (n_modes,) and (n_modes, n).
+    """
+    rng = np.random.default_rng(seed)
+    m, n = A.shape
+    k = min(n_modes + oversample, m, n)
+    Q, _ = np.linalg.qr(A @ rng.standard_normal((n, k)))
+    for _ in range(n_iter):
+        Q, _ = np.linalg.qr(A.T @ Q)
+        Q, _ = np.linalg.qr(A @ Q)
+    Ub, s, Vt = np.linalg.svd(Q.T @ A, full_matrices=False)
+    return Q @ Ub[:, :n_modes], s[:n_modes], Vt[:n_modes]
+
+
+def fix_signs(U, Vt):
+    """Flip modes so the largest loading of every pattern is positive."""
+    signs = np.sign(Vt[np.arange(Vt.shape[0]), np.abs(Vt).argmax(axis=1)])
+    signs[signs == 0] = 1.0
+    return U * signs, Vt * signs[:, None]
+
+
+def varimax(loadings, gamma=1.0, tol=1e-8, max_iter=500):
+    """
+    Varimax (``gamma=1``) or other orthomax rotation of a (cells, k)
+    loading matrix (Kaiser, 1958).
+
+    Each iteration needs two products with the loadings, ``loadings @ R``
+    and ``loadings.T @ G``, and the SVD of a k x k matrix, so the large
+    matrix is never copied or decomposed. Iteration stops once no entry
+    of the rotation changes by more than ``tol``.
+
+    Returns
+    -------
+    rotated : np.ndarray
+        ``loadings @ R``.
+    R : np.ndarray
+        The k x k orthogonal rotation.
+    n_iter : int
+    converged : bool
+    """
+    p, k = loadings.shape
+    R = np.eye(k)
+    for n_iter in range(1, max_iter + 1):
+        L = loadings @ R
+        G = L ** 3 - L * ((gamma / p) * np.sum(L * L, axis=0))
+        u, _, vt = np.linalg.svd(loadings.T @ G)
+        previous, R = R, u @ vt
+        if np.abs(R - previous).max() < tol:
+            return loadings @ R, R, n_iter, True
+    return loadings @ R, R, max_iter, False
+
+
+class IncrementalSVD:
+    """
+    Rank-``rank`` SVD of the column-centred rows seen so far, updated one
+    block of rows at a time (incremental PCA; Ross et al., 2008).
+
+    Every update decomposes the current factors ``diag(s) @ Vt`` stacked on
+    the centred new block and a row that corrects for the shift of the
+    mean, so only (rank + block) rows are ever held. The column means and
+    the total centred sum of squares are merged between blocks as well.
+    """
+
+    def __init__(self, rank):
+        self.rank = rank
+        self.n = 0
+        self.mean = None
+        self.s = None
+        self.Vt = None
+        self.total = 0.0    # centred sum of squares of everything seen
+
+    def partial_fit(self, B):
+        nB = B.shape[0]
+        if nB == 0:
+            return self
+        mean_b = B.mean(axis=0)
+        Bc = B - mean_b
+        if self.n == 0:
+            stack = Bc
+            self.mean = mean_b
+            self.total = float(np.sum(Bc * Bc))
+        else:
+            shift = self.mean - mean_b
+            factor = self.n * nB / (self.n + nB)
+            stack = np.vstack([self.s[:, None] * self.Vt, Bc, np.sqrt(factor) * shift[None]])
+            self.mean = self.mean + shift * (-nB / (self.n + nB))
+            self.total += float(np.sum(Bc * Bc)) + factor * float(np.sum(shift * shift))
+        _, s, Vt = np.linalg.svd(stack, full_matrices=False)
+        self.s, self.Vt = s[:self.rank], Vt[:self.rank]
+        self.n += nB
+        return self
+
+
+class EOFBasis:
+    """
+    Saved EOF patterns for projecting new anomalies on the same grid.
+
+    Only the cells with data are stored, as float32 (mode, cell) patterns
+    plus a grid mask, along with the centring and area weights of the
+    original decomposition. The weights and the centring are folded into
+    the patterns once, so the PCs of a block of anomalies are one matrix
+    product: ``pc = X @ (w * eof).T - offset``.
+
+    Example
+    -------
+    >>> basis = EOFBasis.from_results(eof.eofs(n_modes=5))
+    >>> basis.save('tg_eofs.nc')
+    >>> pcs = EOFBasis.load('tg_eofs.nc').project(new_anomalies)
+    """
+
+    def __init__(self, patterns, mask, weights, mean, grid, singular_values=None):
+        self.patterns = np.asarray(patterns, dtype=np.float32)   # (mode, cell)
+        self.mask = np.asarray(mask, dtype=bool)                  # grid shape
+        self.weights = np.asarray(weights, dtype=np.float32)     # (cell,)
+        self.mean = np.asarray(mean, dtype=np.float32)           # (cell,)
+        self.grid = grid                                          # DataArray with the grid dims and coords
+        self.singular_values = singular_values
+        # weights and centring folded in: pc = X @ self._loadings.T - self._offset
+        self._loadings = self.patterns * self.weights
+        self._offset = self._loadings @ self.mean
+
+    @property
+    def n_modes(self):
+        return self.patterns.shape[0]
+
+    @classmethod
+    def from_results(cls, results):
+        """Basis from the Dataset returned by ``CalcEOF.eofs``."""
+        eof = results["eof"]
+        grid = eof.isel(mode=0, drop=True)
+        mask = ~np.isnan(grid.values)
+        k = eof.sizes["mode"]
+        return cls(eof.values.reshape(k, -1)[:, mask.ravel()], mask,
+                   results["weights"].values[mask], results["mean"].values[mask],
+                   grid.copy(data=np.zeros(grid.shape, dtype=np.int8)),
+                   results["singular_values"].values)
+
+    def save(self, path):
+        ds = xr.Dataset(
+            {
+                "patterns": (("mode", "cell"), self.patterns),
+                "weights": ("cell", self.weights),
+                "mean": ("cell", self.mean),
+                "mask": (self.grid.dims, self.mask.astype(np.int8)),
+            },
+            coords={"mode": np.arange(1, self.n_modes + 1), **self.grid.coords},
+        )
+        if self.singular_values is not None:
+            ds["singular_values"] = ("mode", np.asarray(self.singular_values))
+        encoding = {v: {"zlib": True} for v in ("patterns", "weights", "mean", "mask")}
+        tmp = f"{path}.tmp"
+        ds.to_netcdf(tmp, encoding=encoding)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        ds = xr.load_dataset(path)
+        mask = ds["mask"]
+        sv = ds["singular_values"].values if "singular_values" in ds else None
+        return cls(ds["patterns"].values, mask.values.astype(bool), ds["weights"].values,
+                   ds["mean"].values, mask.copy(data=np.zeros(mask.shape, dtype=np.int8)), sv)
+
+    def _project_block(self, block):
+        X = np.asarray(block, dtype=np.float32).reshape(block.shape[0], -1)[:, self.mask.ravel()]
+        # gaps count as the mean, i.e. no contribution
+        X = np.where(np.isnan(X), self.mean, X)
+        return X @ self._loadings.T - self._offset
+
+    def project(self, anomalies, block_size=None):
+        """
+        PCs of new anomalies on this basis.
+
+        Parameters
+        ----------
+        anomalies : xr.DataArray | iterable of (times, array)
+            Anomalies on the basis grid, time first; either a DataArray
+            (read ``block_size`` steps at a time) or blocks such as those of
+            ``CalcMean.iter_daily_clim_Anom``.
+
+        Returns
+        -------
+        xr.DataArray
+            PCs on (time, mode), float32.
+        """
+        if isinstance(anomalies, xr.DataArray):
+            da = anomalies.transpose("time", *self.grid.dims)
+            step = block_size or da.sizes["time"]
+            anomalies = ((da["time"].values[i:i + step], da.isel(time=slice(i, i + step)).values)
+                         for i in range(0, da.sizes["time"], step))
+
+        times, pcs = [], []
+        for t, block in anomalies:
+            if block.shape[1:] != self.mask.shape:
+                raise ValueError(f"anomalies have grid {block.shape[1:]}, basis has {self.mask.shape}")
+            times.append(t)
+            pcs.append(self._project_block(block))
+        return xr.DataArray(np.concatenate(pcs), dims=("time", "mode"),
+                            coords={"time": np.concatenate(times),
+                                    "mode": np.arange(1, self.n_modes + 1)}, name="pc")
+
+
+class CalcEOF:
+    """
+    EOF (principal component) analysis of temperature anomalies.
+
+    Anomalies come from ``CalcMean.monthly_clim_Anom`` or
+    ``CalcMean.daily_clim_Anom``, and the file is read through the same
+    shared ``DataReader``. Every cell is weighted by sqrt(cos(latitude)),
+    cells that are NaN at every time (sea, outside the domain) are left
+    out, and the leading modes are found with a randomized truncated SVD.
+
+    Example
+    -------
+    >>> eof = CalcEOF(data_path, lat_range=(35, 70), lon_range=(-10, 30))
+    >>> modes = eof.eofs(n_modes=5, freq="monthly", baseline=("1991", "2020"))
+    >>> modes["explained_variance_ratio"]
+    """
+
+    def __init__(self, file_path, varname='tg', chunks=None, memory_budget=None,
+                 lat_range=None, lon_range=None, time_range=None, clim_store=None):
+        self.calc_mean = CalcMean(file_path, varname=varname, chunks=chunks, memory_budget=memory_budget,
+                                  lat_range=lat_range, lon_range=lon_range, time_range=time_range,
+                                  clim_store=clim_store)
+        self.reader = self.calc_mean.reader
+        self.tg = self.calc_mean.tg
+        self.lat = "lat" if "lat" in self.tg.coords else "latitude"
+        self.lon = "lon" if "lon" in self.tg.coords else "longitude"
+        self.results = None
+
+    def anomalies(self, freq="monthly", baseline=None):
+        """Monthly or daily anomalies from CalcMean, time first."""
+        if freq == "monthly":
+            anom = self.calc_mean.monthly_clim_Anom(baseline=baseline)
+        elif freq == "daily":
+            anom = self.calc_mean.daily_clim_Anom(baseline=baseline)
+        else:
+            raise ValueError(f"freq must be 'monthly' or 'daily', not {freq!r}")
+        return anom.transpose("time", ...)
+
+    def _grid(self, anom):
+        # grid template and flattened area weights
+        template = anom.isel(time=0, drop=True).reset_coords(drop=True)
+        weights = area_weights(template, self.lat).values.ravel()
+        return template, weights
+
+    def anomaly_blocks(self, freq="monthly", baseline=None, block_size=None):
+        """
+        Anomalies as (times, array) blocks streamed from the file without
+        being held whole: ``block_size`` days at a time, or the whole months
+        in about ``block_size`` days for monthly anomalies.
+        """
+        if freq == "daily":
+            return self.calc_mean.iter_daily_clim_Anom(baseline=baseline, block_size=block_size)
+        if freq == "monthly":
+            return self.calc_mean.iter_monthly_clim_Anom(baseline=baseline, block_size=block_size)
+        raise ValueError(f"freq must be 'monthly' or 'daily', not {freq!r}")
+
+    def _stream_block_size(self, n_cells, rank):
+        # about three (rows, cells) float64 arrays live in an incremental update
+        budget = self.reader.memory_budget or default_memory_budget()
+        return max(int(budget // (3 * 8 * max(n_cells, 1))) - rank, 1)
+
+    def eofs(self, n_modes=10, freq="monthly", baseline=None, weighted=True, oversample=10,
+             n_iter=4, seed=0, streaming=False, block_size=None):
+        """
+        Leading ``n_modes`` EOFs of the monthly or daily anomalies.
+
+        The anomaly of every cell is centred on its mean over the record and
+        multiplied by its area weight; remaining gaps in cells that do have
+        data count as zero anomaly. ``oversample`` and ``n_iter`` tune the
+        randomized SVD (see ``randomized_svd``); ``seed`` fixes its random
+        test matrix.
+
+        Returns
+        -------
+        xr.Dataset
+            ``eof`` (mode, lat, lon): unit-norm patterns in weighted space,
+            NaN over cells without data;
+            ``pc`` (time, mode): principal components, so that the weighted
+            anomalies are ``sum(pc * eof)`` over modes;
+            ``explained_variance``, ``explained_variance_ratio`` and
+            ``singular_values`` (mode);
+            ``mean`` and ``weights`` (lat, lon): the centring and weights
+            applied to the anomalies.
+
+        With ``streaming=True`` the anomalies are computed from ``block_size``
+        days of data at a time (whole months for monthly anomalies; chosen
+        from the reader's memory budget when not given) and the modes are updated incrementally (see
+        ``IncrementalSVD``), keeping ``n_modes + oversample`` of them
+        between blocks; a second pass projects the blocks onto the modes to
+        give the PCs. Memory stays proportional to block size times grid.
+        The leading modes match the in-memory result to within the
+        truncation error; gaps in cells that have data are filled with the
+        cell's mean over the block rather than over the record.
+        """
+        if streaming:
+            return self._eofs_streaming(n_modes, freq, baseline, weighted, oversample, block_size)
+
+        anom = self.anomalies(freq, baseline)
+        template, weights = self._grid(anom)
+        if not weighted:
+            weights = np.ones_like(weights)
+
+        T = anom.sizes["time"]
+        values = np.asarray(anom.values, dtype=float).reshape(T, -1)
+        cells = ~np.isnan(values).all(axis=0)
+        X = values[:, cells]
+        mean = np.nanmean(X, axis=0)
+        X = np.nan_to_num(X - mean) * weights[cells]
+
+        U, s, Vt = randomized_svd(X, n_modes, oversample=oversample, n_iter=n_iter, seed=seed)
+        U, Vt = fix_signs(U, Vt)
+        self.results = self._dataset(anom["time"].values, template, cells, U * s, s, Vt,
+                                     total=np.sum(X * X), T=T)
+        self.results["mean"] = self._on_grid(mean[None], template, cells)[0]
+        self.results["weights"] = template.copy(data=weights.reshape(template.shape))
+        return self.results
+
+    def rotate(self, results=None, gamma=1.0, tol=1e-8, max_iter=500):
+        """
+        Varimax rotation of EOFs (the last ``eofs`` result by default).
+
+        The patterns are scaled to loadings (pattern times the square root
+        of its explained variance) and rotated with ``varimax``. The result
+        has the same layout as ``eofs``: unit-norm rotated patterns, PCs such
+        that the weighted anomalies are still ``sum(pc * eof)``, and the
+        variance each rotated mode explains; modes are reordered by it.
+        Attributes record the number of iterations and convergence.
+        """
+        results = self.results if results is None else results
+        if results is None:
+            raise ValueError("no EOFs computed yet, call eofs() first")
+        eof = results["eof"]
+        k = eof.sizes["mode"]
+        flat = eof.values.reshape(k, -1)
+        cells = ~np.isnan(flat[0])
+        variance = results["explained_variance"].values
+        total = variance[0] / results["explained_variance_ratio"].values[0]
+
+        loadings = flat[:, cells].T * np.sqrt(variance)
+        rotated, R, n_iter, converged = varimax(loadings, gamma=gamma, tol=tol, max_iter=max_iter)
+        norms = np.sqrt(np.sum(rotated * rotated, axis=0))
+        order = np.argsort(-norms)
+        norms, rotated = norms[order], rotated[:, order]
+        pcs = (results["pc"].values / np.sqrt(variance)) @ R[:, order] * norms
+        pcs, patterns = fix_signs(pcs, (rotated / norms).T)
+
+        # the rotated PCs stay orthogonal, so their norms play the part of singular values
+        T = len(results["time"])
+        template = eof.isel(mode=0, drop=True)
+        rotated_results = self._dataset(results["time"].values, template, cells, pcs,
+                                        np.sqrt(np.sum(pcs * pcs, axis=0)), patterns,
+                                        total=total * max(T - 1, 1), T=T)
+        for name in ("mean", "weights"):
+            if name in results:
+                rotated_results[name] = results[name]
+        rotated_results.attrs.update(rotation="varimax" if gamma == 1.0 else f"orthomax(gamma={gamma})",
+                                     n_iter=n_iter, converged=int(converged))
+        return rotated_results
+
+    def basis(self):
+        """``EOFBasis`` of the last ``eofs`` result, for saving and projecting."""
+        if self.results is None:
+            raise ValueError("no EOFs computed yet, call eofs() first")
+        return EOFBasis.from_results(self.results)
+
+    def project(self, basis, freq="monthly", baseline=None, block_size=None):
+        """
+        PCs of this file's anomalies on a stored basis (an ``EOFBasis`` or
+        the path of a saved one), streamed ``block_size`` steps at a time,
+        e.g. to extend operational indices with a new release.
+        """
+        if not isinstance(basis, EOFBasis):
+            basis = EOFBasis.load(basis)
+        return basis.project(self.anomaly_blocks(freq, baseline, block_size))
+
+    def _eofs_streaming(self, n_modes, freq, baseline, weighted, oversample, block_size):
+        template = self.tg.isel(time=0, drop=True).reset_coords(drop=True)
+        weights = area_weights(template, self.lat).values.ravel()
+        if not weighted:
+            weights = np.ones_like(weights)
+        rank = n_modes + oversample
+        if block_size is None:
+            block_size = self._stream_block_size(weights.size, rank)
+
+        def weighted_blocks():
+            for times, block in self.anomaly_blocks(freq, baseline, block_size):
+                X = np.asarray(block, dtype=float).reshape(len(times), -1)
+                valid = ~np.isnan(X)
+                n_valid = valid.sum(axis=0)
+                fill = np.where(valid, X, 0.0).sum(axis=0) / np.maximum(n_valid, 1)
+                yield times, np.where(valid, X, fill) * weights, n_valid
+
+        # pass 1: incremental decomposition, counting the cells that have data
+        isvd = IncrementalSVD(rank)
+        count = np.zeros(weights.size, dtype=np.int64)
+        for _, X, n_valid in weighted_blocks():
+            isvd.partial_fit(X)
+            count += n_valid
+        cells = count > 0
+        s, Vt = isvd.s[:n_modes], isvd.Vt[:n_modes][:, cells]
+
+        # pass 2: principal components
+        times, pcs = [], []
+        for t, X, _ in weighted_blocks():
+            times.append(t)
+            pcs.append((X - isvd.mean)[:, cells] @ Vt.T)
+        pcs, Vt = fix_signs(np.concatenate(pcs), Vt)
+
+        self.results = self._dataset(np.concatenate(times), template, cells, pcs, s, Vt,
+                                     total=isvd.total, T=isvd.n)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = isvd.mean[cells] / weights[cells]
+        self.results["mean"] = self._on_grid(mean[None], template, cells)[0]
+        self.results["weights"] = template.copy(data=weights.reshape(template.shape))
+        return self.results
+
+    @staticmethod
+    def _on_grid(rows, template, cells):
+        # (k, valid cells) -> (k, *grid) with NaN outside the valid cells
+        full = np.full((rows.shape[0], cells.size), np.nan)
+        full[:, cells] = rows
+        return xr.DataArray(full.reshape((rows.shape[0],) + template.shape),
+                            dims=("mode",) + template.dims, coords=template.coords)
+
+    def _dataset(self, times, template, cells, pcs, s, Vt, total, T):
+        modes = np.arange(1, len(s) + 1)
+        variance = s ** 2 / max(T - 1, 1)
+        return xr.Dataset(
+            {
+                "eof": self._on_grid(Vt, template, cells),
+                "pc": (("time", "mode"), pcs),
+                "explained_variance": ("mode", variance),
+                "explained_variance_ratio": ("mode", s ** 2 / total),
+                "singular_values": ("mode", s),
+            },
+            coords={"mode": modes, "time": times},
+        )
@@ -1,52 +1,62 @@
 import xarray as xr
-import matplotlib.pyplot as plt
 import os
 import pandas as pd
 from simple_climate_package.loader import DataReader
-
-class CalcExtremes:
-    def __init__(self, file_path, varname='tg'):
-        dr = DataReader(file_path)
-        ds = dr.read()
+from simple_climate_package.aggregate import aggregate
+from simple_climate_package.index import RangeExtremesIndex
+from simple_climate_package.plotting import render_series, save_map
+from simple_climate_package.stats import TimeSummaryMixin
+
+class CalcExtremes(TimeSummaryMixin):
+    def __init__(self, file_path, varname='tg', chunks=None, memory_budget=None,
+                 lat_range=None, lon_range=None, time_range=None):
+        # the reader shares one opened dataset between every analysis class on this file
+        # and only reads the requested lat/lon box and time window from it
+        # chunks="auto" opens the file lazily with dask, planned for reductions over time
+        self.reader = DataReader(file_path, chunks=chunks, memory_budget=memory_budget,
+                                 operation="reduce", varname=varname,
+                                 lat_range=lat_range, lon_range=lon_range, time_range=time_range)
+        ds = self.reader.read()
 
         if varname is None:
-            varname = list(self.ds.data_vars)[0]
+            varname = list(ds.data_vars)[0]
 
         if varname not in ds:
             raise KeyError(f'{varname} not in dataset')
         
         self.tg = ds[varname]
-
-        # check the file exists
-        # if not os.path.exists(filepath):
-        #     FileNotFoundError(f"File not found: {filepath}")
-
-        # # try to open the dataset
-        # try:
-        #     self.ds = xr.open_dataset(filepath, decode_times=True)
-        #     print('\nThe data exists, go on with analysis :)')
-        #     print(f"Opened: {filepath}")
-        #     print("Dimensions:", self.ds.dims)
-        #     print("Variables:", list(self.ds.data_vars))
-
-        # # store the temperature variable
-        #     self.tg = self.ds[varname]
-
-        # except Exception as e:
-        #     raise RuntimeError(f"Error reading {filepath}: {e}")
+        self.extremes_index = None
+        self._aggregates = {}    # monthly and yearly aggregates computed by this instance
+
+    def build_extremes_index(self, block=32, save=True):
+        """
+        Load or build the range min/max index used by min_between and max_between.
+
+        The index is stored next to the data file and rebuilt automatically
+        when the data file changes. Once built, a window's min or max reads
+        a few table entries (at most twice the log2 of the number of blocks)
+        plus at most two partial blocks of ``block`` days per grid pixel,
+        however long the window.
+        """
+        path = self.reader.sidecar_path('extidx', self.tg.name, block)
+        source_hash = self.reader.content_hash(self.tg.name, block)
+        index = RangeExtremesIndex.load(path, self.tg, source_hash)
+        if index is None:
+            index = RangeExtremesIndex.build(self.tg, block=block, memory_budget=self.reader.memory_budget,
+                                             source_hash=source_hash)
+            if save:
+                index.save(path)
+        self.extremes_index = index
+        return index
 
     def min_between(self, start, end):
-        # Identify the minimum temperature values between two dates and plot
+        # Identify the minimum temperature values between two dates
 
-        # select data between two dates
-        selected_data = self.tg.sel(time=slice(start, end))
+        if self.extremes_index is not None:
+            return self.extremes_index.min(start, end).rename(self.tg.name)
+        return self.summary(start, end)['min'].rename(self.tg.name)
 
-        # plot this data on a map
-        min_map = selected_data.min(dim='time')
-        
-        return min_map
-
-    def plot_min_between(self, start, end):
+    def plot_min_between(self, start, end, redraw=False, full_resolution=False):
         # Identify the minimum temperature values between two dates and plot
        
         # Get the current working directory
@@ -56,36 +66,24 @@ class CalcExtremes:
         save_path = os.path.join(current_dir, 'plots')
         os.makedirs(save_path, exist_ok=True)
 
-        # select data between two dates
-        selected_data = self.tg.sel(time=slice(start, end))
-
-        # plot this data on a map
-        min_map = selected_data.min(dim='time')
-        qm = min_map.plot(cmap='RdYlBu_r')          # xarray returns an Axes object
-        ax = qm.axes
-        ax.set_title(f"Minimum {self.tg.name} values between {start} and {end}")
-        ax.figure.savefig(save_path + f'/Min_{self.tg.name}_values_between_{start}_and_{end}.png', bbox_inches='tight')
-        plt.close(ax.figure)
+        # plot this data on a map, unless the file already shows the same data
+        min_map = self.min_between(start, end)
+        title = f"Minimum {self.tg.name} values between {start} and {end}"
+        filepath = save_path + f'/Min_{self.tg.name}_values_between_{start}_and_{end}.png'
+        save_map(min_map, title, filepath, "min", redraw, full_resolution)
 
         return min_map
 
     def max_between(self, start, end):
-        # Identify the maximum temperature values between two dates and plot
-
-        # select data between two dates
-        selected_data = self.tg.sel(time=slice(start, end))
-
-        # plot this data on a map
-        max_map = selected_data.max(dim='time')
+        # Identify the maximum temperature values between two dates
 
-        return max_map
+        if self.extremes_index is not None:
+            return self.extremes_index.max(start, end).rename(self.tg.name)
+        return self.summary(start, end)['max'].rename(self.tg.name)
     
-    def plot_max_between(self, start, end):
+    def plot_max_between(self, start, end, redraw=False, full_resolution=False):
         # Identify the maximum temperature values between two dates and plot
 
-        # select data between two dates
-        selected_data = self.tg.sel(time=slice(start, end))
-       
         # Get the current working directory
         current_dir = os.getcwd()
 
@@ -93,26 +91,21 @@ class CalcExtremes:
         save_path = os.path.join(current_dir, 'plots')
         os.makedirs(save_path, exist_ok=True)
 
-        # plot this data on a map
-        max_map = selected_data.max(dim='time')
-        qm = max_map.plot(cmap='RdYlBu_r')
-        ax = qm.axes
-        ax.set_title(f"Maximum {self.tg.name} values between {start} and {end}")
-        ax.figure.savefig(save_path + f'/Max_{self.tg.name}_values_between_{start}_and_{end}.png', bbox_inches='tight')
-        plt.close(ax.figure)
+        # plot this data on a map, unless the file already shows the same data
+        max_map = self.max_between(start, end)
+        title = f"Maximum {self.tg.name} values between {start} and {end}"
+        filepath = save_path + f'/Max_{self.tg.name}_values_between_{start}_and_{end}.png'
+        save_map(max_map, title, filepath, "max", redraw, full_resolution)
 
         return max_map
 
 
     def min_tot(self):
-        # Identify the minimum temperature over the whole dataset and plot
+        # Identify the minimum temperature over the whole dataset
 
-        # plot this data on a map
-        min_map = self.tg.min(dim='time')
-        
-        return min_map
+        return self.summary()['min'].rename(self.tg.name)
 
-    def plot_min_tot(self):
+    def plot_min_tot(self, redraw=False, full_resolution=False):
         # Identify the minimum temperature over the whole dataset and plot
         
         # Get the current working directory
@@ -122,26 +115,21 @@ class CalcExtremes:
         save_path = os.path.join(current_dir, 'plots')
         os.makedirs(save_path, exist_ok=True)
 
-        # plot this data on a map
-        min_map = self.tg.min(dim='time')
-        qm = min_map.plot(cmap='RdYlBu_r')
-        ax = qm.axes
-        ax.set_title(f"Overall minimum {self.tg.name} values")
-        ax.figure.savefig(save_path + f'/Min_{self.tg.name}_tot_time.png', bbox_inches='tight')
-        plt.close(ax.figure)
+        # plot this data on a map, unless the file already shows the same data
+        min_map = self.min_tot()
+        title = f"Overall minimum {self.tg.name} values"
+        filepath = save_path + f'/Min_{self.tg.name}_tot_time.png'
+        save_map(min_map, title, filepath, "min", redraw, full_resolution)
 
         return min_map
 
 
     def max_tot(self):
-        # Identify the maximum temperature over the whole dataset and plot
+        # Identify the maximum temperature over the whole dataset
 
-        # plot this data on a map
-        max_map = self.tg.max(dim='time')
-        
-        return max_map
+        return self.summary()['max'].rename(self.tg.name)
 
-    def plot_max_tot(self):
+    def plot_max_tot(self, redraw=False, full_resolution=False):
         # Identify the maximum temperature over the whole dataset and plot
         
         # Get the current working directory
@@ -151,114 +139,73 @@ class CalcExtremes:
         save_path = os.path.join(current_dir, 'plots')
         os.makedirs(save_path, exist_ok=True)
 
-        # plot this data on a map
-        max_map = self.tg.max(dim='time')
-        qm = max_map.plot(cmap='RdYlBu_r')
-        ax = qm.axes
-        ax.set_title(f"Overall maximum {self.tg.name} values")
-        ax.figure.savefig(save_path + f'/Max_{self.tg.name}_tot_time.png', bbox_inches='tight')
-        plt.close(ax.figure)
+        # plot this data on a map, unless the file already shows the same data
+        max_map = self.max_tot()
+        title = f"Overall maximum {self.tg.name} values"
+        filepath = save_path + f'/Max_{self.tg.name}_tot_time.png'
+        save_map(max_map, title, filepath, "max", redraw, full_resolution)
 
         return max_map
 
-    def monthly_max(self):
-        return self.tg.resample(time="1ME").max()
-
-    def monthly_min(self):
-        return self.tg.resample(time="1ME").min()
-
-    def yearly_max(self):
-        return self.tg.resample(time="1YE").max()
-
-    def yearly_min(self):
-        return self.tg.resample(time="1YE").min()
-
-    def plot_yearly_max(self):
-        
-        # calculate the yearly mean:
-        yearly_ds = self.yearly_max()
-        # da = yearly_ds[var]
-        da = yearly_ds
-        lats = yearly_ds.coords['latitude'].values
-        lons = yearly_ds.coords['longitude'].values
-
-        # 3. Compute global vmin/vmax for consistent color scaling
-        vmin = float(da.min(skipna=True).values)
-        vmax = float(da.max(skipna=True).values)
-
-        # Get the current working directory
-        current_dir = os.getcwd()
+    # min_fraction: months/years with fewer valid days than this share are NaN
+    def _aggregate(self, freq, how, min_fraction=None):
+        # computed once per instance and shared by every method (and pipeline step) that needs it
+        key = (freq, how, min_fraction)
+        if key not in self._aggregates:
+            self._aggregates[key] = aggregate(self.tg, freq, how, min_fraction=min_fraction,
+                                              memory_budget=self.reader.memory_budget)
+        return self._aggregates[key]
+
+    def monthly_max(self, min_fraction=None):
+        return self._aggregate("month", "max", min_fraction)
+
+    def monthly_min(self, min_fraction=None):
+        return self._aggregate("month", "min", min_fraction)
+
+    def yearly_max(self, min_fraction=None):
+        return self._aggregate("year", "max", min_fraction)
+
+    def yearly_min(self, min_fraction=None):
+        return self._aggregate("year", "min", min_fraction)
+
+    def plot_yearly_max(self, n_workers=None, combined=None, redraw=False, full_resolution=False):
+        # plot the max of every year, rendered by a pool of workers
+        # (combined="gif" or "pdf" writes every frame into one animated or multi-page file;
+        # frames already drawn from the same data are skipped unless redraw=True;
+        # grids finer than the image are block-reduced unless full_resolution=True)
+        da = self.yearly_max()
+        var_name = self.tg.name
 
         # Create a 'plots' subfolder inside the current directory
-        save_path = os.path.join(current_dir, 'plots', 'yearly_max')
+        save_path = os.path.join(os.getcwd(), 'plots', 'yearly_max')
         os.makedirs(save_path, exist_ok=True)
 
-        # loop to plot over the yearly data:
-        times = da.time.values
-        print(times)
+        # nice date labels (YYYY); one colour scale for every year
+        years = [pd.to_datetime(t).strftime("%Y") for t in da.time.values]
+        return render_series(da, "time",
+                             titles=[f"Max {var_name} for {year}" for year in years],
+                             paths=[os.path.join(save_path, f'max_{var_name}_for_{year}.png') for year in years],
+                             label=var_name, n_workers=n_workers,
+                             output=os.path.join(save_path, f'yearly_max_{var_name}.{combined}') if combined else None,
+                             redraw=redraw, coarsen="max", full_resolution=full_resolution)
+
+    def plot_yearly_min(self, n_workers=None, combined=None, redraw=False, full_resolution=False):
+        # plot the min of every year, rendered by a pool of workers
+        # (combined="gif" or "pdf" writes every frame into one animated or multi-page file;
+        # frames already drawn from the same data are skipped unless redraw=True;
+        # grids finer than the image are block-reduced unless full_resolution=True)
+        da = self.yearly_min()
         var_name = self.tg.name
 
-        for idx, t in enumerate(times):
-            single = da.isel(time=idx)
-
-            # nice date label (YYYY)
-            year_label = pd.to_datetime(t).strftime("%Y")
-
-            fig = plt.figure()
-            ax = plt.axes()
-            # single.plot()
-            mesh = ax.pcolormesh(lons, lats, single.values, shading="auto", vmin=vmin, vmax=vmax, cmap="RdYlBu_r")
-            cbar = fig.colorbar(mesh, ax=ax, orientation="vertical")
-            cbar.set_label(var_name)
-            ax.set_xlabel('Longitude')
-            ax.set_ylabel('Latitude')
-            plt.title(f"Max {var_name} for {year_label}")
-            plt.savefig(save_path + f'/max_{var_name}_for_{year_label}.png', dpi=150, bbox_inches="tight")
-            fig.tight_layout()
-            plt.close()
-            print(f'sved fig for {year_label}')
-
-    def plot_yearly_min(self):
-        
-        # calculate the yearly mean:
-        yearly_ds = self.yearly_min()
-        # da = yearly_ds[var]
-        da = yearly_ds
-        lats = yearly_ds.coords['latitude'].values
-        lons = yearly_ds.coords['longitude'].values
-
-        # 3. Compute global vmin/vmax for consistent color scaling
-        vmin = float(da.min(skipna=True).values)
-        vmax = float(da.max(skipna=True).values)
-
-        # Get the current working directory
-        current_dir = os.getcwd()
-
         # Create a 'plots' subfolder inside the current directory
-        save_path = os.path.join(current_dir, 'plots', 'yearly_min')
+        save_path = os.path.join(os.getcwd(), 'plots', 'yearly_min')
         os.makedirs(save_path, exist_ok=True)
 
-        # loop to plot over the yearly data:
-        times = da.time.values
-        print(times)
-        var_name = self.tg.name
-
-        for idx, t in enumerate(times):
-            single = da.isel(time=idx)
-
-            # nice date label (YYYY)
-            year_label = pd.to_datetime(t).strftime("%Y")
-
-            fig = plt.figure()
-            ax = plt.axes()
-            # single.plot()
-            mesh = ax.pcolormesh(lons, lats, single.values, shading="auto", vmin=vmin, vmax=vmax, cmap="RdYlBu_r")
-            cbar = fig.colorbar(mesh, ax=ax, orientation="vertical")
-            cbar.set_label(var_name)
-            ax.set_xlabel('Longitude')
-            ax.set_ylabel('Latitude')
-            plt.title(f"Min {var_name} for {year_label}")
-            plt.savefig(save_path + f'/min_{var_name}_for_{year_label}.png', dpi=150, bbox_inches="tight")
-            fig.tight_layout()
-            plt.close()
-            print(f'sved fig for {year_label}')
+        # nice date labels (YYYY); one colour scale for every year
+        years = [pd.to_datetime(t).strftime("%Y") for t in da.time.values]
+        return render_series(da, "time",
+                             titles=[f"Min {var_name} for {year}" for year in years],
+                             paths=[os.path.join(save_path, f'min_{var_name}_for_{year}.png') for year in years],
+                             label=var_name, n_workers=n_workers,
+                             output=os.path.join(save_path, f'yearly_min_{var_name}.{combined}') if combined else None,
+                             redraw=redraw, coarsen="min", full_resolution=full_resolution)
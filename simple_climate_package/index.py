@@ -0,0 +1,321 @@
+import os
+import netCDF4
+import numpy as np
+import pandas as pd
+import xarray as xr
+from simple_climate_package.stats import time_block_size
+
+###Precomputed indexes for fast queries over arbitrary time windows###
+
+
+def window_indices(times, start, end):
+    """
+    Positions ``(i0, i1)`` of the window ``time=slice(start, end)`` on a time
+    axis, with the same (inclusive, partial-date aware) rules as ``.sel``.
+    """
+    index = times if isinstance(times, pd.Index) else xr.DataArray(times, dims="time").indexes["time"]
+    window = index.slice_indexer(start, end)
+    i0, i1, _ = window.indices(len(index))
+    return i0, max(i0, i1)
+
+
+def _save(ds, path):
+    # write to a temporary name first so a reader never sees half a file
+    tmp = f"{path}.tmp"
+    ds.to_netcdf(tmp)
+    os.replace(tmp, path)
+
+
+def _prefix_blocks(da, block_size):
+    """
+    Cumulative sums (float64) and valid counts (int32) of ``da`` along time,
+    yielded as ``(i0, i1, sums, counts)`` for every block of ``block_size``
+    steps: the totals after each of time steps ``i0 .. i1 - 1``.
+    """
+    T = da.sizes["time"]
+    sum_carry = np.zeros(da.shape[1:], dtype=float)
+    count_carry = np.zeros(da.shape[1:], dtype=np.int32)
+    for i0 in range(0, T, block_size):
+        block = np.asarray(da.isel(time=slice(i0, i0 + block_size)).values, dtype=float)
+        valid = ~np.isnan(block)
+        # carry the running total from the previous block
+        sums = np.cumsum(np.where(valid, block, 0.0), axis=0) + sum_carry
+        counts = np.cumsum(valid, axis=0, dtype=np.int32) + count_carry
+        sum_carry, count_carry = sums[-1], counts[-1]
+        yield i0, i0 + block.shape[0], sums, counts
+
+
+class PrefixSumIndex:
+    """
+    Cumulative sums and valid counts along time for every grid cell.
+
+    ``sums[i]`` holds the sum of all valid values before time step ``i``,
+    so the mean over any window ``[i0, i1)`` is
+    ``(sums[i1] - sums[i0]) / (counts[i1] - counts[i0])``: two lookups and
+    a subtraction per grid cell, however long the window. Sums are
+    accumulated in float64.
+    """
+
+    def __init__(self, sums, counts, source_hash=None):
+        self.sums = sums          # xr.DataArray (time_edge, ...)
+        self.counts = counts      # xr.DataArray (time_edge, ...)
+        self.source_hash = source_hash
+        self._index = pd.DatetimeIndex(sums["time"].values[:-1])
+
+    @classmethod
+    def build(cls, da, block_size=None, memory_budget=None, source_hash=None, path=None):
+        """
+        Build the index in one blockwise pass over ``da``'s time axis.
+
+        With ``path``, every block of sums and counts is written straight to
+        that NetCDF file and the index is opened lazily from it, so memory
+        holds one block rather than the whole (time, grid) index, which is
+        larger than the data itself. Without it the index is built in memory.
+        """
+        da = da.transpose("time", ...)
+        T = da.sizes["time"]
+        shape = da.shape[1:]
+        if block_size is None:
+            block_size = time_block_size(da, memory_budget)
+
+        # one extra edge after the last day closes the final window
+        times = da["time"].values
+        step = times[-1] - times[-2] if T > 1 else np.timedelta64(1, "D")
+        dims = ("time",) + da.dims[1:]
+        coords = dict(da.isel(time=0, drop=True).coords)
+        coords["time"] = np.append(times, times[-1] + step)
+
+        if path is not None:
+            return cls._build_to_file(da, block_size, dims, coords, source_hash, path)
+
+        sums = np.zeros((T + 1,) + shape, dtype=float)
+        counts = np.zeros((T + 1,) + shape, dtype=np.int32)
+        for i0, i1, s, c in _prefix_blocks(da, block_size):
+            sums[i0 + 1:i1 + 1] = s
+            counts[i0 + 1:i1 + 1] = c
+        sums = xr.DataArray(sums, dims=dims, coords=coords, name="sums")
+        counts = xr.DataArray(counts, dims=dims, coords=coords, name="counts")
+        return cls(sums, counts, source_hash=source_hash)
+
+    @classmethod
+    def _build_to_file(cls, da, block_size, dims, coords, source_hash, path):
+        # xarray writes the coordinates with their encoding; the two large
+        # variables are then filled block by block through netCDF4
+        tmp = f"{path}.tmp"
+        xr.Dataset(coords=coords).to_netcdf(tmp)
+        with netCDF4.Dataset(tmp, "a") as nc:
+            # dimensions without a coordinate variable are not written by xarray
+            for dim, size in zip(dims, (len(coords["time"]),) + da.shape[1:]):
+                if dim not in nc.dimensions:
+                    nc.createDimension(dim, size)
+            sums = nc.createVariable("sums", "f8", dims)
+            counts = nc.createVariable("counts", "i4", dims)
+            sums[0] = 0.0
+            counts[0] = 0
+            for i0, i1, s, c in _prefix_blocks(da, block_size):
+                sums[i0 + 1:i1 + 1] = s
+                counts[i0 + 1:i1 + 1] = c
+            if source_hash is not None:
+                nc.setncattr("source_hash", source_hash)
+        os.replace(tmp, path)
+        return cls.load(path)
+
+    def save(self, path):
+        ds = xr.Dataset({"sums": self.sums, "counts": self.counts})
+        if self.source_hash is not None:
+            ds.attrs["source_hash"] = self.source_hash
+        _save(ds, path)
+
+    @classmethod
+    def load(cls, path, source_hash=None):
+        """
+        Open a saved index lazily. Returns None when it is missing or was built
+        from a different version of the source than ``source_hash``.
+        """
+        if not os.path.exists(path):
+            return None
+        ds = xr.open_dataset(path)
+        if source_hash is not None and ds.attrs.get("source_hash") != source_hash:
+            ds.close()
+            return None
+        return cls(ds["sums"], ds["counts"], source_hash=ds.attrs.get("source_hash"))
+
+    def _window_mean(self, s0, s1, c0, c1):
+        n = c1 - c0
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(n > 0, (s1 - s0) / n, np.nan)
+
+    def mean(self, start, end):
+        """Mean over ``time=slice(start, end)``, skipping NaNs like ``.mean(dim='time')``."""
+        i0, i1 = window_indices(self._index, start, end)
+        edges = [i0, i1]
+        s = self.sums.isel(time=edges).values
+        c = self.counts.isel(time=edges).values
+        out = self.sums.isel(time=0, drop=True).copy(data=self._window_mean(s[0], s[1], c[0], c[1]))
+        return out.rename("mean")
+
+    def mean_many(self, windows):
+        """
+        Means for a list of ``(start, end)`` windows in one vectorised call.
+        Returns a DataArray with a leading ``window`` dimension.
+        """
+        bounds = np.array([window_indices(self._index, start, end) for start, end in windows],
+                          dtype=np.int64).reshape(-1, 2)
+        # read every distinct edge once
+        edges, inverse = np.unique(bounds, return_inverse=True)
+        inverse = inverse.reshape(bounds.shape)
+        s = self.sums.isel(time=edges).values
+        c = self.counts.isel(time=edges).values
+        data = self._window_mean(s[inverse[:, 0]], s[inverse[:, 1]],
+                                 c[inverse[:, 0]], c[inverse[:, 1]])
+        template = self.sums.isel(time=0, drop=True)
+        return xr.DataArray(
+            data,
+            dims=("window",) + template.dims,
+            coords={**template.coords,
+                    "window_start": ("window", [str(w[0]) for w in windows]),
+                    "window_end": ("window", [str(w[1]) for w in windows])},
+            name="mean",
+        )
+
+
+def _level_sizes(n_blocks):
+    # level k has one node per aligned run of 2**k whole blocks
+    sizes = []
+    while n_blocks >> len(sizes):
+        sizes.append(n_blocks >> len(sizes))
+    return sizes
+
+
+class RangeExtremesIndex:
+    """
+    Range-minimum/maximum index over time for every grid cell.
+
+    Time is cut into blocks of ``block`` steps. Level ``k`` of the table
+    holds the min/max over each aligned run of ``2**k`` blocks (blocks
+    ``[m * 2**k, (m + 1) * 2**k)``), so any run of whole blocks is covered by
+    at most ``2 * log2(T / block)`` table entries, and only the partial
+    blocks at the ends of a window (at most ``2 * block`` steps) are read
+    from the source. Each table holds about ``2 * T / block`` grids; with
+    ``block=32`` the min and max tables together are about 1/8 of the data.
+    NaNs are skipped, matching ``.min(dim='time')``.
+    """
+
+    def __init__(self, mins, maxs, block, n_blocks, source_hash=None):
+        self.mins = mins          # xr.DataArray (node, ...), the levels one after the other
+        self.maxs = maxs
+        self.block = int(block)
+        self.offsets = np.cumsum([0] + _level_sizes(int(n_blocks)))   # first node of each level
+        self.source_hash = source_hash
+        self.data = None          # source DataArray, needed for the partial blocks
+
+    @classmethod
+    def build(cls, da, block=32, memory_budget=None, source_hash=None):
+        """Build the table in one blockwise pass over ``da``'s time axis."""
+        da = da.transpose("time", ...)
+        T = da.sizes["time"]
+        n_blocks = -(-T // block)
+        shape = da.shape[1:]
+        dtype = da.dtype if np.issubdtype(da.dtype, np.floating) else np.dtype(float)
+
+        sizes = _level_sizes(n_blocks)
+        offsets = np.cumsum([0] + sizes)
+        mins = np.full((offsets[-1],) + shape, np.nan, dtype=dtype)
+        maxs = np.full((offsets[-1],) + shape, np.nan, dtype=dtype)
+        # read many index blocks per pass through the file
+        step = max(time_block_size(da, memory_budget) // block, 1) * block
+        with np.errstate(invalid="ignore"):
+            for t0 in range(0, T, step):
+                values = da.isel(time=slice(t0, t0 + step)).values
+                for j in range(0, values.shape[0], block):
+                    b = (t0 + j) // block
+                    mins[b] = np.fmin.reduce(values[j:j + block], axis=0)
+                    maxs[b] = np.fmax.reduce(values[j:j + block], axis=0)
+
+            # node m of level k joins nodes 2m and 2m + 1 of level k - 1; fmin/fmax ignore NaN
+            for k in range(1, len(sizes)):
+                prev = slice(offsets[k - 1], offsets[k - 1] + 2 * sizes[k])
+                level = slice(offsets[k], offsets[k + 1])
+                np.fmin(mins[prev][0::2], mins[prev][1::2], out=mins[level])
+                np.fmax(maxs[prev][0::2], maxs[prev][1::2], out=maxs[level])
+
+        dims = ("node",) + da.dims[1:]
+        coords = dict(da.isel(time=0, drop=True).coords)
+        mins = xr.DataArray(mins, dims=dims, coords=coords, name="mins")
+        maxs = xr.DataArray(maxs, dims=dims, coords=coords, name="maxs")
+        index = cls(mins, maxs, block, n_blocks, source_hash=source_hash)
+        index.data = da
+        return index
+
+    def save(self, path):
+        ds = xr.Dataset({"mins": self.mins, "maxs": self.maxs})
+        ds.attrs["block"] = self.block
+        ds.attrs["n_blocks"] = int(-(-self.data.sizes["time"] // self.block))
+        if self.source_hash is not None:
+            ds.attrs["source_hash"] = self.source_hash
+        _save(ds, path)
+
+    @classmethod
+    def load(cls, path, data, source_hash=None):
+        """
+        Open a saved index for ``data``. Returns None when it is missing, was
+        built from a different version of the source than ``source_hash`` or
+        uses an older table layout.
+        """
+        if not os.path.exists(path):
+            return None
+        ds = xr.open_dataset(path)
+        if ("n_blocks" not in ds.attrs
+                or (source_hash is not None and ds.attrs.get("source_hash") != source_hash)):
+            ds.close()
+            return None
+        index = cls(ds["mins"], ds["maxs"], ds.attrs["block"], ds.attrs["n_blocks"],
+                    source_hash=ds.attrs.get("source_hash"))
+        index.data = data.transpose("time", ...)
+        return index
+
+    def _nodes(self, b0, b1):
+        # table entries covering blocks [b0, b1): the largest aligned run at each step
+        nodes = []
+        while b0 < b1:
+            k = 0
+            while b0 % 2 ** (k + 1) == 0 and b0 + 2 ** (k + 1) <= b1:
+                k += 1
+            nodes.append(self.offsets[k] + (b0 >> k))
+            b0 += 2 ** k
+        return nodes
+
+    def _query(self, start, end, how):
+        reduce = np.fmin if how == "min" else np.fmax
+        table = self.mins if how == "min" else self.maxs
+        i0, i1 = window_indices(self.data.indexes["time"], start, end)
+        B = self.block
+
+        # whole blocks strictly inside the window
+        b0 = -(-i0 // B)
+        b1 = i1 // B
+        parts = []
+        if b1 > b0:
+            parts.extend(table.isel(node=self._nodes(b0, b1)).values)
+            edges = [(i0, b0 * B), (b1 * B, i1)]
+        else:
+            edges = [(i0, i1)]
+        # partial blocks at the ends come straight from the data
+        for e0, e1 in edges:
+            if e1 > e0:
+                parts.append(reduce.reduce(self.data.isel(time=slice(e0, e1)).values, axis=0))
+
+        template = self.data.isel(time=0, drop=True)
+        if not parts:
+            return template.copy(data=np.full(template.shape, np.nan, dtype=table.dtype)).rename(how)
+        with np.errstate(invalid="ignore"):
+            result = reduce.reduce(np.stack(parts), axis=0)
+        return template.copy(data=result.astype(table.dtype)).rename(how)
+
+    def min(self, start, end):
+        """Minimum over ``time=slice(start, end)``."""
+        return self._query(start, end, "min")
+
+    def max(self, start, end):
+        """Maximum over ``time=slice(start, end)``."""
+        return self._query(start, end, "max")
@@ -2,9 +2,359 @@ from functools import wraps
 import os
 import matplotlib.pyplot as plt
 import numpy as np
+import pandas as pd
 import xarray as xr
+from scipy.linalg import solve_triangular
 from scipy.stats import t
-from simple_climate_package.loader import DataReader
+from simple_climate_package._parallel import map_columns
+from simple_climate_package.aggregate import aggregate
+from simple_climate_package.loader import DataReader, default_memory_budget, parse_memory
+from simple_climate_package.plotting import (
+    PlotCache, axes_pixels, block_reduce, coarsen_coords, display_factors, plot_key)
+
+
+# float64 (T, block) temporaries alive at once while a block of grid columns is reduced
+_TEMPORARIES_PER_BLOCK = 6
+
+
+def regression_moments(x, Y):
+    """
+    Sufficient statistics of a simple regression of every column of ``Y``
+    on ``x``, skipping NaNs in ``Y``.
+
+    Parameters
+    ----------
+    x : np.ndarray, shape (T,)
+    Y : np.ndarray, shape (T, N)
+
+    Returns
+    -------
+    n, x_mean, y_mean, Sxx, Sxy, Syy : np.ndarray, shape (N,)
+        Valid count, means and centred sums of squares and cross products.
+    """
+    valid = ~np.isnan(Y)
+    n = valid.sum(axis=0).astype(float)
+    Yf = np.where(valid, Y, 0.0)
+    X = np.where(valid, x.reshape(-1, 1), 0.0)
+    x_mean = np.where(n > 0, X.sum(axis=0) / n, np.nan)
+    y_mean = np.where(n > 0, Yf.sum(axis=0) / n, np.nan)
+
+    # centre on the per-column means (over valid times only) for accuracy
+    Xc = np.where(valid, X - x_mean, 0.0)
+    Yc = np.where(valid, Yf - y_mean, 0.0)
+    return n, x_mean, y_mean, (Xc * Xc).sum(axis=0), (Xc * Yc).sum(axis=0), (Yc * Yc).sum(axis=0)
+
+
+def ols_from_moments(n, x_mean, y_mean, Sxx, Sxy, Syy, min_obs=3):
+    """
+    Slope, intercept, t-statistic, p-value, R squared and RMSE from the
+    sufficient statistics of ``regression_moments``, without forming fitted
+    values or residuals: SSR = Syy - Sxy**2 / Sxx.
+
+    Pixels with fewer than ``min_obs`` values or no spread in x are NaN.
+    """
+    with np.errstate(invalid="ignore", divide="ignore"):
+        ok = (n >= min_obs) & (Sxx != 0)
+        slope = np.where(ok, Sxy / Sxx, np.nan)
+        intercept = y_mean - slope * x_mean
+
+        # residual sum of squares; clip tiny negative values from rounding
+        SSR = np.where(ok, np.maximum(Syy - slope * Sxy, 0.0), np.nan)
+        df = n - 2.0  # Degrees of freedom
+        se_slope = np.sqrt(SSR / df / Sxx)
+        t_stat = slope / se_slope
+        p_value = 2.0 * t.sf(np.abs(t_stat), df)
+        r2 = 1.0 - SSR / Syy
+        rmse = np.sqrt(SSR / n)
+    return {"slope": slope, "intercept": intercept, "t_stat": t_stat,
+            "p_value": p_value, "r2": r2, "rmse": rmse}
+
+
+def regress_annual(annual, lat, lon, min_obs=3, block_size=None, max_memory=None):
+    """
+    Linear regression on calendar year for every grid point of an annual
+    (time, lat, lon) DataArray. Shared by LinReg and by saved statistics
+    states (see simple_climate_package.state).
+
+    Grid columns are processed ``block_size`` at a time (chosen from
+    ``max_memory``, e.g. "512MB", when not given), and every block is reduced
+    to its sufficient statistics (n, means, Sxx, Sxy, Syy), so peak memory
+    is a few (time, block) arrays rather than many full (time, grid) ones.
+
+    Returns an xr.Dataset with slope, intercept, t_stat, p_value, r2, rmse,
+    n_obs, per_decade and total_change on the (lat, lon) grid.
+    """
+    da = annual.transpose("time", lat, lon)
+    years = da["time"].dt.year.values.astype(float)
+    T, ny, nx = da.shape
+
+    # (time, grid) view; for lazily loaded data each block reads whole rows
+    out = regress_columns(years, da.data.reshape(T, ny * nx), min_obs, block_size, max_memory)
+    return xr.Dataset(
+        {k: ((lat, lon), v.reshape(ny, nx)) for k, v in out.items()},
+        coords={lat: da.coords[lat].values, lon: da.coords[lon].values},
+    )
+
+
+def column_block_size(n_rows, block_size=None, max_memory=None):
+    """
+    Columns per block so the (rows, block) temporaries of a fit fit in
+    ``max_memory``. Without ``max_memory`` the cap is half of the available
+    RAM (see ``default_memory_budget``).
+    """
+    if block_size is not None:
+        return block_size
+    budget = parse_memory(max_memory) if max_memory is not None else default_memory_budget()
+    return max(budget // (_TEMPORARIES_PER_BLOCK * 8 * max(n_rows, 1)), 1)
+
+
+def regress_columns(x, Y, min_obs=3, block_size=None, max_memory=None):
+    """
+    Regression of every column of ``Y`` (time, N) on ``x``, a block of
+    columns at a time, reduced to sufficient statistics (see
+    ``regression_moments`` and ``ols_from_moments``).
+
+    Returns
+    -------
+    dict of np.ndarray, shape (N,)
+        slope, intercept, t_stat, p_value, r2, rmse, n_obs, per_decade and
+        total_change (slope times the span of ``x``).
+    """
+    T, N = Y.shape
+    block_size = column_block_size(T, block_size, max_memory)
+    names = ("slope", "intercept", "t_stat", "p_value", "r2", "rmse", "n_obs")
+    out = {k: np.full(N, np.nan, dtype=float) for k in names}
+    for c0 in range(0, N, block_size):
+        c1 = min(c0 + block_size, N)
+        block = np.asarray(Y[:, c0:c1], dtype=float)
+        n, x_mean, y_mean, Sxx, Sxy, Syy = regression_moments(x, block)
+        fit = ols_from_moments(n, x_mean, y_mean, Sxx, Sxy, Syy, min_obs=min_obs)
+        for k, v in fit.items():
+            out[k][c0:c1] = v
+        out["n_obs"][c0:c1] = n
+
+    # Compute slope per decade and over whole dataset
+    out["per_decade"] = out["slope"] * 10.0
+    out["total_change"] = out["slope"] * (x[-1] - x[0])
+    return out
+
+
+def running_regression(x, Y, window, min_obs=3):
+    """
+    Regressions of every column of ``Y`` (time, N) on ``x`` over every
+    window of ``window`` consecutive rows.
+
+    Cumulative sums of n, x, y, xx, xy and yy along time are built once, so
+    each window's sums are a difference of two rows and the whole set of
+    windows costs O(T) rather than O(T * window). Values are shifted by the
+    first x and the column mean before summing to limit cancellation.
+
+    Returns
+    -------
+    dict of np.ndarray, shape (T - window + 1, N)
+        As ``ols_from_moments``, plus n_obs.
+    """
+    valid = ~np.isnan(Y)
+    x_ref = x[0]
+    with np.errstate(invalid="ignore"):
+        y_ref = np.where(valid.any(axis=0), np.nanmean(np.where(valid, Y, np.nan), axis=0), 0.0)
+    xs = np.where(valid, (x - x_ref).reshape(-1, 1), 0.0)
+    ys = np.where(valid, Y - y_ref, 0.0)
+
+    def window_sums(a):
+        c = np.zeros((a.shape[0] + 1,) + a.shape[1:])
+        np.cumsum(a, axis=0, out=c[1:])
+        return c[window:] - c[:-window]
+
+    n = window_sums(valid.astype(float))
+    sx, sy = window_sums(xs), window_sums(ys)
+    sxx, sxy, syy = window_sums(xs * xs), window_sums(xs * ys), window_sums(ys * ys)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        x_mean, y_mean = sx / n, sy / n
+        Sxx = sxx - sx * x_mean
+        Sxy = sxy - sx * y_mean
+        Syy = syy - sy * y_mean
+    fit = ols_from_moments(n, x_mean + x_ref, y_mean + y_ref, Sxx, Sxy, Syy, min_obs=min_obs)
+    fit["n_obs"] = n
+    return fit
+
+
+def resample_indices(T, n_resamples, method="permutation", block_length=None, seed=None):
+    """
+    Index matrix (n_resamples, T) of resampled time orders.
+
+    ``method="permutation"`` shuffles the years; ``"block_bootstrap"`` joins
+    randomly placed circular blocks of ``block_length`` consecutive years
+    (about T**(1/3) by default), keeping short-range autocorrelation.
+    """
+    rng = np.random.default_rng(seed)
+    if method == "permutation":
+        return rng.permuted(np.tile(np.arange(T), (n_resamples, 1)), axis=1)
+    if method == "block_bootstrap":
+        L = block_length if block_length is not None else max(int(round(T ** (1 / 3))), 1)
+        starts = rng.integers(0, T, size=(n_resamples, -(-T // L)))
+        return ((starts[:, :, None] + np.arange(L)) % T).reshape(n_resamples, -1)[:, :T]
+    raise ValueError(f"method must be 'permutation' or 'block_bootstrap', not {method!r}")
+
+
+def resample_weights(idx, x):
+    """
+    Weight matrices C, M, M2 (n_resamples, T) of an index matrix: how often
+    each year is drawn, and the sums of x and x**2 at the positions it is
+    drawn to. Every resampled sum is then a matrix product with the data,
+    e.g. sum_t x_t * y[idx[r, t]] = (M @ y)[r].
+    """
+    R, T = idx.shape
+    rows = np.repeat(np.arange(R), T)
+    xs = np.tile(x, R)
+    C = np.zeros((R, T))
+    M = np.zeros((R, T))
+    M2 = np.zeros((R, T))
+    np.add.at(C, (rows, idx.ravel()), 1.0)
+    np.add.at(M, (rows, idx.ravel()), xs)
+    np.add.at(M2, (rows, idx.ravel()), xs * xs)
+    return C, M, M2
+
+
+def _resampled_tile(Y, x, C, M, M2, alpha, min_obs):
+    # observed and resampled t statistics of a tile of grid columns
+    valid = ~np.isnan(Y)
+    V = valid.astype(float)
+    Yf = np.where(valid, Y - np.nanmean(np.where(valid, Y, np.nan), axis=0), 0.0)
+    fit = ols_from_moments(*regression_moments(x, Y), min_obs=min_obs)
+
+    n = C @ V
+    sx, sxx = M @ V, M2 @ V
+    sy, syy, sxy = C @ Yf, C @ (Yf * Yf), M @ Yf
+    with np.errstate(invalid="ignore", divide="ignore"):
+        x_mean, y_mean = sx / n, sy / n
+        null = ols_from_moments(n, x_mean, y_mean, sxx - sx * x_mean, sxy - sx * y_mean,
+                                syy - sy * y_mean, min_obs=min_obs)
+    t_obs = np.abs(fit["t_stat"])
+    t_null = np.abs(null["t_stat"])
+    ok = ~np.isnan(t_null)
+    exceed = ((t_null >= t_obs) & ok).sum(axis=0)
+    # locally significant pixels in every resampled field
+    local = (null["p_value"] < alpha).sum(axis=1)
+    return {"exceed": exceed, "n_valid": ok.sum(axis=0), "local": local,
+            "p_value": fit["p_value"]}
+
+
+def bh_fdr(p_values, alpha=0.05):
+    """Benjamini-Hochberg mask: True where a p-value is significant at false discovery rate ``alpha``."""
+    p = np.asarray(p_values, dtype=float)
+    finite = ~np.isnan(p)
+    ranked = np.sort(p[finite])
+    m = ranked.size
+    passed = np.flatnonzero(ranked <= alpha * np.arange(1, m + 1) / max(m, 1))
+    mask = np.zeros(p.shape, dtype=bool)
+    if passed.size:
+        mask[finite] = p[finite] <= ranked[passed[-1]]
+    return mask
+
+
+def predictor_frame(predictors, years):
+    """
+    Put predictors on the years of the annual data.
+
+    ``predictors`` is a pandas DataFrame or Series, an xarray DataArray
+    (``time`` or ``(time, predictor)``) or Dataset, or a dict of name to
+    Series or array. Indexes may be integer years or dates; dated values
+    are averaged per calendar year. Plain arrays must have one value per
+    year of the annual data. Years without a value are NaN.
+    """
+    if isinstance(predictors, xr.Dataset):
+        predictors = predictors.to_dataframe()
+    elif isinstance(predictors, xr.DataArray):
+        if predictors.ndim == 1:
+            predictors = predictors.to_series().rename(predictors.name or "x")
+        else:
+            predictors = predictors.transpose("time", ...).to_pandas()
+    if isinstance(predictors, pd.Series):
+        predictors = predictors.to_frame(predictors.name if predictors.name is not None else "x")
+    if isinstance(predictors, dict):
+        columns = {}
+        for name, values in predictors.items():
+            if not isinstance(values, pd.Series):
+                values = pd.Series(np.asarray(values, dtype=float), index=years)
+            columns[name] = _by_year(values)
+        frame = pd.DataFrame(columns)
+    else:
+        frame = _by_year(predictors)
+    return frame.reindex(years).astype(float)
+
+
+def _by_year(obj):
+    index = obj.index
+    if isinstance(index, pd.DatetimeIndex):
+        return obj.groupby(index.year).mean()
+    return obj.set_axis(index.astype(int))
+
+
+def regress_multi(Y, X, min_obs=None):
+    """
+    Ordinary least squares of every column of ``Y`` (time, N) on the
+    columns of ``X`` (time, p), skipping NaNs in either.
+
+    Columns with the same pattern of missing values share one design
+    matrix, so the patterns are found once (``np.unique`` over the packed
+    masks) and each gets a single QR factorisation, reused for all of its
+    columns. Fits that are rank deficient or have fewer than ``min_obs``
+    (default p + 1) values are NaN.
+
+    Returns
+    -------
+    dict of np.ndarray
+        coef, std_err, t_stat, p_value with shape (p, N); r2 and n_obs with
+        shape (N,). R squared is centred when ``X`` has a constant column.
+    """
+    T, p = X.shape
+    N = Y.shape[1]
+    if min_obs is None:
+        min_obs = p + 1
+    valid = ~np.isnan(Y) & ~np.isnan(X).any(axis=1, keepdims=True)
+    n_obs = valid.sum(axis=0).astype(float)
+    centred = bool(np.any(np.all(X == X[0], axis=0)))
+
+    out = {k: np.full((p, N), np.nan) for k in ("coef", "std_err", "t_stat", "p_value")}
+    out["r2"] = np.full(N, np.nan)
+    out["n_obs"] = n_obs
+
+    # one group of grid columns per distinct missing-data pattern
+    packed = np.packbits(valid, axis=0).T
+    patterns, inverse = np.unique(packed, axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    for g in range(len(patterns)):
+        cols = np.flatnonzero(inverse == g)
+        rows = valid[:, cols[0]]
+        n = int(rows.sum())
+        df = n - p
+        if n < min_obs or df < 1:
+            continue
+        Q, R = np.linalg.qr(X[rows])
+        diag = np.abs(np.diag(R))
+        if diag.min() <= diag.max() * max(n, p) * np.finfo(float).eps:
+            continue
+
+        y = Y[rows][:, cols]
+        beta = solve_triangular(R, Q.T @ y)
+        resid = y - X[rows] @ beta
+        ssr = (resid ** 2).sum(axis=0)
+        sst = ((y - y.mean(axis=0)) ** 2).sum(axis=0) if centred else (y ** 2).sum(axis=0)
+
+        # diagonal of (X'X)^-1 from R^-1
+        r_inv = solve_triangular(R, np.eye(p))
+        xtx_diag = (r_inv ** 2).sum(axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            se = np.sqrt(np.outer(xtx_diag, ssr / df))
+            t_stat = beta / se
+            out["r2"][cols] = 1.0 - ssr / sst
+        out["coef"][:, cols] = beta
+        out["std_err"][:, cols] = se
+        out["t_stat"][:, cols] = t_stat
+        out["p_value"][:, cols] = 2.0 * t.sf(np.abs(t_stat), df)
+    return out
+
 
 ###Writing linear regression calculation and plotting class###
 
@@ -16,12 +366,18 @@ class LinReg:
     """
 
     # reading in data function
-    def __init__(self, file_path, varname=None):
+    def __init__(self, file_path, varname=None, chunks=None, memory_budget=None,
+                 lat_range=None, lon_range=None, time_range=None):
                 
-        dr = DataReader(file_path)
-        ds = dr.read()
-
-        self.ds = xr.open_dataset(file_path)
+        # the reader shares one opened dataset between every analysis class on this file
+        # and only reads the requested lat/lon box and time window from it
+        # chunks="auto" opens the file lazily with dask, planned for per-pixel regression
+        self.reader = DataReader(file_path, chunks=chunks, memory_budget=memory_budget,
+                                 operation="regression", varname=varname,
+                                 lat_range=lat_range, lon_range=lon_range, time_range=time_range)
+        ds = self.reader.read()
+
+        self.ds = ds
         if varname is None:
             varname = list(self.ds.data_vars)[0]
         # Takes the first variable in the 3D array
@@ -37,13 +393,25 @@ class LinReg:
         self.lat = "lat" if "lat" in self.da.coords else "latitude"
         self.lon = "lon" if "lon" in self.da.coords else "longitude"
         self.results = {}
+        self.results_by_period = None
+        self.significance = None
         self.annual = None
 
     # resampling daily data to years
-    def make_yearly(self, how="mean"):
-        self.annual = self.da.resample(time="1YS").reduce(getattr(np, how))
+    def make_yearly(self, how="mean", min_fraction=None):
+        """
+        Aggregate daily data to years labelled by 1 January. ``how`` is one of
+        "mean", "sum", "min" or "max" and skips NaNs. Years whose valid days
+        cover less than ``min_fraction`` of the year are set to NaN.
+        """
+        self.annual = aggregate(self.da, "year", how, label="start", min_fraction=min_fraction,
+                                memory_budget=self.reader.memory_budget)
         return self.annual
 
+    def _max_memory(self, max_memory):
+        # cap the fits by the reader's budget unless a method is given its own
+        return self.reader.memory_budget if max_memory is None else max_memory
+
     def ignore_numpy_warnings(func):
         """
         Runs function inside np.errstat(invalid='ignore', divide='ignore)
@@ -57,7 +425,7 @@ class LinReg:
         return wrapper
 
     @ignore_numpy_warnings
-    def grid_linear_regression(self, min_obs=3):
+    def grid_linear_regression(self, min_obs=3, block_size=None, max_memory=None):
         """
         Function computes a linear regression for each grid point in
         dataset's longitude-latitude grid.
@@ -70,138 +438,279 @@ class LinReg:
         - R squared (r2)
         - Root mean squared error (rmse)
         - intercept (intercept)
+        Grid points are processed in blocks of ``block_size`` columns, or as
+        many as fit in ``max_memory`` (e.g. "512MB"), to bound peak memory.
+        ``max_memory`` defaults to the ``memory_budget`` given to LinReg.
         """
 
         if self.annual is None:
             self.make_yearly()
 
-        da = self.annual.transpose("time", self.lat, self.lon)
-        y = da.values[:, :, :]  # 3D array with time, lat, lon
-
-        years = da["time"].dt.year.values.astype(float)
+        self.results = regress_annual(self.annual, self.lat, self.lon, min_obs=min_obs,
+                                      block_size=block_size, max_memory=self._max_memory(max_memory))
+        return self.results
 
-        # Validate data array shapes:
-        if y.ndim != 3:
-            raise ValueError("y must be 3D with shape (time ny, nx)")
-        T, ny, nx = y.shape
-        if len(years) != T:
-            raise ValueError(
-                "Length of x must equal y shape[0] (time dimension)"
-            )
+    @ignore_numpy_warnings
+    def grid_linear_regression_by_period(self, groups="season", how="mean", min_fraction=None,
+                                         min_obs=3, block_size=None, max_memory=None):
+        """
+        Linear regression on calendar year for every season (DJF, MAM, JJA,
+        SON) or every calendar month, for each grid point.
+
+        The daily data is aggregated to seasons or months in one pass (see
+        ``simple_climate_package.aggregate``) and arranged as a
+        (period, year, lat, lon) array, and the regressions of all periods
+        are solved together as one stacked computation. DJF belongs to the
+        year of its January and February. ``how`` and ``min_fraction`` are
+        as in ``make_yearly``.
+
+        Returns
+        -------
+        xr.Dataset
+            The variables of ``grid_linear_regression`` on
+            (season | month, lat, lon).
+        """
+        if groups not in ("season", "month"):
+            raise ValueError(f"groups must be 'season' or 'month', not {groups!r}")
+        agg = aggregate(self.da, groups, how, label="start", min_fraction=min_fraction,
+                        memory_budget=self.reader.memory_budget)
+        agg = agg.transpose("time", self.lat, self.lon)
+
+        starts = agg["time"].values.astype("datetime64[M]")
+        month = starts.astype(np.int64) % 12  # 0 = January
+        if groups == "season":
+            names = np.array(["DJF", "MAM", "JJA", "SON"])
+            period = (month + 1) % 12 // 3
+            year = (starts + 1).astype("datetime64[Y]").astype(np.int64) + 1970
+        else:
+            names = np.arange(1, 13)
+            period = month
+            year = starts.astype("datetime64[Y]").astype(np.int64) + 1970
+
+        # (year, period, grid) with NaN where a period has no aggregate
+        years = np.unique(year)
+        T, ny, nx = agg.shape
+        cube = np.full((len(years), len(names), ny * nx), np.nan)
+        cube[np.searchsorted(years, year), period] = agg.values.reshape(T, ny * nx)
+
+        present = np.unique(period)
+        cube = cube[:, present].reshape(len(years), -1)
+        out = regress_columns(years.astype(float), cube, min_obs, block_size, self._max_memory(max_memory))
+        dims = (groups, self.lat, self.lon)
+        self.results_by_period = xr.Dataset(
+            {k: (dims, v.reshape(len(present), ny, nx)) for k, v in out.items()},
+            coords={groups: names[present], self.lat: agg.coords[self.lat].values,
+                    self.lon: agg.coords[self.lon].values},
+        )
+        return self.results_by_period
 
-        # Create lon-lat grid
-        N_grid = ny * nx
+    @ignore_numpy_warnings
+    def running_trend(self, window=30, min_obs=3, block_size=None, max_memory=None):
+        """
+        Linear trends over every window of ``window`` consecutive years, for
+        each grid point, e.g. all 30-year trends starting from 1950 onward.
+
+        Missing years are kept as gaps, so every window spans exactly
+        ``window`` calendar years. All windows come from one set of
+        cumulative sums along the yearly axis (see ``running_regression``).
+
+        Returns
+        -------
+        xr.Dataset
+            slope, intercept, t_stat, p_value, r2, rmse, n_obs and per_decade
+            on (window_start, lat, lon), where ``window_start`` is the first
+            year of each window.
+        """
+        if self.annual is None:
+            self.make_yearly()
 
-        # Reshape 3D y to 2D array (T, N_grid)
-        Y = y.reshape(T, N_grid)
-
-        # Reshape X so broadcasting occurs across the array correctly
-        X = years.reshape(T, 1)
-        X_mat = np.broadcast_to(X, (T, N_grid))
-
-        # Validate obs using mask and counts to mask NaNs
-        valid = ~np.isnan(Y)
-        n_obs = valid.sum(axis=0).astype(float)
-
-        # Fill invalid regions with zero for sums
-        Yf = np.where(valid, Y, 0.0)
-
-        # Calculate sums
-        X_sum = (X_mat * valid).sum(axis=0)
-        Y_sum = Yf.sum(axis=0)
-
-        # Calculate means
-        X_mean = np.where(n_obs > 0, X_sum / n_obs, np.nan)
-        Y_mean = np.where(n_obs > 0, Y_sum / n_obs, np.nan)
-
-        # Center data array shapes
-        Xc = (X_mat - X_mean.reshape(1, N_grid)) * valid
-        Yc = (Yf - Y_mean.reshape(1, N_grid)) * valid
-
-        # Sxx and Sxy
-        Sxx = np.sum(Xc * Xc, axis=0)
-        Sxy = np.sum(Xc * Yc, axis=0)
-
-        # Minimum data maks so variables are only c
-        # computed where valid results are present
-        ok_pix = (n_obs >= min_obs) & (Sxx != 0)
-
-        # Create empty output files
-        slope, intercept, t_stat, p_value, r2, rmse = [
-            np.full(N_grid, np.nan, dtype=float) for i in range(6)
-        ]
-
-        # Compute slope and intercept
-        slope_ok = Sxy[ok_pix] / Sxx[ok_pix]
-        slope[ok_pix] = slope_ok
-        intercept[ok_pix] = Y_mean[ok_pix] - slope_ok * X_mean[ok_pix]
-
-        # Compute slope per decade and over whole dataset
-        total_change = slope * (years[-1] - years[0])
-        per_decade = slope * 10.0
-
-        # Comparing model_predicted values and residuals
-        # Measures how well the linear regression fits each lon-lat
-        # grid point
-        Yhat = np.zeros_like(Yf)
-        if np.any(ok_pix):
-            idx_ok = np.where(ok_pix)[0]  # compute for ok grid points
-            # broadcast to 2D array shape
-            Yhat[:, idx_ok] = (slope[idx_ok].reshape(1, -1) * X) + intercept[
-                idx_ok
-            ].reshape(1, -1)
-            Yhat = np.where(valid, Yhat, 0.0)  # mask out invalid times
-        # Calculating residuals
-        resid = Yf - Yhat
-        SSR = np.sum(resid * resid, axis=0)  # Sum of squared residuals
-
-        # Calculating mean squared error
-        df = n_obs - 2.0  # Degrees of freedom
-        mse = SSR / df
-        se_slope = np.sqrt(mse / Sxx)
-
-        # Calcuating t-statistics and p-values
-        t_stat = slope / se_slope
-        p_value = 2.0 * t.sf(np.abs(t_stat), df)
+        da = self.annual.transpose("time", self.lat, self.lon)
+        years = da["time"].dt.year.values
+        all_years = np.arange(years[0], years[-1] + 1)
+        if window > len(all_years):
+            raise ValueError(f"window of {window} years is longer than the record ({len(all_years)} years)")
+
+        # one row per calendar year, NaN where a year is missing
+        T, ny, nx = len(all_years), da.shape[1], da.shape[2]
+        Y = np.full((T, ny * nx), np.nan)
+        Y[years - years[0]] = np.asarray(da.values, dtype=float).reshape(len(years), ny * nx)
+
+        n_windows = T - window + 1
+        # the six cumulative sums of running_regression plus their window
+        # differences and the fit temporaries are alive at once
+        block_size = column_block_size(6 * (T + 1), block_size, self._max_memory(max_memory))
+        names = ("slope", "intercept", "t_stat", "p_value", "r2", "rmse", "n_obs")
+        out = {k: np.full((n_windows, ny * nx), np.nan) for k in names}
+        for c0 in range(0, ny * nx, block_size):
+            c1 = min(c0 + block_size, ny * nx)
+            fit = running_regression(all_years.astype(float), Y[:, c0:c1], window, min_obs)
+            for k in names:
+                out[k][:, c0:c1] = fit[k]
+        out["per_decade"] = out["slope"] * 10.0
+
+        dims = ("window_start", self.lat, self.lon)
+        return xr.Dataset(
+            {k: (dims, v.reshape(n_windows, ny, nx)) for k, v in out.items()},
+            coords={"window_start": all_years[:n_windows], self.lat: da.coords[self.lat].values,
+                    self.lon: da.coords[self.lon].values},
+            attrs={"window": window},
+        )
 
-        # Calculating R squared and RMSE
-        SST = np.sum(((Yf - Y_mean.reshape(1, N_grid)) * valid) ** 2, axis=0)
-        r2 = 1.0 - SSR / SST
-        rmse = np.sqrt(SSR / n_obs)
+    def field_significance(self, method="permutation", n_resamples=1000, block_length=None,
+                           alpha=0.05, seed=None, n_workers=1, min_obs=3, block_size=None,
+                           max_memory=None):
+        """
+        Resampling significance of the yearly trends, per pixel and for the
+        field as a whole.
+
+        The years are reordered ``n_resamples`` times, by permutation or by
+        a circular block bootstrap (``block_length`` years per block), with
+        the same orders used at every pixel so spatial correlation is kept.
+        The resamples are held as index matrices and turned into weight
+        matrices, so all resampled regressions of a block of pixels are a
+        few matrix products (see ``resample_weights``). Blocks of pixels are
+        spread over ``n_workers`` processes; ``seed`` makes the result
+        reproducible whatever the number of workers.
+
+        Returns
+        -------
+        xr.Dataset
+            ``p_value`` (from the resampled distribution of |t|) and
+            ``fdr_mask`` (Benjamini-Hochberg at ``alpha``) on (lat, lon).
+            Attributes hold the ``field_p_value`` (how often a resampled
+            field has at least as many pixels with t-test p < ``alpha`` as
+            the data) and ``n_significant``.
+        """
+        if self.annual is None:
+            self.make_yearly()
 
-        lat_vals = da.coords[self.lat].values
-        lon_vals = da.coords[self.lon].values
+        da = self.annual.transpose("time", self.lat, self.lon)
+        x = da["time"].dt.year.values.astype(float)
+        T, ny, nx = da.shape
+        Y = np.ascontiguousarray(np.asarray(da.values, dtype=float).reshape(T, ny * nx))
+
+        idx = resample_indices(T, n_resamples, method, block_length, seed)
+        C, M, M2 = resample_weights(idx, x)
+        block_size = column_block_size(max(T, n_resamples), block_size, self._max_memory(max_memory))
+
+        exceed = np.zeros(ny * nx)
+        n_valid = np.zeros(ny * nx)
+        p_obs = np.full(ny * nx, np.nan)
+        local = np.zeros(n_resamples, dtype=np.int64)
+        for c0, c1, tile in map_columns(_resampled_tile, Y, block_size, n_workers, x=x, C=C,
+                                        M=M, M2=M2, alpha=alpha, min_obs=min_obs):
+            exceed[c0:c1] = tile["exceed"]
+            n_valid[c0:c1] = tile["n_valid"]
+            p_obs[c0:c1] = tile["p_value"]
+            local += tile["local"]
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            p_value = np.where(np.isnan(p_obs), np.nan, (1.0 + exceed) / (1.0 + n_valid))
+        n_significant = int((p_obs < alpha).sum())
+        field_p = (1.0 + (local >= n_significant).sum()) / (1.0 + n_resamples)
+
+        self.significance = xr.Dataset(
+            {
+                "p_value": ((self.lat, self.lon), p_value.reshape(ny, nx)),
+                "fdr_mask": ((self.lat, self.lon), bh_fdr(p_value, alpha).reshape(ny, nx)),
+            },
+            coords={self.lat: da.coords[self.lat].values, self.lon: da.coords[self.lon].values},
+            attrs={"method": method, "n_resamples": n_resamples, "alpha": alpha,
+                   "field_p_value": float(field_p), "n_significant": n_significant},
+        )
+        return self.significance
 
-        # reshape to (ny,nx)
-        def to_grid(a):
-            return a.reshape(ny, nx)
+    def grid_multi_regression(self, predictors, add_intercept=True, min_obs=None,
+                              block_size=None, max_memory=None):
+        """
+        Regress the yearly data of every grid point on several predictors at
+        once, e.g. NAO, ENSO and CO2 forcing indices.
+
+        Parameters
+        ----------
+        predictors : DataFrame, Series, DataArray, Dataset or dict
+            One column per predictor, indexed by year or by date (dated
+            values are averaged per year), see ``predictor_frame``. Years
+            with a missing predictor are left out of every fit.
+        add_intercept : bool
+            Add a constant column named ``intercept``.
+        min_obs : int, optional
+            Minimum number of years per fit, by default one more than the
+            number of coefficients.
+
+        Returns
+        -------
+        xr.Dataset
+            ``coef``, ``std_err``, ``t_stat`` and ``p_value`` on
+            (predictor, lat, lon), plus ``r2`` and ``n_obs`` on (lat, lon).
+        """
+        if self.annual is None:
+            self.make_yearly()
 
-        ds_out = xr.Dataset(
+        da = self.annual.transpose("time", self.lat, self.lon)
+        years = da["time"].dt.year.values
+        frame = predictor_frame(predictors, years)
+        names = [str(c) for c in frame.columns]
+        X = frame.to_numpy()
+        if add_intercept:
+            X = np.column_stack([np.ones(len(years)), X])
+            names = ["intercept"] + names
+
+        T, ny, nx = da.shape
+        N_grid = ny * nx
+        p = X.shape[1]
+        block_size = column_block_size(max(T, p), block_size, self._max_memory(max_memory))
+
+        Y = da.data.reshape(T, N_grid)
+        out = {k: np.full((p, N_grid), np.nan) for k in ("coef", "std_err", "t_stat", "p_value")}
+        out.update(r2=np.full(N_grid, np.nan), n_obs=np.zeros(N_grid))
+        for c0 in range(0, N_grid, block_size):
+            c1 = min(c0 + block_size, N_grid)
+            fit = regress_multi(np.asarray(Y[:, c0:c1], dtype=float), X, min_obs=min_obs)
+            for k, v in fit.items():
+                out[k][..., c0:c1] = v
+
+        coords = {"predictor": names, self.lat: da.coords[self.lat].values,
+                  self.lon: da.coords[self.lon].values}
+        per_predictor = ("predictor", self.lat, self.lon)
+        return xr.Dataset(
             {
-                "slope": ((self.lat, self.lon), to_grid(slope)),
-                "intercept": ((self.lat, self.lon), to_grid(intercept)),
-                "t_stat": ((self.lat, self.lon), to_grid(t_stat)),
-                "p_value": ((self.lat, self.lon), to_grid(p_value)),
-                "r2": ((self.lat, self.lon), to_grid(r2)),
-                "rmse": ((self.lat, self.lon), to_grid(rmse)),
-                "n_obs": ((self.lat, self.lon), to_grid(n_obs)),
-                "per_decade": ((self.lat, self.lon), to_grid(per_decade)),
-                "total_change": ((self.lat, self.lon), to_grid(total_change)),
+                **{k: (per_predictor, out[k].reshape(p, ny, nx))
+                   for k in ("coef", "std_err", "t_stat", "p_value")},
+                "r2": ((self.lat, self.lon), out["r2"].reshape(ny, nx)),
+                "n_obs": ((self.lat, self.lon), out["n_obs"].reshape(ny, nx)),
             },
-            coords={self.lat: lat_vals, self.lon: lon_vals},
+            coords=coords,
         )
 
-        self.results = ds_out
-        return self.results
-
-    def quick_plot_signif_stippling(self, key="per_decade"):
-        
-        self.annual = self.make_yearly()
-        self.results = self.grid_linear_regression()
+    def quick_plot_signif_stippling(self, key="per_decade", stipple="p_value", redraw=False,
+                                    full_resolution=False, results=None, **significance_kwargs):
+        """
+        Plot ``key`` with stippling where the trend is significant: where the
+        t-test p-value is below 0.05 (``stipple="p_value"``), or where the
+        Benjamini-Hochberg mask of ``field_significance`` is set
+        (``stipple="fdr"``, computed with ``significance_kwargs`` if needed).
+        The figure is not drawn again when the file already shows the same
+        data (see ``plotting.PlotCache``) unless ``redraw=True``. Grids with
+        more cells than the figure has pixels are block-averaged to display
+        resolution unless ``full_resolution=True``. ``results`` plots a
+        Dataset returned by ``grid_linear_regression`` instead of the last
+        one stored on this object.
+        """
+        if stipple not in ("p_value", "fdr"):
+            raise ValueError(f"stipple must be 'p_value' or 'fdr', not {stipple!r}")
+
+        # plot the given or current results, computing them first if needed
+        if results is None:
+            if not self.results:
+                self.grid_linear_regression()
+            results = self.results
+        if stipple == "fdr" and (self.significance is None or significance_kwargs):
+            self.field_significance(**significance_kwargs)
         
         # read in data
-        field = self.results[key]
-        p_val = self.results["p_value"]
+        field = results[key]
+        p_val = results["p_value"]
 
         # set up spatial lon-lat grid
         lons = self.da[self.lon].values
@@ -214,15 +723,36 @@ class LinReg:
         # Create a 'plots' subfolder inside the current directory
         save_path = os.path.join(current_dir, 'plots')
         os.makedirs(save_path, exist_ok=True)
+        filepath = save_path + f'/linear_regression_of_{self.da.name}.png'
+
+        # making significance mask
+        if stipple == "fdr":
+            p_95 = np.ma.masked_where(~self.significance["fdr_mask"].values, p_val)
+        else:
+            p_95 = np.ma.masked_greater(p_val, 0.05)
+
+        # block-reduce grids denser than the figure: the mean of the field,
+        # stippled where at least half of a block is significant
+        if not full_resolution:
+            factors = display_factors(field.shape, axes_pixels())
+            significant = block_reduce(~np.ma.getmaskarray(p_95), factors) >= 0.5
+            field = block_reduce(field, factors)
+            p_95 = np.ma.masked_where(~significant, block_reduce(p_val, factors))
+            Lon, Lat = np.meshgrid(*coarsen_coords(lats, lons, factors)[::-1])
+
+        # skip the figure if the file already shows the same field and stippling
+        cache = PlotCache()
+        fig_key = plot_key(field, np.ma.getmaskarray(p_95), key=key, stipple=stipple,
+                           full_resolution=full_resolution,
+                           title=f"Linear regression of {self.da.name}")
+        if not redraw and cache.fresh(filepath, fig_key):
+            return
 
         # create figure
         # fig, ax = plt.subplots(figsize=(6, 6))
         fig = plt.figure()
         ax = plt.axes()
 
-        # making significance mask
-        p_95 = np.ma.masked_greater(p_val, 0.05)
-
         # constraints on colourbar for plotting
         vmin, vmax = np.nanmin(field), np.nanmax(field)
 
@@ -271,8 +801,10 @@ class LinReg:
 
         #Save plot
         plt.title(f"Linear regression of {self.da.name}")
-        plt.savefig(save_path + f'/linear_regression_of_{self.da.name}.png', bbox_inches="tight")
+        plt.savefig(filepath, bbox_inches="tight")
         fig.tight_layout()
+        cache.record(filepath, fig_key)
+        cache.save()
 
         #show and close plot
         plt.show()
@@ -1,99 +1,339 @@
-## 
-from dataclasses import dataclass
-import xarray as xr
+##
+from collections import OrderedDict
+from dataclasses import dataclass, field
+import glob
+import hashlib
 import os
-from typing import Optional, Dict
+import threading
+import weakref
+import numpy as np
+import xarray as xr
+from typing import Optional, Dict, Tuple, Union
+
+# several chunks are decoded and reduced at once by dask, and every numpy
+# temporary needs room too, so a single chunk only gets a slice of the budget
+_CHUNKS_IN_FLIGHT = 8
+_DEFAULT_MEMORY_BUDGET = 4 * 1024**3
+_UNITS = {"B": 1, "KB": 1024, "MB": 1024**2, "GB": 1024**3, "TB": 1024**4}
+
+
+class DatasetCache:
+    """
+    Process-wide cache of opened xarray Datasets.
+
+    Entries are keyed by the resolved file path(s), their modification
+    times and sizes, the chunking and the decode options, so a file that
+    is rewritten on disk is never served from a stale handle.
+    Every ``acquire`` increments a reference count and every ``release``
+    decrements it. Only unreferenced entries are evicted (least recently
+    used first) once more than ``maxsize`` datasets are held.
+    """
+
+    def __init__(self, maxsize=8):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()   # key -> [dataset, refcount]
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def acquire(self, key, opener):
+        """Return the dataset for ``key``, calling ``opener()`` on a miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = [opener(), 0]
+                self._entries[key] = entry
+            entry[1] += 1
+            self._entries.move_to_end(key)
+            self._evict()
+            return entry[0]
+
+    def release(self, key):
+        """Drop one reference to ``key``. Unknown keys are ignored."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry[1] = max(entry[1] - 1, 0)
+            self._evict()
+
+    def refcount(self, key):
+        entry = self._entries.get(key)
+        return 0 if entry is None else entry[1]
+
+    def clear(self):
+        """Close and forget every unreferenced dataset."""
+        with self._lock:
+            for key in [k for k, e in self._entries.items() if e[1] == 0]:
+                self._entries.pop(key)[0].close()
+
+    def _evict(self):
+        # walk from the least recently used end, skipping handles in use
+        for key in list(self._entries):
+            if len(self._entries) <= self.maxsize:
+                break
+            ds, refs = self._entries[key]
+            if refs == 0:
+                del self._entries[key]
+                ds.close()
+
+
+# shared by every DataReader (and so every analysis class) in the process
+_CACHE = DatasetCache()
+
+
+def _freeze(value):
+    # make chunk specs and other options hashable for use in cache keys
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def parse_memory(value) -> int:
+    """Convert a memory size such as ``"4GB"``, ``"512 MB"`` or ``2**30`` to bytes."""
+    if isinstance(value, (int, float)):
+        return int(value)
+    text = str(value).strip().upper().replace(" ", "")
+    for unit in sorted(_UNITS, key=len, reverse=True):
+        if text.endswith(unit):
+            return int(float(text[:-len(unit)]) * _UNITS[unit])
+    return int(float(text))
+
+
+def default_memory_budget() -> int:
+    """Half of the physical memory, or 4GB where that cannot be queried."""
+    try:
+        return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") // 2
+    except (ValueError, OSError, AttributeError):
+        return _DEFAULT_MEMORY_BUDGET
+
+
+def plan_chunks(sizes, itemsize, memory_budget, operation="reduce", time_dim="time"):
+    """
+    Pick dask chunk sizes for a variable.
+
+    Parameters
+    ----------
+    sizes : dict
+        Dimension name -> length, in the variable's dimension order.
+    itemsize : int
+        Bytes per element. Computations upcast to float64, so at least 8 is used.
+    memory_budget : int | str
+        Memory the computation may use, e.g. ``"4GB"``.
+    operation : {"reduce", "regression"}
+        ``"reduce"`` keeps the whole grid in every chunk and splits time, which
+        suits reductions over time. ``"regression"`` keeps the whole time axis
+        in every chunk and tiles the grid, which suits per-pixel fits.
+
+    Returns
+    -------
+    dict
+        Dimension name -> chunk length.
+    """
+    if operation not in ("reduce", "regression"):
+        raise ValueError(f"operation must be 'reduce' or 'regression', not {operation!r}")
+
+    target = max(parse_memory(memory_budget) // _CHUNKS_IN_FLIGHT, 1)
+    cells_per_chunk = max(target // max(int(itemsize), 8), 1)
+    dims = list(sizes)
+    spatial = [d for d in dims if d != time_dim]
+    chunks = {d: sizes[d] for d in dims}
+
+    if operation == "reduce":
+        grid = 1
+        for d in spatial:
+            grid *= sizes[d]
+        if time_dim in sizes:
+            chunks[time_dim] = int(min(sizes[time_dim], max(cells_per_chunk // max(grid, 1), 1)))
+            if chunks[time_dim] > 1:
+                return chunks
+        # a single time step is already larger than a chunk: tile the grid too
+        remaining = cells_per_chunk
+    else:
+        remaining = max(cells_per_chunk // max(sizes.get(time_dim, 1), 1), 1)
+
+    # fill the fastest varying dimensions first so chunks stay contiguous on disk
+    for d in reversed(spatial):
+        chunks[d] = int(min(sizes[d], max(remaining, 1)))
+        remaining = max(remaining // chunks[d], 1)
+    return chunks
+
+
+def _coord_slice(values, bounds):
+    # index slice covering lo <= value <= hi on a monotonic coordinate
+    lo, hi = sorted(bounds)
+    if values.size > 1 and values[0] > values[-1]:
+        rev = values[::-1]
+        start = values.size - np.searchsorted(rev, hi, side="right")
+        stop = values.size - np.searchsorted(rev, lo, side="left")
+    else:
+        start = np.searchsorted(values, lo, side="left")
+        stop = np.searchsorted(values, hi, side="right")
+    return slice(int(start), int(stop))
+
 
 @dataclass
 class DataReader:
     filepath: str                     # file path or glob pattern
     use_mfdataset: bool = False       # set True if path is a glob / many files
-    chunks: Optional[Dict] = None     # e.g. {"time": 100} to enable dask lazy loading
-    def __init__(self,filepath):
-        self.filepath = filepath
-        
+    chunks: Optional[Union[Dict, str]] = None   # e.g. {"time": 100}, or "auto" to plan chunks
+    decode_times: bool = True
+    memory_budget: Optional[Union[int, str]] = None   # e.g. "4GB", used by chunks="auto"
+    operation: str = "reduce"         # "reduce" or "regression", used by chunks="auto"
+    varname: Optional[str] = None     # variable the automatic chunk plan is made for
+    lat_range: Optional[Tuple[float, float]] = None    # (south, north) in degrees
+    lon_range: Optional[Tuple[float, float]] = None    # (west, east) in degrees
+    time_range: Optional[Tuple[str, str]] = None       # (start, end), inclusive like .sel
+    _key: Optional[tuple] = field(default=None, init=False, repr=False, compare=False)
+
+    def cache_key(self) -> tuple:
+        """Identify the opened dataset: files, mtimes, chunking and decode options."""
+        if self.use_mfdataset:
+            paths = sorted(glob.glob(self.filepath))
+            if not paths:
+                raise FileNotFoundError(f"No files match: {self.filepath}")
+        else:
+            paths = [self.filepath]
+        stamps = []
+        for p in paths:
+            st = os.stat(p)
+            stamps.append((os.path.abspath(p), st.st_mtime_ns, st.st_size))
+        return (tuple(stamps), self.use_mfdataset, _freeze(self._open_chunks), self.decode_times)
+
+    def data_key(self) -> tuple:
+        """Identify the data ``read`` returns: the cached file plus the subset."""
+        return (self.cache_key(), _freeze(self.lat_range), _freeze(self.lon_range),
+                _freeze(self.time_range))
+
+    def content_hash(self, *extra) -> str:
+        """
+        Hash of the file contents' identity (paths, mtimes, sizes), the subset
+        and ``extra``. Derived products saved to disk record it, so they can
+        tell when the source has changed underneath them.
+        """
+        stamps, *_ = self.cache_key()
+        text = repr((stamps, self.data_key()[1:], extra))
+        return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+    def checksum(self, sample_bytes=1024**2) -> str:
+        """
+        Checksum of the source: each file's size and modification time plus
+        its first and last ``sample_bytes``, and the subset, without reading
+        tens of GB on every run. Any write to a file changes its mtime, so
+        an edit in the middle of a file that keeps its size still changes
+        the checksum. Unlike ``content_hash`` it ignores the path, so a copy
+        that keeps its timestamps (``cp -p``, ``rsync -t``) matches the
+        original.
+        """
+        stamps, *_ = self.cache_key()
+        h = hashlib.blake2b(digest_size=16)
+        for path, mtime, size in stamps:
+            h.update(f"{size}:{mtime}".encode())
+            with open(path, "rb") as f:
+                h.update(f.read(sample_bytes))
+                if size > sample_bytes:
+                    f.seek(max(size - sample_bytes, sample_bytes))
+                    h.update(f.read(sample_bytes))
+        h.update(repr(self.data_key()[1:]).encode())
+        return h.hexdigest()
+
+    def sidecar_path(self, tag: str, *extra) -> str:
+        """
+        Path for a derived file stored next to the source, e.g.
+        ``tg.nc.meanidx-1a2b3c4d.nc``. The suffix hashes the subset and
+        ``extra`` (not the mtime), so a rebuilt product replaces the old one.
+        """
+        base = self.filepath.replace("*", "_").replace("?", "_")
+        text = repr((self.data_key()[1:], extra))
+        suffix = hashlib.blake2b(text.encode(), digest_size=4).hexdigest()
+        return f"{base}.{tag}-{suffix}.nc"
+
+    @property
+    def _open_chunks(self):
+        # automatic plans are applied after opening, on top of the shared lazy handle
+        return None if self.chunks == "auto" else self.chunks
+
+    def _open(self) -> xr.Dataset:
+        if self.use_mfdataset:
+            return xr.open_mfdataset(self.filepath, combine="by_coords",
+                                     decode_times=self.decode_times, chunks=self._open_chunks)
+        return xr.open_dataset(self.filepath, decode_times=self.decode_times,
+                               chunks=self._open_chunks)
+
+    def subset(self, ds: xr.Dataset) -> xr.Dataset:
+        """
+        Restrict ``ds`` to the reader's bounding box and time window.
+
+        The bounds are turned into one contiguous index slice per dimension,
+        so on a lazily opened file only that hyperslab is ever read from disk.
+        """
+        slices = {}
+        for bounds, names in ((self.lat_range, ("lat", "latitude")),
+                              (self.lon_range, ("lon", "longitude"))):
+            if bounds is None:
+                continue
+            dim = next((n for n in names if n in ds.dims), None)
+            if dim is None:
+                raise KeyError(f"None of {names} found in dataset dimensions {list(ds.dims)}")
+            slices[dim] = _coord_slice(ds[dim].values, bounds)
+        if self.time_range is not None:
+            start, end = self.time_range
+            slices["time"] = ds.indexes["time"].slice_indexer(start, end)
+        return ds.isel(slices) if slices else ds
+
+    def chunk_plan(self, ds: xr.Dataset) -> dict:
+        """Chunk sizes for ``ds`` from the variable's shape and dtype, the budget and the operation."""
+        if self.varname is not None:
+            da = ds[self.varname]
+        else:
+            da = max(ds.data_vars.values(), key=lambda v: v.size)
+        budget = self.memory_budget if self.memory_budget is not None else default_memory_budget()
+        return plan_chunks(dict(da.sizes), da.dtype.itemsize, budget, self.operation)
+
     def read(self) -> xr.Dataset:
+        """
+        Return the shared dataset for this file, opening it on first use.
+
+        Readers built on the same file and options get the same ``xr.Dataset``
+        object, so treat it as read-only. The returned dataset is restricted by
+        ``subset`` and, with ``chunks="auto"``, is a dask-backed view of the
+        shared dataset chunked by ``chunk_plan``. The reference is held until
+        ``close()`` is called or the reader is garbage collected.
+        """
         if not os.path.exists(self.filepath) and not self.use_mfdataset:
             raise FileNotFoundError(f"File not found: {self.filepath}")
 
-        if self.use_mfdataset:
-            ds = xr.open_mfdataset(self.filepath, combine="by_coords",
-                                   decode_times=True, chunks=self.chunks)
+        key = self.cache_key()
+        if self._key != key:
+            self.close()
+            ds = _CACHE.acquire(key, self._open)
+            self._key = key
+            self._finalizer = weakref.finalize(self, _CACHE.release, key)
         else:
-            ds = xr.open_dataset(self.filepath, decode_times=True, chunks=self.chunks)
+            ds = _CACHE.acquire(key, self._open)
+            _CACHE.release(key)
+
+        # subset before planning so chunks are sized for what is actually read
+        ds = self.subset(ds)
+        if self.chunks == "auto":
+            ds = ds.chunk(self.chunk_plan(ds))
 
         return ds
 
+    def close(self):
+        """Release this reader's reference on the shared dataset."""
+        if self._key is not None:
+            self._finalizer()
+            self._key = None
+
+    def __enter__(self):
+        return self
 
-# # simple_climate_package/loader.py
-# from __future__ import annotations
-# from typing import Optional, Union
-# from pathlib import Path
-# import xarray as xr
-
-# class DatasetLoader:
-#     """
-#     Responsible for opening a NetCDF / Zarr dataset in a safe, configurable way.
-
-#     Parameters
-#     ----------
-#     chunks : dict | None
-#         Chunking to pass to xarray.open_dataset. If None, dataset is opened eagerly
-#         (no dask). Example: {'time': 365} or {'time': 100, 'latitude': 50, 'longitude': 50}.
-#     decode_times : bool
-#         Whether to decode times on open. Default True.
-#     verbose : bool
-#         If True, log information about the opened dataset (dimensions, variables).
-#     """
-
-#     def __init__(self, chunks: Optional[dict] = None, decode_times: bool = True):
-#         self.chunks = chunks
-#         self.decode_times = decode_times
-#         self._ds: Optional[xr.Dataset] = None
-#         self._source: Optional[Union[str, Path, xr.Dataset]] = None
-
-#     def open(self, source: Union[str, Path, xr.Dataset]) -> xr.Dataset:
-#         """
-#         Open and return an xarray.Dataset (cached).
-
-#         Parameters
-#         ----------
-#         source : str | Path | xr.Dataset
-#             File path, URL, or an already-open xarray.Dataset. If an xarray.Dataset is passed,
-#             it is returned unchanged (but stored in the loader cache).
-#         """
-#         # If it's already an xarray Dataset, just store & return it
-#         if isinstance(source, xr.Dataset):
-#             self._source = source
-#             self._ds = source
-#             return self._ds
-
-#         # normalize to Path / str
-#         path = Path(source)
-#         self._source = str(path)
-
-#         # check existence early (helpful for local paths)
-#         if not path.exists():
-#             raise FileNotFoundError(f"File not found: {path}")
-
-#         # If already opened the same source, return cached
-#         if self._ds is not None and getattr(self._ds, "encoding", {}).get("source") == str(path):
-#             return self._ds
-
-#         try:
-#             # Use xarray.open_dataset with provided chunking and decode_times options.
-#             # When chunks is not None, xarray will return a dask-backed dataset (lazy).
-#             self._ds = xr.open_dataset(str(path), chunks=self.chunks, decode_times=self.decode_times)
-#         except Exception as exc:
-#             raise RuntimeError(f"Error reading {path}: {exc}") from exc
-
-#         return self._ds
-
-#     def open_variable(self, source: Union[str, Path, xr.Dataset], varname: str = 'tg') -> xr.DataArray:
-#         """
-#         Open dataset and return a single DataArray for `varname`. Raises KeyError if variable missing.
-#         """
-#         ds = self.open(source)
-#         if varname not in ds:
-#             raise KeyError(f"Variable '{varname}' not found in dataset. Available: {list(ds.data_vars)}")
-#         return ds[varname]
+    def __exit__(self, *exc):
+        self.close()
@@ -1,74 +1,75 @@
-import xarray as xr
-import matplotlib.pyplot as plt
 import os
 import pandas as pd
+from simple_climate_package.aggregate import aggregate
 from simple_climate_package.loader import DataReader
-
-class CalcMean:
-    def __init__(self, file_path, varname='tg'):
-        
-        dr = DataReader(file_path)
-        ds = dr.read()
+from simple_climate_package.climatology import (
+    ClimatologyStore, clim_to_dataarray, daily_anomalies, daily_climatology, iter_daily_anomalies,
+    iter_monthly_anomalies, monthly_means_climatology)
+from simple_climate_package.index import PrefixSumIndex
+from simple_climate_package.plotting import render_series, save_map
+from simple_climate_package.stats import TimeSummaryMixin
+
+class CalcMean(TimeSummaryMixin):
+    def __init__(self, file_path, varname='tg', chunks=None, memory_budget=None,
+                 lat_range=None, lon_range=None, time_range=None, clim_store=None):
+
+        # the reader shares one opened dataset between every analysis class on this file
+        # and only reads the requested lat/lon box and time window from it
+        # chunks="auto" opens the file lazily with dask, planned for reductions over time
+        self.reader = DataReader(file_path, chunks=chunks, memory_budget=memory_budget,
+                                 operation="reduce", varname=varname,
+                                 lat_range=lat_range, lon_range=lon_range, time_range=time_range)
+        ds = self.reader.read()
 
         if varname not in ds:
             raise KeyError(f'{varname} not in dataset')
         self.tg = ds[varname]
+        self.mean_index = None
+        self._clims = {}    # climatologies computed or loaded by this instance
+        self._aggregates = {}    # monthly and yearly aggregates computed by this instance
 
-        # check the file exists
-        # if not os.path.exists(filepath):
-        #     FileNotFoundError(f"File not found: {filepath}")
-
-        # try to open the dataset
-        # try:
-        #     self.ds = xr.open_dataset(filepath, decode_times=True)
-        #     print('\nThe data exists, go on with analysis :)')
-        #     print(f"Opened: {filepath}")
-        #     print("Dimensions:", self.ds.dims)
-        #     print("Variables:", list(self.ds.data_vars))
-
-        # # store the temperature variable
-        #     self.tg = self.ds[varname]
-        #     # print(self.tg.time)
-
-        # except Exception as e:
-        #     raise RuntimeError(f"Error reading {filepath}: {e}")
-        
+        # optional on-disk store (a ClimatologyStore or a directory) shared between runs
+        if clim_store is not None and not isinstance(clim_store, ClimatologyStore):
+            clim_store = ClimatologyStore(clim_store)
+        self.clim_store = clim_store
+        self._checksum = None
 
-    def __init__(self, filepath, varname='tg'):
-
-        # check the file exists
-        if not os.path.exists(filepath):
-            FileNotFoundError(f"File not found: {filepath}")
-
-        # try to open the dataset
-        try:
-            self.ds = xr.open_dataset(filepath, decode_times=True)
-            print('\nThe data exists, go on with analysis :)')
-            print(f"Opened: {filepath}")
-            print("Dimensions:", self.ds.dims)
-            print("Variables:", list(self.ds.data_vars))
-
-        # store the temperature variable
-            self.tg = self.ds[varname]
-            # print(self.tg.time)
+    def build_mean_index(self, save=True):
+        """
+        Load or build the cumulative-sum index used by mean_between.
 
-        except Exception as e:
-            raise RuntimeError(f"Error reading {filepath}: {e}")
-        
-        # return self
+        The index is stored next to the data file and rebuilt automatically
+        when the data file changes. Once built, any window mean costs two
+        lookups per grid pixel instead of a pass over the window.
+        """
+        path = self.reader.sidecar_path('meanidx', self.tg.name)
+        source_hash = self.reader.content_hash(self.tg.name)
+        index = PrefixSumIndex.load(path, source_hash)
+        if index is None:
+            # a saved index is written to its file block by block as it is built
+            index = PrefixSumIndex.build(self.tg, memory_budget=self.reader.memory_budget,
+                                         source_hash=source_hash, path=path if save else None)
+        self.mean_index = index
+        return index
 
     def mean_between(self, start, end):
-        # Identify and returns the mean temperature values between two dates and plots it to a map.
-
-        # select data between two dates
-        selected_data = self.tg.sel(time=slice(start, end))
+        # Identify and returns the mean temperature values between two dates
 
-        # plot this data on a map
-        mean_map = selected_data.mean(dim='time')
+        if self.mean_index is not None:
+            return self.mean_index.mean(start, end).astype(self.tg.dtype).rename(self.tg.name)
+        return self.summary(start, end)['mean'].rename(self.tg.name)
 
-        return mean_map
+    def mean_between_many(self, windows):
+        """
+        Mean for every (start, end) window in ``windows``, stacked along a
+        ``window`` dimension. Uses the mean index (see build_mean_index) so
+        the whole batch is answered in one vectorised call.
+        """
+        if self.mean_index is None:
+            self.build_mean_index()
+        return self.mean_index.mean_many(windows).astype(self.tg.dtype).rename(self.tg.name)
 
-    def plot_mean_between(self, start, end):
+    def plot_mean_between(self, start, end, redraw=False, full_resolution=False):
         # Identify and returns the mean temperature values between two dates and plots it to a map.
 
         # Get the current working directory
@@ -82,25 +83,19 @@ class CalcMean:
         filename = f"Mean_{self.tg.name}_values_between_{start}_and_{end}.png"
         filepath = os.path.join(save_path, filename)
 
-        # select data between two dates
-        selected_data = self.tg.sel(time=slice(start, end))
-
-        # plot this data on a map
-        mean_map = selected_data.mean(dim='time')
-        qm = mean_map.plot(cmap='RdYlBu_r')          # xarray returns an Axes object
-        ax = qm.axes
-        ax.set_title(f"Mean_{self.tg.name}_values_between_{start}_and_{end}")
-        ax.figure.savefig(filepath, bbox_inches='tight')
-        plt.close(ax.figure)
+        # plot this data on a map, unless the file already shows the same data
+        mean_map = self.mean_between(start, end)
+        title = f"Mean_{self.tg.name}_values_between_{start}_and_{end}"
+        save_map(mean_map, title, filepath, "mean", redraw, full_resolution)
 
         return mean_map
 
     def mean_tot_time(self):
         # Identify the mean temperature over the whole dataset
 
-        return self.tg.mean(dim='time')
+        return self.summary()['mean'].rename(self.tg.name)
         
-    def plot_mean_tot_time(self):
+    def plot_mean_tot_time(self, redraw=False, full_resolution=False):
         # Identify the mean temperature over the whole dataset and plot
         
         # Get the current working directory
@@ -114,83 +109,95 @@ class CalcMean:
         filename = f"mean_time_tot_{self.tg.name}.png"
         filepath = os.path.join(save_path, filename)
 
-        # plot this data on a map
-        mean_map = self.tg.mean(dim='time')
-        qm = mean_map.plot(cmap='RdYlBu_r')
-        ax = qm.axes
-        ax.set_title(f"Overall mean {self.tg.name} values")
-        ax.figure.savefig(filepath, bbox_inches='tight')
-        plt.close(ax.figure)
+        # plot this data on a map, unless the file already shows the same data
+        mean_map = self.mean_tot_time()
+        title = f"Overall mean {self.tg.name} values"
+        save_map(mean_map, title, filepath, "mean", redraw, full_resolution)
 
         return mean_map
 
-    def monthly_mean(self):
-        return self.tg.resample(time="1ME").mean()
-
-    def yearly_mean(self):
-        return self.tg.resample(time="1YE").mean()
+    def _aggregate(self, freq, how, min_fraction=None):
+        # computed once per instance and shared by every method (and pipeline step) that needs it
+        key = (freq, how, min_fraction)
+        if key not in self._aggregates:
+            self._aggregates[key] = aggregate(self.tg, freq, how, min_fraction=min_fraction,
+                                              memory_budget=self.reader.memory_budget)
+        return self._aggregates[key]
+
+    def monthly_mean(self, min_fraction=None):
+        # min_fraction: months with fewer valid days than this share are NaN
+        return self._aggregate("month", "mean", min_fraction)
+
+    def yearly_mean(self, min_fraction=None):
+        # min_fraction: years with fewer valid days than this share are NaN
+        return self._aggregate("year", "mean", min_fraction)
     
-    def plot_yearly_mean(self):
-        
-        # calculate the yearly mean:
-        yearly_ds = self.yearly_mean()
-        # da = yearly_ds[var]
-        da = yearly_ds
-        lats = yearly_ds.coords['latitude'].values
-        lons = yearly_ds.coords['longitude'].values
-
-        # 3. Compute global vmin/vmax for consistent color scaling
-        vmin = float(da.min(skipna=True).values)
-        vmax = float(da.max(skipna=True).values)
-
-                # Get the current working directory
-        current_dir = os.getcwd()
+    def plot_yearly_mean(self, n_workers=None, combined=None, redraw=False, full_resolution=False):
+        # plot the mean of every year, rendered by a pool of workers
+        # (combined="gif" or "pdf" writes every frame into one animated or multi-page file;
+        # frames already drawn from the same data are skipped unless redraw=True;
+        # grids finer than the image are block-reduced unless full_resolution=True)
+        da = self.yearly_mean()
+        var_name = self.tg.name
 
         # Create a 'plots' subfolder inside the current directory
-        save_path = os.path.join(current_dir, 'plots','yearly_mean')
+        save_path = os.path.join(os.getcwd(), 'plots', 'yearly_mean')
         os.makedirs(save_path, exist_ok=True)
-    
-        # cmap = "RdYlBu_r",
 
-        # loop to plot over the yearly data:
-        times = da.time.values
-        print(times)
-        var_name = self.tg.name
+        # nice date labels (YYYY); one colour scale for every year
+        years = [pd.to_datetime(t).strftime("%Y") for t in da.time.values]
+        return render_series(da, "time",
+                             titles=[f"Mean {var_name} for {year}" for year in years],
+                             paths=[os.path.join(save_path, f'mean_{var_name}_for_{year}.png') for year in years],
+                             label=var_name, n_workers=n_workers,
+                             output=os.path.join(save_path, f'yearly_mean_{var_name}.{combined}') if combined else None,
+                             redraw=redraw, coarsen="mean", full_resolution=full_resolution)
+
+    def _clim(self, kind, compute, baseline=None, **options):
+        # look in this instance, then in the climatology store, and only then compute
+        memo_key = (kind, tuple(baseline) if baseline else None, tuple(sorted(options.items())))
+        if memo_key in self._clims:
+            return self._clims[memo_key]
+
+        clim = None
+        if self.clim_store is not None:
+            if self._checksum is None:
+                self._checksum = self.reader.checksum()
+            store_key = ClimatologyStore.key(self._checksum, self.tg.name, kind,
+                                             baseline=memo_key[1], **options)
+            clim = self.clim_store.get(store_key)
+        if clim is None:
+            data = self.tg if baseline is None else self.tg.sel(time=slice(*baseline))
+            clim = compute(data)
+            if self.clim_store is not None:
+                self.clim_store.put(store_key, clim, self.reader.filepath, self._checksum)
+
+        self._clims[memo_key] = clim
+        return clim
 
-        for idx, t in enumerate(times):
-            single = da.isel(time=idx)
-
-            # nice date label (YYYY)
-            year_label = pd.to_datetime(t).strftime("%Y")
-
-            fig = plt.figure()
-            ax = plt.axes()
-            # single.plot()
-            mesh = ax.pcolormesh(lons, lats, single.values, shading="auto", vmin=vmin, vmax=vmax, cmap="RdYlBu_r")
-            cbar = fig.colorbar(mesh, ax=ax, orientation="vertical")
-            cbar.set_label(var_name)
-            ax.set_xlabel('Longitude')
-            ax.set_ylabel('Latitude')
-            plt.title(f"Mean {var_name} for {year_label}")
-            plt.savefig(save_path + f'/mean_{var_name}_for_{year_label}.png', dpi=150, bbox_inches="tight")
-            fig.tight_layout()
-            plt.close()
-            print(f'sved fig for {year_label}')
-
-    def monthly_clim(self):
-        return self.tg.groupby('time.month').mean(dim='time')
+    def monthly_clim(self, baseline=None):
+        """
+        Long-term mean of every calendar month, optionally over a baseline
+        period such as ("1991-01-01", "2020-12-31").
+        """
+        return self._clim('monthly', lambda d: d.groupby('time.month').mean(dim='time').load(), baseline)
     
-    def monthly_clim_Anom(self):
+    def monthly_clim_Anom(self, baseline=None):
         """
         Compute monthly anomalies:
         monthly mean - long-term monthly climatology.
+        The climatology can be taken over a baseline period, e.g. ("1991-01-01", "2020-12-31").
         Returns an xarray.DataArray with one value per month.
         """
         # 1. Convert daily data → monthly means
-        monthly = self.tg.resample(time="1ME").mean()
+        monthly = self.monthly_mean()
 
         # 2. Compute long-term monthly climatology
-        clim = monthly.groupby("time.month").mean(dim="time")
+        # over the whole record the monthly means above are reused
+        clim = self._clim('monthly_of_monthly_means',
+                          lambda d: (monthly if baseline is None else aggregate(d, "month", "mean"))
+                          .groupby("time.month").mean(dim="time"),
+                          baseline)
 
         # 3. Subtract climatology from each month
         anom = monthly.groupby("time.month") - clim
@@ -198,122 +205,81 @@ class CalcMean:
         anom.attrs["description"] = "Monthly mean anomalies"
         return anom
 
+    def iter_monthly_clim_Anom(self, baseline=None, block_size=None):
+        """
+        Same anomalies as monthly_clim_Anom, streamed as (times, numpy array) blocks
+        of whole months read ``block_size`` days at a time, for records too large to hold in memory.
+        """
+        budget = self.reader.memory_budget
+        clim = self._clim('monthly_of_monthly_means',
+                          lambda d: monthly_means_climatology(d, memory_budget=budget), baseline)
+        return iter_monthly_anomalies(self.tg, clim, block_size=block_size, memory_budget=budget)
+
     # DAILY climatology & anomalies (day-of-year handling)
-    def daily_clim(self, drop_feb29=True):
+    def _daily_clim_da(self, drop_feb29, baseline):
+        # computed once per calendar and baseline and reused by daily_clim and daily_clim_Anom
+        budget = self.reader.memory_budget
+        return self._clim(
+            'daily',
+            lambda d: clim_to_dataarray(daily_climatology(d, drop_feb29=drop_feb29, memory_budget=budget), d),
+            baseline, drop_feb29=drop_feb29)
+
+    def daily_clim(self, drop_feb29=True, baseline=None):
         """
         Daily climatology (dayofyear: 1..365).
-        If drop_feb29=True, Feb 29 is removed before computing the climatology so clim has 365 values.
+        If drop_feb29=True, Feb 29 is removed before computing the climatology so clim has 365 values,
+        and every calendar date has the same dayofyear in leap and non-leap years.
+        If drop_feb29=False, Feb 29 gets its own value and clim has 366 values.
+        The climatology can be taken over a baseline period, e.g. ("1991-01-01", "2020-12-31").
         """
-        daily = self.tg  # assume daily frequency; resample if needed: self.tg.resample(time="1D").mean()
-        if drop_feb29:
-            daily_no29 = daily.sel(time=~((daily['time'].dt.month == 2) & (daily['time'].dt.day == 29)))
-        else:
-            daily_no29 = daily
-        clim = daily_no29.groupby("time.dayofyear").mean(dim="time")
-        clim.attrs["description"] = "Daily climatology by dayofyear (1..365)"
+        clim = self._daily_clim_da(drop_feb29, baseline).copy()
+        clim.attrs["description"] = f"Daily climatology by dayofyear (1..{clim.sizes['dayofyear']})"
         return clim
 
-
-    def daily_clim_Anom(self, keep_feb29=True, drop_feb29_for_clim=True):
+    def daily_clim_Anom(self, keep_feb29=True, drop_feb29_for_clim=True, baseline=None):
         """
         Daily anomalies: daily mean - day-of-year climatology.
         - If drop_feb29_for_clim=True, the climatology is computed on a 365-day calendar.
         - If keep_feb29=True, Feb 29 anomalies are produced by mapping Feb29 to Feb28 climatology.
         Otherwise Feb29 is dropped from the returned anomaly.
         Returns DataArray with same time axis as input (except possibly Feb29 if keep_feb29=False).
+        The anomalies are written in one pass into a single output array, with no concat or sort.
+        The climatology can be taken over a baseline period, e.g. ("1991-01-01", "2020-12-31").
         """
-        daily = self.tg  # use as-is (resample to 1D only if needed)
-
-        # Optionally drop Feb29 when computing climatology
-        if drop_feb29_for_clim:
-            daily_for_clim = daily.sel(time=~((daily['time'].dt.month == 2) & (daily['time'].dt.day == 29)))
-        else:
-            daily_for_clim = daily
-
-        clim = daily_for_clim.groupby("time.dayofyear").mean(dim="time")  # dayofyear: 1..365 (or 366)
-
-        # Compute anomalies for days present in daily_for_clim
-        # If we dropped Feb29 for climatology, we compute anom for non-Feb29 days first
-        anom_non29 = daily_for_clim.groupby("time.dayofyear") - clim
-
-        if keep_feb29 and drop_feb29_for_clim:
-            # Build Feb29 anomalies by mapping to Feb28 climatology (common choice)
-            feb29_mask = (daily['time'].dt.month == 2) & (daily['time'].dt.day == 29)
-            if feb29_mask.any():
-                # dayofyear for Feb28 in non-leap-year calendar:
-                feb28_dayofyear = pd.Timestamp(year=2001, month=2, day=28).dayofyear  # usually 59
-                feb28_clim = clim.sel(dayofyear=feb28_dayofyear)
-
-                # Compute anomaly for Feb29 dates by subtracting Feb28 climatology
-                feb29_values = daily.sel(time=feb29_mask) - feb28_clim
-
-                # Combine non-Feb29 anomalies with constructed Feb29 anomalies and sort by time
-                anom = xr.concat([anom_non29, feb29_values], dim="time").sortby("time")
-            else:
-                anom = anom_non29
-        else:
-            # either we dropped Feb29 and don't want to keep it, or climatology included Feb29 so the grouping works
-            # if daily still has Feb29 but clim has 366 days, xarray alignment will work automatically.
-            if not drop_feb29_for_clim:
-                # We didn't drop Feb29 when computing climatology, so compute anom for full daily directly:
-                anom = daily.groupby("time.dayofyear") - clim
-            else:
-                anom = anom_non29
-
+        clim = self._daily_clim_da(drop_feb29_for_clim, baseline).values
+        anom = daily_anomalies(self.tg, clim, drop_feb29=drop_feb29_for_clim, keep_feb29=keep_feb29,
+                               memory_budget=self.reader.memory_budget)
         anom.attrs["description"] = "Daily anomalies (daily - dayofyear climatology)"
         return anom
 
+    def iter_daily_clim_Anom(self, keep_feb29=True, drop_feb29_for_clim=True, baseline=None,
+                             block_size=None):
+        """
+        Same anomalies as daily_clim_Anom, streamed as (times, numpy array) blocks
+        of ``block_size`` days, for records too large to hold in memory.
+        """
+        clim = self._daily_clim_da(drop_feb29_for_clim, baseline).values
+        return iter_daily_anomalies(self.tg, clim, drop_feb29=drop_feb29_for_clim, keep_feb29=keep_feb29,
+                                    block_size=block_size, memory_budget=self.reader.memory_budget)
 
-    def plot_monthly_climatology(self):
-        
-        # calculate the yearly mean:
-        clim_ds = self.monthly_clim()
-        # da = yearly_ds[var]
-        da = clim_ds
-        lats = clim_ds.coords['latitude'].values
-        lons = clim_ds.coords['longitude'].values
-
-        # 3. Compute global vmin/vmax for consistent color scaling
-        vmin = float(da.min(skipna=True).values)
-        vmax = float(da.max(skipna=True).values)
 
-        # Get the current working directory
-        current_dir = os.getcwd()
+    def plot_monthly_climatology(self, n_workers=None, combined=None, redraw=False, full_resolution=False):
+        # plot the climatology of every calendar month, rendered by a pool of workers
+        # (combined="gif" or "pdf" writes every frame into one animated or multi-page file;
+        # frames already drawn from the same data are skipped unless redraw=True;
+        # grids finer than the image are block-reduced unless full_resolution=True)
+        da = self.monthly_clim()
+        var_name = self.tg.name
 
         # Create a 'plots' subfolder inside the current directory
-        save_path = os.path.join(current_dir, 'plots','monthly_clim')
+        save_path = os.path.join(os.getcwd(), 'plots', 'monthly_clim')
         os.makedirs(save_path, exist_ok=True)
-    
-        # cmap = "RdYlBu_r",
-
-        # print(da) 
-
-        # loop to plot over the yearly data:
-        times = da.month.values
-        print(times)
-        var_name = self.tg.name
-        # print(self.tg.name)
 
         months = ['Jan','Feb','Mar','Apr','May','Jun','Jul','Aug','Sep','Oct','Nov','Dec']
-
-        for idx, t in enumerate(times):
-            single = da.isel(month=idx)
-
-            # nice date label (YYYY)
-            # month_label = str(t)            
-            month_label = months[idx]
-
-
-            fig = plt.figure()
-            ax = plt.axes()
-            # single.plot()
-            mesh = ax.pcolormesh(lons, lats, single.values, shading="auto", vmin=vmin, vmax=vmax, cmap="RdYlBu_r")
-            cbar = fig.colorbar(mesh, ax=ax, orientation="vertical")
-            cbar.set_label(var_name)
-            ax.set_xlabel('Longitude')
-            ax.set_ylabel('Latitude')
-            plt.title(f"Mean climatology {var_name} for {month_label}")
-            plt.savefig(save_path + f'/mean_{var_name}_for_{month_label}.png', dpi=150, bbox_inches="tight")
-            fig.tight_layout()
-            plt.close()
-            print(f'sved fig for {month_label}')
+        labels = [months[int(m) - 1] for m in da.month.values]
+        return render_series(da, "month",
+                             titles=[f"Mean climatology {var_name} for {m}" for m in labels],
+                             paths=[os.path.join(save_path, f'mean_{var_name}_for_{m}.png') for m in labels],
+                             label=var_name, n_workers=n_workers,
+                             output=os.path.join(save_path, f'monthly_clim_{var_name}.{combined}') if combined else None,
+                             redraw=redraw, coarsen="mean", full_resolution=full_resolution)
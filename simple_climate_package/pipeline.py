@@ -0,0 +1,356 @@
+import argparse
+import os
+import threading
+import time
+import tomllib
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import chdir, contextmanager
+from dataclasses import dataclass
+import matplotlib.pyplot as plt
+import numpy as np
+import xarray as xr
+from simple_climate_package.climatology import ClimatologyStore
+from simple_climate_package.extremes import CalcExtremes
+from simple_climate_package.linear_regression import LinReg, regress_annual
+from simple_climate_package.mean import CalcMean
+
+###Declarative runs of several analyses with shared intermediate products###
+
+# pyplot keeps global state and is not thread-safe; figures drawn through it take turns
+_PYPLOT_LOCK = threading.Lock()
+
+_READER_OPTIONS = ("varname", "chunks", "memory_budget", "lat_range", "lon_range", "time_range")
+
+
+@dataclass(frozen=True)
+class Step:
+    """
+    One kind of node in a pipeline graph.
+
+    ``needs`` names the steps whose results it uses, ``params`` the job
+    parameters it accepts (passed on to every needed step that accepts them
+    too) and ``run(pipeline, inputs, **params)`` computes it, with
+    ``inputs`` mapping each needed step to its result. ``figure`` steps
+    write their own files; the results of the others are saved when asked
+    for as products. Steps drawing through pyplot set ``pyplot`` so that
+    they never run concurrently.
+    """
+    needs: tuple
+    params: tuple
+    run: object
+    figure: bool = False
+    pyplot: bool = False
+
+
+def _analysis(cls):
+    def run(pipeline, inputs):
+        options = {k: v for k, v in pipeline.data.items() if k in _READER_OPTIONS}
+        if cls is CalcMean and pipeline.data.get("clim_store"):
+            options["clim_store"] = ClimatologyStore(pipeline.data["clim_store"])
+        return cls(pipeline.data["path"], **options)
+    return run
+
+
+def _method(analysis, method, **renamed):
+    # call a method of an analysis object, with job parameters renamed to its arguments
+    def run(pipeline, inputs, **params):
+        kwargs = {renamed.get(k, k): v for k, v in params.items()}
+        return getattr(inputs[analysis], method)(**kwargs)
+    return run
+
+
+def _regression(pipeline, inputs, min_obs=3):
+    # the regression runs on the yearly means already computed for the mean products;
+    # every node keeps its own fit rather than overwriting the shared LinReg.results
+    reg = inputs["linreg"]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return regress_annual(inputs["yearly_mean"], reg.lat, reg.lon, min_obs=min_obs,
+                              max_memory=reg.reader.memory_budget)
+
+
+def _plot_trend(pipeline, inputs, **params):
+    # draw the fit of the regression node this one depends on
+    return inputs["linreg"].quick_plot_signif_stippling(results=inputs["regression"], **params)
+
+
+def _map(analysis, method, params=()):
+    # single map drawn through pyplot
+    return Step((analysis, "summary"), params + _PLOT, _method(analysis, method), figure=True, pyplot=True)
+
+
+def _series(analysis, data, method):
+    # one figure per year or month, drawn by a process pool; with pipeline threads running
+    # its workers start from a fork server rather than a fork (see _parallel.pool_context)
+    return Step((analysis, data), _SERIES, _method(analysis, method), figure=True)
+
+
+_PLOT = ("redraw", "full_resolution")
+_SERIES = ("n_workers", "combined") + _PLOT
+
+STEPS = {
+    # analysis objects, all sharing one opened dataset
+    "mean": Step((), (), _analysis(CalcMean)),
+    "extremes": Step((), (), _analysis(CalcExtremes)),
+    "linreg": Step((), (), _analysis(LinReg)),
+
+    # intermediate products, each computed once for every step that needs it
+    "summary": Step(("mean",), ("start", "end"), _method("mean", "summary")),
+    "monthly_mean": Step(("mean",), ("min_fraction",), _method("mean", "monthly_mean")),
+    "yearly_mean": Step(("mean",), ("min_fraction",), _method("mean", "yearly_mean")),
+    "monthly_max": Step(("extremes",), ("min_fraction",), _method("extremes", "monthly_max")),
+    "monthly_min": Step(("extremes",), ("min_fraction",), _method("extremes", "monthly_min")),
+    "yearly_max": Step(("extremes",), ("min_fraction",), _method("extremes", "yearly_max")),
+    "yearly_min": Step(("extremes",), ("min_fraction",), _method("extremes", "yearly_min")),
+    "monthly_clim": Step(("mean",), ("baseline",), _method("mean", "monthly_clim")),
+    "monthly_clim_anom": Step(("mean", "monthly_mean"), ("baseline",), _method("mean", "monthly_clim_Anom")),
+    "daily_clim": Step(("mean",), ("drop_feb29", "baseline"), _method("mean", "daily_clim")),
+    "daily_clim_anom": Step(("mean", "daily_clim"), ("keep_feb29", "drop_feb29", "baseline"),
+                            _method("mean", "daily_clim_Anom", drop_feb29="drop_feb29_for_clim")),
+    "regression": Step(("linreg", "yearly_mean"), ("min_obs",), _regression),
+
+    # figures, written under plots/ in the output directory
+    "plot_mean_tot_time": _map("mean", "plot_mean_tot_time"),
+    "plot_mean_between": _map("mean", "plot_mean_between", ("start", "end")),
+    "plot_max_tot": _map("extremes", "plot_max_tot"),
+    "plot_min_tot": _map("extremes", "plot_min_tot"),
+    "plot_max_between": _map("extremes", "plot_max_between", ("start", "end")),
+    "plot_min_between": _map("extremes", "plot_min_between", ("start", "end")),
+    "plot_yearly_mean": _series("mean", "yearly_mean", "plot_yearly_mean"),
+    "plot_monthly_climatology": _series("mean", "monthly_clim", "plot_monthly_climatology"),
+    "plot_yearly_max": _series("extremes", "yearly_max", "plot_yearly_max"),
+    "plot_yearly_min": _series("extremes", "yearly_min", "plot_yearly_min"),
+    "plot_trend": Step(("linreg", "regression"), ("key", "stipple") + _PLOT,
+                       _plot_trend, figure=True, pyplot=True),
+}
+
+
+@contextmanager
+def _agg_backend(needed=True):
+    # pyplot steps draw on worker threads, which interactive backends (TkAgg, Qt) do not
+    # allow; switching backend closes the open figures
+    backend = plt.get_backend()
+    if not needed or backend.lower() == "agg":
+        yield
+        return
+    plt.switch_backend("Agg")
+    try:
+        yield
+    finally:
+        plt.switch_backend(backend)
+
+
+def _freeze(value):
+    # lists from the job file become tuples, so parameters can key graph nodes
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def load_spec(path):
+    """
+    Read a job spec from a TOML file, or a YAML file (``.yaml``/``.yml``,
+    needs PyYAML).
+    """
+    if os.path.splitext(path)[1].lower() in (".yaml", ".yml"):
+        try:
+            import yaml
+        except ImportError as e:
+            raise ImportError("YAML job files need PyYAML (pip install pyyaml); "
+                              "or write the job as TOML") from e
+        with open(path) as f:
+            return yaml.safe_load(f)
+    with open(path, "rb") as f:
+        return tomllib.load(f)
+
+
+class Pipeline:
+    """
+    Run the products listed in a job spec in one pass over a data file.
+
+    Every product and every intermediate it needs (the time summary,
+    monthly and yearly aggregates, climatologies, the regression) is a node
+    of a dependency graph keyed by step name and parameters, so an
+    intermediate shared by several products is computed once. Nodes whose
+    inputs are ready run concurrently on ``max_workers`` threads.
+
+    The spec is a mapping (the contents of a TOML or YAML job file)::
+
+        output_dir = "results"          # plots/ and data files go here
+        max_workers = 4
+
+        [data]
+        path = "Data/Example_Data/e-obs_UK_ground_temp.nc"
+        varname = "tg"                  # also chunks, memory_budget, lat_range,
+                                        # lon_range, time_range, clim_store
+
+        [[products]]
+        step = "plot_mean_between"
+        start = "1950-01-01"
+        end = "1955-01-01"
+
+    A product is a step name or a table with ``step`` and its parameters
+    (see ``STEPS``). Products that compute data (``yearly_mean``,
+    ``regression``...) are written to NetCDF, to ``file`` if given or
+    ``<step>.nc``. Relative paths are taken from ``base_dir``.
+
+    Example
+    -------
+    >>> outputs = Pipeline.from_file("example_job.toml").run()
+    """
+
+    def __init__(self, spec, base_dir="."):
+        spec = dict(spec)
+        self.data = {k: _freeze(v) for k, v in dict(spec.pop("data", {})).items()}
+        if "path" not in self.data:
+            raise ValueError("the job spec needs a [data] table with the path of the data file")
+        for key in ("path", "clim_store"):
+            if self.data.get(key):
+                self.data[key] = os.path.abspath(os.path.join(base_dir, self.data[key]))
+        self.output_dir = os.path.abspath(os.path.join(base_dir, spec.pop("output_dir", ".")))
+        self.max_workers = spec.pop("max_workers", None)
+        products = spec.pop("products", [])
+        if spec:
+            raise ValueError(f"unknown job spec entries: {sorted(spec)}")
+        if not products:
+            raise ValueError("the job spec lists no products")
+
+        self.graph = {}      # node -> the nodes it needs, in the order of Step.needs
+        self.products = {}   # requested node -> output file for data products (or None)
+        for product in products:
+            product = {"step": product} if isinstance(product, str) else dict(product)
+            name = product.pop("step", None)
+            if name not in STEPS:
+                raise ValueError(f"unknown step {name!r}; choose from {sorted(STEPS)}")
+            output = product.pop("file", None)
+            unknown = set(product) - set(STEPS[name].params)
+            if unknown:
+                raise ValueError(f"step {name!r} takes {list(STEPS[name].params)}, not {sorted(unknown)}")
+            node = self._add(name, {k: _freeze(v) for k, v in product.items()})
+            self.products[node] = output if output is not None else f"{name}.nc"
+
+        files = [f for node, f in self.products.items() if not STEPS[node[0]].figure]
+        clashes = sorted({f for f in files if files.count(f) > 1})
+        if clashes:
+            raise ValueError(f"several products would be written to {clashes}; give each a 'file'")
+
+    @classmethod
+    def from_file(cls, path):
+        """Pipeline for a TOML or YAML job file; relative paths are taken from its folder."""
+        return cls(load_spec(path), base_dir=os.path.dirname(os.path.abspath(path)))
+
+    def _add(self, name, params):
+        node = (name, tuple(sorted(params.items())))
+        if node not in self.graph:
+            self.graph[node] = [
+                self._add(need, {k: v for k, v in params.items() if k in STEPS[need].params})
+                for need in STEPS[name].needs]
+        return node
+
+    def order(self):
+        """The graph's nodes with every node after the nodes it needs."""
+        done, order = set(), []
+
+        def visit(node):
+            if node not in done:
+                done.add(node)
+                for need in self.graph[node]:
+                    visit(need)
+                order.append(node)
+
+        for node in self.graph:
+            visit(node)
+        return order
+
+    def _run_node(self, node, results):
+        name, params = node
+        step = STEPS[name]
+        inputs = {need: results[dep] for need, dep in zip(step.needs, self.graph[node])}
+        start = time.perf_counter()
+        if step.pyplot:
+            with _PYPLOT_LOCK:
+                result = step.run(self, inputs, **dict(params))
+        else:
+            result = step.run(self, inputs, **dict(params))
+        return result, time.perf_counter() - start
+
+    def run(self, progress=True):
+        """
+        Compute every node of the graph and write the products.
+
+        Figures go under ``plots/`` in the output directory, which is the
+        working directory for the duration of the run. Steps drawing through
+        pyplot use the non-interactive Agg backend; another active backend
+        is restored afterwards (its open figures are closed).
+
+        Returns
+        -------
+        dict
+            Step name and parameters of every product -> the path of the
+            NetCDF file written for data products, or what the plotting
+            method returned for figures.
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        results, outputs = {}, {}
+        waiting = dict(self.graph)
+        pyplot = any(STEPS[name].pyplot for name, _ in self.graph)
+        with _agg_backend(pyplot), chdir(self.output_dir), ThreadPoolExecutor(self.max_workers) as pool:
+            running = {}
+            while waiting or running:
+                for node in [n for n, needs in waiting.items() if all(d in results for d in needs)]:
+                    del waiting[node]
+                    running[pool.submit(self._run_node, node, results)] = node
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    node = running.pop(future)
+                    results[node], seconds = future.result()
+                    if node in self.products:
+                        outputs[node] = self._write(node, results[node])
+                    if progress:
+                        print(f"{_label(node)} done in {seconds:.1f}s", flush=True)
+        return outputs
+
+    def _write(self, node, result):
+        # data products are saved; figures were written by their step
+        if STEPS[node[0]].figure or not isinstance(result, (xr.Dataset, xr.DataArray)):
+            return result
+        path = os.path.abspath(self.products[node])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        result.to_netcdf(f"{path}.tmp", format="NETCDF4")
+        os.replace(f"{path}.tmp", path)
+        return path
+
+
+def _label(node):
+    name, params = node
+    return name + "".join(f" {k}={v}" for k, v in params)
+
+
+def main(argv=None):
+    """Command line entry point: ``simple-climate-pipeline job.toml``."""
+    parser = argparse.ArgumentParser(
+        prog="simple-climate-pipeline",
+        description="Run the analyses and plots listed in a TOML or YAML job file.")
+    parser.add_argument("job", help="path of the job file")
+    parser.add_argument("--max-workers", type=int, help="steps run at once (default: from the job file)")
+    parser.add_argument("--output-dir", help="where to write plots and data (default: from the job file)")
+    parser.add_argument("--dry-run", action="store_true", help="list the steps in order without running them")
+    parser.add_argument("--quiet", action="store_true", help="do not report each finished step")
+    args = parser.parse_args(argv)
+
+    pipeline = Pipeline.from_file(args.job)
+    if args.max_workers is not None:
+        pipeline.max_workers = args.max_workers
+    if args.output_dir is not None:
+        pipeline.output_dir = os.path.abspath(args.output_dir)
+
+    if args.dry_run:
+        for node in pipeline.order():
+            print(_label(node) + (" *" if node in pipeline.products else ""))
+        return 0
+
+    pipeline.run(progress=not args.quiet)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,399 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import matplotlib.pyplot as plt
+import numpy as np
+import xarray as xr
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.backends.backend_pdf import PdfPages
+from matplotlib.figure import Figure
+from PIL import Image
+from tqdm import tqdm
+from simple_climate_package._parallel import pool_context
+from simple_climate_package.version_info import VERSION
+
+###Batch rendering of map series (one PNG per year or month)###
+
+
+def plot_key(*arrays, **params):
+    """
+    Content hash of a figure: the bytes of every array drawn (DataArrays
+    with their dimension coordinates) plus the plotting parameters and the
+    package version.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for a in arrays:
+        parts = [a.values] + [a[d].values for d in a.dims if d in a.coords] if hasattr(a, "dims") else [a]
+        for part in parts:
+            part = np.ascontiguousarray(part)
+            h.update(f"{part.dtype.str}{part.shape}".encode())
+            h.update(part.tobytes())
+    h.update(json.dumps([VERSION, params], sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+class PlotCache:
+    """
+    Manifest of the figures already drawn, one JSON file per plot folder
+    mapping file names to ``plot_key`` hashes. A figure whose file exists
+    with a matching hash does not need to be drawn again.
+    """
+
+    MANIFEST = ".plot_manifest.json"
+
+    def __init__(self):
+        self._manifests = {}
+        self._changed = set()
+
+    def _manifest(self, directory):
+        if directory not in self._manifests:
+            try:
+                with open(os.path.join(directory, self.MANIFEST)) as f:
+                    self._manifests[directory] = json.load(f)
+            except (OSError, ValueError):
+                self._manifests[directory] = {}
+        return self._manifests[directory]
+
+    def fresh(self, path, key):
+        """True when ``path`` exists and was drawn from content hashing to ``key``."""
+        directory, name = os.path.split(os.path.abspath(path))
+        return self._manifest(directory).get(name) == key and os.path.exists(path)
+
+    def record(self, path, key):
+        directory, name = os.path.split(os.path.abspath(path))
+        self._manifest(directory)[name] = key
+        self._changed.add(directory)
+
+    def save(self):
+        for directory in self._changed:
+            path = os.path.join(directory, self.MANIFEST)
+            with open(f"{path}.tmp", "w") as f:
+                json.dump(self._manifests[directory], f, indent=1, sort_keys=True)
+            os.replace(f"{path}.tmp", path)
+        self._changed.clear()
+
+
+_REDUCERS = {"mean": np.nanmean, "min": np.nanmin, "max": np.nanmax}
+# share of the axes width a default colorbar takes (fraction 0.15 plus pad 0.05)
+_COLORBAR_SHARE = 0.2
+
+
+def display_factors(shape, pixels):
+    """
+    Block sizes (rows, cols) that bring a (lat, lon) grid of ``shape`` down
+    to no more cells than the (height, width) ``pixels`` it is drawn on.
+    """
+    return tuple(max(-(-int(n) // max(int(p), 1)), 1) for n, p in zip(shape, pixels))
+
+
+def block_reduce(a, factors, how="mean"):
+    """
+    Reduce the last two axes of ``a`` over blocks of ``factors`` cells with
+    ``how`` ("mean", "min" or "max"), skipping NaNs. Edge blocks that do not
+    fill a whole block are reduced over the cells they have.
+    """
+    a = np.asarray(a, dtype=float)
+    fy, fx = factors
+    if fy == 1 and fx == 1:
+        return a
+    ny, nx = a.shape[-2:]
+    my, mx = -(-ny // fy), -(-nx // fx)
+    padded = np.full(a.shape[:-2] + (my * fy, mx * fx), np.nan)
+    padded[..., :ny, :nx] = a
+    blocks = padded.reshape(a.shape[:-2] + (my, fy, mx, fx))
+    with np.errstate(invalid="ignore"), warnings.catch_warnings():
+        # all-NaN blocks (sea, missing data) stay NaN
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return _REDUCERS[how](blocks, axis=(-3, -1))
+
+
+def coarsen_for_display(field, lats, lons, pixels, how="mean"):
+    """
+    ``field`` (..., lat, lon) block-reduced with ``how`` to at most one cell
+    per pixel of ``pixels`` (height, width), with the block-mean latitudes
+    and longitudes. Grids that are already coarse enough are returned as
+    they are.
+    """
+    factors = display_factors(np.shape(field)[-2:], pixels)
+    return (block_reduce(field, factors, how),) + coarsen_coords(lats, lons, factors)
+
+
+def coarsen_coords(lats, lons, factors):
+    """The mean latitude and longitude of every block of ``factors`` cells."""
+    if factors == (1, 1):
+        return lats, lons
+    lats = block_reduce(np.asarray(lats, dtype=float).reshape(-1, 1), (factors[0], 1)).ravel()
+    lons = block_reduce(np.asarray(lons, dtype=float).reshape(1, -1), (1, factors[1])).ravel()
+    return lats, lons
+
+
+def axes_pixels(fig=None, dpi=None):
+    """
+    (height, width) in pixels of the map axes of ``fig`` (default: a new
+    pyplot figure) saved at ``dpi``: the subplot area, less the width a
+    default vertical colorbar takes from it.
+    """
+    rc = plt.rcParams
+    width, height = fig.get_size_inches() if fig is not None else rc["figure.figsize"]
+    if dpi is None:
+        dpi = rc["savefig.dpi"]
+        if dpi == "figure":
+            dpi = fig.dpi if fig is not None else rc["figure.dpi"]
+    if fig is not None:
+        sp = fig.subplotpars
+        left, right, bottom, top = sp.left, sp.right, sp.bottom, sp.top
+    else:
+        left, right, bottom, top = (rc[f"figure.subplot.{k}"] for k in ("left", "right", "bottom", "top"))
+    return (int(height * dpi * (top - bottom)),
+            int(width * dpi * (right - left) * (1 - _COLORBAR_SHARE)))
+
+
+def display_map(da, how="mean", full_resolution=False):
+    """
+    A 2D (lat, lon) DataArray block-reduced to the resolution of the map in
+    a default pyplot figure (see ``coarsen_for_display``), unless ``full_resolution``.
+    """
+    lat = "lat" if "lat" in da.coords else "latitude"
+    lon = "lon" if "lon" in da.coords else "longitude"
+    da = da.transpose(lat, lon)
+    if full_resolution:
+        return da
+    values, lats, lons = coarsen_for_display(da.values, da[lat].values, da[lon].values,
+                                             axes_pixels(), how)
+    if values.shape == da.shape:
+        return da
+    return xr.DataArray(values, coords={lat: lats, lon: lons}, dims=(lat, lon),
+                        name=da.name, attrs=da.attrs)
+
+
+def save_map(da, title, path, how="mean", redraw=False, full_resolution=False, cmap='RdYlBu_r'):
+    """
+    Plot a 2D (lat, lon) DataArray with pyplot and save it to ``path``.
+
+    The map is coarsened with ``how`` as in ``display_map``, and is not
+    drawn again when ``path`` already shows the same data, title and
+    colours (see ``PlotCache``) unless ``redraw=True``.
+    """
+    cache = PlotCache()
+    shown = display_map(da, how, full_resolution)
+    key = plot_key(shown, title=title, cmap=cmap)
+    if redraw or not cache.fresh(path, key):
+        qm = shown.plot(cmap=cmap)          # xarray returns an Axes object
+        ax = qm.axes
+        ax.set_title(title)
+        ax.figure.savefig(path, bbox_inches='tight')
+        plt.close(ax.figure)
+        cache.record(path, key)
+        cache.save()
+    return path
+
+
+def series_frames(da, dim):
+    """
+    The frames of ``da`` along ``dim`` as a (frame, lat, lon) float array,
+    with the latitude and longitude values to draw them on.
+    """
+    lat = "lat" if "lat" in da.coords else "latitude"
+    lon = "lon" if "lon" in da.coords else "longitude"
+    da = da.transpose(dim, lat, lon)
+    return np.asarray(da.values, dtype=float), da[lat].values, da[lon].values
+
+
+class FrameRenderer:
+    """
+    A map figure built once and redrawn for every frame of a series.
+
+    The figure, axes, mesh and colorbar are created once; every frame only
+    replaces the mesh colours (``set_array``) and the title text, which is
+    far cheaper than building a new figure. Uses the Agg canvas directly,
+    with no pyplot state, so it is safe in any process.
+
+    Grids with more cells than the saved figure has pixels are
+    block-reduced with ``coarsen`` ("mean", "min" or "max") before drawing,
+    unless ``full_resolution=True``.
+    """
+
+    def __init__(self, lons, lats, vmin, vmax, cmap="RdYlBu_r", label="", dpi=150,
+                 coarsen="mean", full_resolution=False):
+        self.dpi = dpi
+        self.fig = Figure()
+        self.canvas = FigureCanvasAgg(self.fig)
+        self.coarsen = coarsen
+        self.factors = (1, 1)
+        if not full_resolution:
+            self.factors = display_factors((len(lats), len(lons)), axes_pixels(self.fig, dpi))
+            lats, lons = coarsen_coords(lats, lons, self.factors)
+        ax = self.fig.add_subplot()
+        empty = np.full((len(lats), len(lons)), np.nan)
+        self.mesh = ax.pcolormesh(lons, lats, empty, shading="auto", vmin=vmin, vmax=vmax, cmap=cmap)
+        cbar = self.fig.colorbar(self.mesh, ax=ax, orientation="vertical")
+        cbar.set_label(label)
+        ax.set_xlabel('Longitude')
+        ax.set_ylabel('Latitude')
+        self.title = ax.set_title("")
+
+    def draw(self, frame, title):
+        frame = block_reduce(frame, self.factors, self.coarsen)
+        self.mesh.set_array(np.ma.masked_invalid(frame))
+        self.title.set_text(title)
+
+    def save(self, frame, title, path, **kwargs):
+        self.draw(frame, title)
+        self.fig.savefig(path, dpi=self.dpi, bbox_inches="tight", **kwargs)
+
+    def rgb(self, frame, title):
+        """The frame drawn as an (height, width, 3) uint8 image."""
+        self.draw(frame, title)
+        self.canvas.draw()
+        return np.asarray(self.canvas.buffer_rgba())[..., :3].copy()
+
+
+def _render(frames, lons, lats, titles, paths, vmin, vmax, cmap, label, dpi, coarsen,
+            full_resolution, on_frame=None):
+    renderer = FrameRenderer(lons, lats, vmin, vmax, cmap, label, dpi, coarsen, full_resolution)
+    for frame, title, path in zip(frames, titles, paths):
+        renderer.save(frame, title, path)
+        if on_frame is not None:
+            on_frame(1)
+    return len(paths)
+
+
+def _render_slice(frames_path, i0, i1, lons, lats, titles, paths, style):
+    # worker: map the frames file and draw frames [i0, i1)
+    frames = np.load(frames_path, mmap_mode="r")
+    return _render(frames[i0:i1], lons, lats, titles, paths, **style)
+
+
+def render_frames(frames, lons, lats, titles, paths, vmin=None, vmax=None, cmap="RdYlBu_r",
+                  label="", dpi=150, n_workers=None, progress=True, redraw=False, coarsen="mean",
+                  full_resolution=False):
+    """
+    Draw every frame of a (frame, lat, lon) array to its own image file.
+
+    The frames are written once to a memory-mapped file that a pool of
+    ``n_workers`` headless (Agg) processes reads from, each drawing a slice
+    of the frames (all cores by default; 1 draws in this process). A
+    progress bar replaces per-frame messages. Colours span ``vmin`` to
+    ``vmax``, by default the range of the whole series.
+
+    Frames whose file already holds the same data, title and style (see
+    ``PlotCache``) are skipped unless ``redraw=True``.
+
+    Grids denser than the image are block-reduced with ``coarsen`` to one
+    cell per pixel (see ``FrameRenderer``); ``full_resolution=True`` draws
+    every cell.
+
+    Returns
+    -------
+    list of str
+        The paths of the series, whether drawn now or before.
+    """
+    if vmin is None:
+        vmin = float(np.nanmin(frames))
+    if vmax is None:
+        vmax = float(np.nanmax(frames))
+    style = dict(vmin=vmin, vmax=vmax, cmap=cmap, label=label, dpi=dpi, coarsen=coarsen,
+                 full_resolution=full_resolution)
+
+    cache = PlotCache()
+    keys = [plot_key(frame, lons, lats, title=title, **style) for frame, title in zip(frames, titles)]
+    stale = [i for i, (path, key) in enumerate(zip(paths, keys)) if redraw or not cache.fresh(path, key)]
+    _draw_frames(np.asarray(frames)[stale], lons, lats, [titles[i] for i in stale],
+                 [paths[i] for i in stale], style, n_workers, progress)
+    for i in stale:
+        cache.record(paths[i], keys[i])
+    cache.save()
+    return list(paths)
+
+
+def _draw_frames(frames, lons, lats, titles, paths, style, n_workers, progress):
+    n = len(paths)
+    if n == 0:
+        return
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    n_workers = max(min(n_workers, n), 1)
+
+    with tqdm(total=n, desc="rendering", unit="fig", disable=not progress) as bar:
+        if n_workers == 1:
+            _render(frames, lons, lats, titles, paths, on_frame=bar.update, **style)
+            return
+
+        tmpdir = tempfile.mkdtemp(prefix="frames-")
+        try:
+            frames_path = os.path.join(tmpdir, "frames.npy")
+            stored = np.lib.format.open_memmap(frames_path, mode="w+", dtype=np.float32,
+                                               shape=np.shape(frames))
+            stored[...] = frames
+            stored.flush()
+            del stored
+
+            # a few slices per worker keeps the pool busy to the end
+            step = max(-(-n // (n_workers * 4)), 1)
+            with ProcessPoolExecutor(n_workers, mp_context=pool_context()) as pool:
+                futures = [pool.submit(_render_slice, frames_path, i, min(i + step, n), lons, lats,
+                                       titles[i:i + step], paths[i:i + step], style)
+                           for i in range(0, n, step)]
+                for future in as_completed(futures):
+                    bar.update(future.result())
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def write_animation(frames, lons, lats, titles, path, vmin=None, vmax=None, cmap="RdYlBu_r",
+                    label="", dpi=100, duration=500, progress=True, redraw=False, coarsen="mean",
+                    full_resolution=False):
+    """
+    Draw every frame into a single file: an animated GIF (through Pillow,
+    ``duration`` milliseconds per frame) or a multi-page PDF, chosen by the
+    extension of ``path``. One figure is reused for every frame. Skipped
+    when the file already holds the same frames (see ``PlotCache``) unless
+    ``redraw=True``. Dense grids are coarsened as in ``render_frames``.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in (".gif", ".pdf"):
+        raise ValueError(f"combined output must be a .gif or .pdf file, not {path!r}")
+    if vmin is None:
+        vmin = float(np.nanmin(frames))
+    if vmax is None:
+        vmax = float(np.nanmax(frames))
+    cache = PlotCache()
+    key = plot_key(frames, lons, lats, titles=list(titles), vmin=vmin, vmax=vmax, cmap=cmap,
+                   label=label, dpi=dpi, duration=duration, coarsen=coarsen,
+                   full_resolution=full_resolution)
+    if not redraw and cache.fresh(path, key):
+        return path
+
+    renderer = FrameRenderer(lons, lats, vmin, vmax, cmap, label, dpi, coarsen, full_resolution)
+    frames_and_titles = tqdm(list(zip(frames, titles)), desc="rendering", unit="fig", disable=not progress)
+
+    if ext == ".pdf":
+        with PdfPages(path) as pdf:
+            for frame, title in frames_and_titles:
+                renderer.draw(frame, title)
+                pdf.savefig(renderer.fig, bbox_inches="tight")
+    else:
+        images = [Image.fromarray(renderer.rgb(frame, title)) for frame, title in frames_and_titles]
+        images[0].save(path, save_all=True, append_images=images[1:], duration=duration, loop=0)
+    cache.record(path, key)
+    cache.save()
+    return path
+
+
+def render_series(da, dim, titles, paths=None, label="", n_workers=None, output=None,
+                  redraw=False, **style):
+    """
+    ``render_frames`` for the frames of a DataArray along ``dim``, or, when
+    ``output`` (a .gif or .pdf path) is given, ``write_animation`` into that
+    single file.
+    """
+    frames, lats, lons = series_frames(da, dim)
+    if output is not None:
+        return [write_animation(frames, lons, lats, list(titles), output, label=label,
+                                redraw=redraw, **style)]
+    return render_frames(frames, lons, lats, list(titles), list(paths), label=label,
+                         n_workers=n_workers, redraw=redraw, **style)
@@ -0,0 +1,259 @@
+import os
+import numpy as np
+import pandas as pd
+import xarray as xr
+from simple_climate_package.aggregate import bin_labels, reduce_bins, runs
+from simple_climate_package.climatology import add_slot_sums, day_slots
+from simple_climate_package.linear_regression import regress_annual
+from simple_climate_package.loader import DataReader
+from simple_climate_package.stats import time_block_size
+
+###Saved accumulators that can be updated with newly released days###
+
+
+class StatsState:
+    """
+    Running sums, counts, minima and maxima behind the CalcMean, CalcExtremes
+    and LinReg products, saved between runs.
+
+    Everything is accumulated per calendar month (plus per day-of-year slot
+    for the daily climatology). Means, yearly and monthly extremes, monthly
+    and daily climatologies and the yearly regression all follow from these
+    accumulators, so ``update`` only has to read days that are newer than
+    the last one already folded in.
+
+    Example
+    -------
+    >>> state = StatsState.load_or_create('tg_state.nc', varname='tg')
+    >>> state.update('tg_ens_mean_0.1deg_reg_v30.0e.nc')
+    >>> state.save('tg_state.nc')
+    >>> trend = state.regression()
+    """
+
+    def __init__(self, varname='tg', drop_feb29=True):
+        self.varname = varname
+        self.drop_feb29 = drop_feb29
+        self.last_time = None
+        self.months = np.array([], dtype="datetime64[M]")
+        self.month_sum = None       # (month, *grid) arrays
+        self.month_count = None
+        self.month_min = None
+        self.month_max = None
+        self.clim_sum = None        # (dayofyear, *grid) arrays
+        self.clim_count = None
+        self.grid = None            # DataArray holding the grid dims and coords
+
+    # ----- persistence -----
+    def save(self, path):
+        if self.grid is None:
+            raise ValueError("nothing to save: the state has not been updated with any data")
+        month_dims = ("month",) + self.grid.dims
+        clim_dims = ("dayofyear",) + self.grid.dims
+        ds = xr.Dataset(
+            {
+                "month_sum": (month_dims, self.month_sum),
+                "month_count": (month_dims, self.month_count),
+                "month_min": (month_dims, self.month_min),
+                "month_max": (month_dims, self.month_max),
+                "clim_sum": (clim_dims, self.clim_sum),
+                "clim_count": (clim_dims, self.clim_count),
+            },
+            coords={"month": self.months.astype("datetime64[ns]"), **self.grid.coords},
+            attrs={"varname": self.varname, "drop_feb29": int(self.drop_feb29),
+                   "last_time": str(self.last_time)},
+        )
+        tmp = f"{path}.tmp"
+        ds.to_netcdf(tmp)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        ds = xr.load_dataset(path)
+        state = cls(ds.attrs["varname"], bool(ds.attrs["drop_feb29"]))
+        state.last_time = np.datetime64(ds.attrs["last_time"])
+        state.months = ds["month"].values.astype("datetime64[M]")
+        for name in ("month_sum", "month_count", "month_min", "month_max", "clim_sum", "clim_count"):
+            setattr(state, name, ds[name].values)
+        state.grid = ds["month_sum"].isel(month=0, drop=True)
+        return state
+
+    @classmethod
+    def load_or_create(cls, path, varname='tg', drop_feb29=True):
+        if os.path.exists(path):
+            return cls.load(path)
+        return cls(varname, drop_feb29)
+
+    # ----- folding in new data -----
+    def update(self, source, time_range=None, block_size=None, memory_budget=None):
+        """
+        Fold new days into the state.
+
+        Parameters
+        ----------
+        source : str | xr.DataArray
+            A data file (or a DataArray) holding the new days. Days up to the
+            last one already in the state are skipped, so passing the full,
+            extended record of a new release is fine.
+        time_range : (start, end), optional
+            Only consider this window of ``source``.
+        block_size : int, optional
+            Days read per block (rounded to whole months); by default sized
+            from ``memory_budget``.
+        memory_budget : int | str, optional
+            Memory allowed for one block, e.g. "2GB", also passed to the
+            file reader. Defaults to half of the available RAM.
+
+        Returns
+        -------
+        int
+            Number of days folded in.
+        """
+        if isinstance(source, xr.DataArray):
+            da = source if time_range is None else source.sel(time=slice(*time_range))
+        else:
+            reader = DataReader(str(source), time_range=time_range, memory_budget=memory_budget)
+            da = reader.read()[self.varname]
+        da = da.transpose("time", ...)
+        if self.last_time is not None:
+            da = da.isel(time=np.flatnonzero(da["time"].values > self.last_time))
+        if da.sizes["time"] == 0:
+            return 0
+
+        grid = da.isel(time=0, drop=True)
+        if self.grid is None:
+            self._start(grid)
+        else:
+            self._check_grid(grid)
+
+        times = da["time"].values
+        months = times.astype("datetime64[M]")
+        starts = runs(months)
+        slots, _, feb29 = day_slots(times, self.drop_feb29)
+        use = ~feb29 if self.drop_feb29 else np.ones(len(times), dtype=bool)
+        if block_size is None:
+            block_size = time_block_size(da, memory_budget)
+
+        # read whole months at a time, at least one month per block, and fold
+        # each block into both the month and the day-of-year accumulators
+        i = 0
+        while i < len(starts):
+            j = i + 1
+            while j < len(starts) and starts[j] - starts[i] < block_size:
+                j += 1
+            t0 = starts[i]
+            t1 = starts[j] if j < len(starts) else len(times)
+            block = np.asarray(da.isel(time=slice(t0, t1)).values, dtype=float)
+            self._fold_months(months[starts[i:j]], block, starts[i:j] - t0)
+            add_slot_sums(self.clim_sum, self.clim_count, block, slots[t0:t1], use[t0:t1])
+            i = j
+
+        self.last_time = times[-1]
+        return len(times)
+
+    def _start(self, grid):
+        self.grid = grid
+        shape = (0,) + grid.shape
+        self.month_sum = np.zeros(shape)
+        self.month_count = np.zeros(shape, dtype=np.int64)
+        self.month_min = np.zeros(shape)
+        self.month_max = np.zeros(shape)
+        n_slots = 365 if self.drop_feb29 else 366
+        self.clim_sum = np.zeros((n_slots,) + grid.shape)
+        self.clim_count = np.zeros((n_slots,) + grid.shape, dtype=np.int64)
+
+    def _check_grid(self, grid):
+        if grid.dims != self.grid.dims or grid.shape != self.grid.shape:
+            raise ValueError(f"new data has grid {dict(grid.sizes)}, state has {dict(self.grid.sizes)}")
+        for dim in grid.dims:
+            if not np.allclose(grid[dim].values, self.grid[dim].values):
+                raise ValueError(f"new data has different {dim} coordinates than the state")
+
+    def _fold_months(self, months, block, starts):
+        sums, counts, mins, maxs = reduce_bins(block, starts)
+
+        # the last stored month may be incomplete: merge rather than append
+        if len(self.months) and months[0] == self.months[-1]:
+            self.month_sum[-1] += sums[0]
+            self.month_count[-1] += counts[0]
+            self.month_min[-1] = np.fmin(self.month_min[-1], mins[0])
+            self.month_max[-1] = np.fmax(self.month_max[-1], maxs[0])
+            months, sums, counts, mins, maxs = months[1:], sums[1:], counts[1:], mins[1:], maxs[1:]
+
+        self.months = np.concatenate([self.months, months])
+        self.month_sum = np.concatenate([self.month_sum, sums])
+        self.month_count = np.concatenate([self.month_count, counts])
+        self.month_min = np.concatenate([self.month_min, mins])
+        self.month_max = np.concatenate([self.month_max, maxs])
+
+    # ----- products -----
+    def _wrap(self, data, dim, labels):
+        return xr.DataArray(data, dims=(dim,) + self.grid.dims,
+                            coords={dim: labels, **self.grid.coords}, name=self.varname)
+
+    @staticmethod
+    def _mean(sums, counts):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(counts > 0, sums / counts, np.nan)
+
+    def _by_year(self):
+        years = self.months.astype("datetime64[Y]")
+        starts = runs(years)
+        with np.errstate(invalid="ignore"):
+            return (years[starts],
+                    np.add.reduceat(self.month_sum, starts, axis=0),
+                    np.add.reduceat(self.month_count, starts, axis=0),
+                    np.fmin.reduceat(self.month_min, starts, axis=0),
+                    np.fmax.reduceat(self.month_max, starts, axis=0))
+
+    def _month_end_labels(self):
+        return bin_labels(self.months)
+
+    @staticmethod
+    def _year_end_labels(years):
+        return bin_labels(years)
+
+    def mean_tot(self):
+        mean = self._mean(self.month_sum.sum(axis=0), self.month_count.sum(axis=0))
+        return self.grid.copy(data=mean).rename(self.varname)
+
+    def monthly_mean(self):
+        return self._wrap(self._mean(self.month_sum, self.month_count), "time", self._month_end_labels())
+
+    def monthly_max(self):
+        return self._wrap(self.month_max, "time", self._month_end_labels())
+
+    def monthly_min(self):
+        return self._wrap(self.month_min, "time", self._month_end_labels())
+
+    def yearly_mean(self):
+        years, sums, counts, _, _ = self._by_year()
+        return self._wrap(self._mean(sums, counts), "time", self._year_end_labels(years))
+
+    def yearly_max(self):
+        years, _, _, _, maxs = self._by_year()
+        return self._wrap(maxs, "time", self._year_end_labels(years))
+
+    def yearly_min(self):
+        years, _, _, mins, _ = self._by_year()
+        return self._wrap(mins, "time", self._year_end_labels(years))
+
+    def monthly_clim(self):
+        month_of_year = pd.DatetimeIndex(self.months.astype("datetime64[ns]")).month.values - 1
+        sums = np.zeros((12,) + self.grid.shape)
+        counts = np.zeros((12,) + self.grid.shape, dtype=np.int64)
+        np.add.at(sums, month_of_year, self.month_sum)
+        np.add.at(counts, month_of_year, self.month_count)
+        present = np.unique(month_of_year)
+        return self._wrap(self._mean(sums, counts)[present], "month", present + 1)
+
+    def daily_clim(self):
+        clim = self._mean(self.clim_sum, self.clim_count)
+        return self._wrap(clim, "dayofyear", np.arange(1, clim.shape[0] + 1))
+
+    def regression(self, min_obs=3):
+        """Yearly-mean regression on calendar year, as LinReg.grid_linear_regression."""
+        years, sums, counts, _, _ = self._by_year()
+        annual = self._wrap(self._mean(sums, counts), "time", years.astype("datetime64[ns]"))
+        lat = "lat" if "lat" in self.grid.dims else "latitude"
+        lon = "lon" if "lon" in self.grid.dims else "longitude"
+        return regress_annual(annual, lat, lon, min_obs=min_obs)
@@ -0,0 +1,148 @@
+from collections import OrderedDict
+import threading
+import numpy as np
+import xarray as xr
+from simple_climate_package.loader import default_memory_budget, plan_chunks
+
+###Single-pass statistics over the time axis###
+
+# summaries already computed in this process, shared by CalcMean and CalcExtremes
+_SUMMARIES = OrderedDict()
+_SUMMARIES_MAXSIZE = 32
+_LOCK = threading.Lock()
+
+
+def time_block_size(da, memory_budget=None, time_dim="time"):
+    """Number of time steps per block so a float64 block fits the memory budget."""
+    budget = memory_budget if memory_budget is not None else default_memory_budget()
+    return plan_chunks(dict(da.sizes), da.dtype.itemsize, budget, "reduce", time_dim)[time_dim]
+
+
+def time_summary(da, block_size=None, memory_budget=None, time_dim="time"):
+    """
+    Compute min, max, mean, std, valid count and the dates of the min and
+    max for every grid cell in one pass over the time axis.
+
+    The time axis is read in blocks of ``block_size`` steps (chosen from
+    ``memory_budget`` when not given), so lazily opened or dask-backed data
+    is only decoded once and never held in memory as a whole. Means and
+    variances are merged between blocks with Chan's parallel update.
+    NaNs are skipped, matching ``da.min(dim='time')`` and friends.
+
+    Returns
+    -------
+    xr.Dataset
+        Variables ``min``, ``max``, ``mean``, ``std`` (ddof=0), ``count``,
+        ``time_of_min`` and ``time_of_max`` on the non-time dimensions of ``da``.
+    """
+    da = da.transpose(time_dim, ...)
+    T = da.sizes[time_dim]
+    shape = da.shape[1:]
+    if block_size is None:
+        block_size = time_block_size(da, memory_budget, time_dim)
+
+    count = np.zeros(shape, dtype=np.int64)
+    mean = np.zeros(shape, dtype=float)
+    m2 = np.zeros(shape, dtype=float)
+    vmin = np.full(shape, np.inf)
+    vmax = np.full(shape, -np.inf)
+    imin = np.full(shape, -1, dtype=np.int64)
+    imax = np.full(shape, -1, dtype=np.int64)
+
+    for i0 in range(0, T, block_size):
+        block = np.asarray(da.isel({time_dim: slice(i0, i0 + block_size)}).values, dtype=float)
+        valid = ~np.isnan(block)
+        n_b = valid.sum(axis=0)
+
+        # block mean and sum of squared deviations
+        sum_b = np.where(valid, block, 0.0).sum(axis=0)
+        mean_b = np.divide(sum_b, n_b, out=np.zeros(shape), where=n_b > 0)
+        m2_b = (np.where(valid, block - mean_b, 0.0) ** 2).sum(axis=0)
+
+        # merge into the running totals (Chan et al.)
+        n_ab = count + n_b
+        delta = mean_b - mean
+        w = np.divide(n_b, n_ab, out=np.zeros(shape), where=n_ab > 0)
+        mean += delta * w
+        m2 += m2_b + delta * delta * count * w
+        count = n_ab
+
+        # strict comparisons keep the first occurrence, like idxmin/idxmax
+        lo = np.where(valid, block, np.inf)
+        a = lo.argmin(axis=0)
+        bmin = np.take_along_axis(lo, a[None], axis=0)[0]
+        better = bmin < vmin
+        vmin[better] = bmin[better]
+        imin[better] = a[better] + i0
+
+        hi = np.where(valid, block, -np.inf)
+        a = hi.argmax(axis=0)
+        bmax = np.take_along_axis(hi, a[None], axis=0)[0]
+        better = bmax > vmax
+        vmax[better] = bmax[better]
+        imax[better] = a[better] + i0
+
+    empty = count == 0
+    out_dtype = da.dtype if np.issubdtype(da.dtype, np.floating) else np.dtype(float)
+    mean[empty] = np.nan
+    std = np.sqrt(np.divide(m2, count, out=np.full(shape, np.nan), where=~empty))
+    vmin[empty] = np.nan
+    vmax[empty] = np.nan
+
+    times = da[time_dim].values
+    time_of_min = np.where(empty, np.datetime64("NaT"), times[np.maximum(imin, 0)])
+    time_of_max = np.where(empty, np.datetime64("NaT"), times[np.maximum(imax, 0)])
+
+    dims = da.dims[1:]
+    coords = da.isel({time_dim: 0}, drop=True).coords
+    return xr.Dataset(
+        {
+            "min": (dims, vmin.astype(out_dtype)),
+            "max": (dims, vmax.astype(out_dtype)),
+            "mean": (dims, mean.astype(out_dtype)),
+            "std": (dims, std.astype(out_dtype)),
+            "count": (dims, count),
+            "time_of_min": (dims, time_of_min),
+            "time_of_max": (dims, time_of_max),
+        },
+        coords=coords,
+    )
+
+
+def cached_time_summary(key, da, **kwargs):
+    """
+    ``time_summary`` memoised under ``key`` for the life of the process.
+
+    Analysis classes pass a key built from their reader's ``data_key()``, so
+    a CalcMean and a CalcExtremes on the same data share a single pass.
+    Callers get a copy, so editing it in place leaves the cache intact.
+    """
+    with _LOCK:
+        if key in _SUMMARIES:
+            _SUMMARIES.move_to_end(key)
+            return _SUMMARIES[key].copy(deep=True)
+    summary = time_summary(da, **kwargs)
+    with _LOCK:
+        _SUMMARIES[key] = summary
+        while len(_SUMMARIES) > _SUMMARIES_MAXSIZE:
+            _SUMMARIES.popitem(last=False)
+    return summary.copy(deep=True)
+
+
+class TimeSummaryMixin:
+    """
+    ``summary`` for analysis classes holding a daily ``tg`` DataArray and a
+    ``reader`` (CalcMean, CalcExtremes).
+    """
+
+    def summary(self, start=None, end=None):
+        """
+        Min, max, mean, std, valid count and the dates of the min and max for
+        every grid pixel (optionally between two dates), computed in one pass
+        over the time axis. The result is shared with every other analysis
+        class reading the same data, so asking for several statistics costs
+        a single scan.
+        """
+        selected_data = self.tg if start is None and end is None else self.tg.sel(time=slice(start, end))
+        key = (self.reader.data_key(), self.tg.name, start, end)
+        return cached_time_summary(key, selected_data, memory_budget=self.reader.memory_budget)
@@ -0,0 +1,154 @@
+import os
+import numpy as np
+import xarray as xr
+from scipy.stats import norm
+from simple_climate_package._parallel import map_columns
+from simple_climate_package.linear_regression import LinReg
+from simple_climate_package.loader import default_memory_budget, parse_memory
+
+###Mann-Kendall test and Theil-Sen slope for every grid point###
+
+# float64 (pairs, tile) temporaries alive at once while a tile is reduced
+_TEMPORARIES_PER_TILE = 3
+
+
+def _tie_sum(Y):
+    """
+    Sum over groups of tied values of t(t-1)(2t+5), per column, for the
+    Mann-Kendall variance. A value in position r of a run of ties adds
+    g(r+1) - g(r) with g(t) = t(t-1)(2t+5), so no run lengths are needed.
+    """
+    s = np.sort(Y, axis=0)  # NaNs sort last
+    T = s.shape[0]
+    start = np.ones(s.shape, dtype=bool)
+    start[1:] = s[1:] != s[:-1]
+    pos = np.arange(T).reshape(-1, 1)
+    r = pos - np.maximum.accumulate(np.where(start, pos, 0), axis=0)
+    g = lambda t: t * (t - 1) * (2 * t + 5)
+    return np.where(np.isnan(s), 0, g(r + 1) - g(r)).sum(axis=0)
+
+
+def mann_kendall_theil_sen(Y, x, min_obs=3):
+    """
+    Mann-Kendall test and Theil-Sen slope for every column of ``Y``
+    (time, N) against ``x`` (time,), skipping NaNs.
+
+    All pairs i < j are formed at once for the whole block of columns: the
+    S statistic is the sum of their signs and the slope is the median of
+    their slopes, with the intercept the median of ``y - slope * x``. The
+    variance of S is corrected for ties and the p-value comes from the
+    continuity-corrected normal approximation.
+
+    Returns
+    -------
+    dict of np.ndarray, shape (N,)
+        slope, intercept, z (Mann-Kendall Z), p_value, s (S statistic), tau
+        (Kendall's tau-a), r2, rmse and n_obs.
+    """
+    Y = np.asarray(Y, dtype=float)
+    n = (~np.isnan(Y)).sum(axis=0).astype(float)
+    i, j = np.triu_indices(Y.shape[0], k=1)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        dy = Y[j] - Y[i]
+        s = np.nansum(np.sign(dy), axis=0)
+        dy /= (x[j] - x[i]).reshape(-1, 1)
+        slope = _nanmedian(dy)
+        del dy
+        intercept = _nanmedian(Y - slope * x.reshape(-1, 1))
+
+        var_s = (n * (n - 1) * (2 * n + 5) - _tie_sum(Y)) / 18.0
+        z = np.where(s > 0, s - 1, np.where(s < 0, s + 1, 0.0)) / np.sqrt(var_s)
+        p_value = 2.0 * norm.sf(np.abs(z))
+        tau = s / (n * (n - 1) / 2.0)
+
+        # goodness of fit of the Theil-Sen line
+        resid = Y - (intercept + slope * x.reshape(-1, 1))
+        ssr = np.nansum(resid ** 2, axis=0)
+        sst = np.nansum((Y - np.nanmean(Y, axis=0)) ** 2, axis=0)
+        r2 = 1.0 - ssr / sst
+        rmse = np.sqrt(ssr / n)
+
+    out = {"slope": slope, "intercept": intercept, "z": z, "p_value": p_value,
+           "s": s, "tau": tau, "r2": r2, "rmse": rmse}
+    bad = n < min_obs
+    for v in out.values():
+        v[bad] = np.nan
+    out["n_obs"] = n
+    return out
+
+
+def _nanmedian(a):
+    # np.nanmedian warns on all-NaN columns; those are masked by min_obs anyway
+    with np.errstate(invalid="ignore"):
+        out = np.full(a.shape[1], np.nan)
+        some = ~np.isnan(a).all(axis=0)
+        if some.any():
+            out[some] = np.nanmedian(a[:, some], axis=0)
+    return out
+
+
+class CalcTrend(LinReg):
+    """
+    Non-parametric trends: Mann-Kendall significance and Theil-Sen slope per
+    grid point on yearly data, returned in the same layout as
+    ``LinReg.grid_linear_regression``.
+
+    Example
+    -------
+    >>> tr = CalcTrend(data_path)
+    >>> trend = tr.grid_trend(n_workers=4)
+    """
+
+    def grid_trend(self, min_obs=3, n_workers=None, max_memory=None, tile_size=None):
+        """
+        Mann-Kendall test and Theil-Sen slope for each grid point on the
+        yearly means (see ``make_yearly``).
+
+        It returns the same variables as ``grid_linear_regression``: slope,
+        intercept, t_stat, p_value, r2, rmse, n_obs, per_decade and
+        total_change, where slope is the Theil-Sen slope per year, t_stat
+        holds the Mann-Kendall Z and p_value its two-sided p-value. The
+        Mann-Kendall S and Kendall's tau are added as ``s_stat`` and ``tau``.
+
+        Grid points are split into tiles of ``tile_size`` columns (chosen so
+        each worker's pairwise slopes fit in ``max_memory`` divided between
+        the workers) and spread over ``n_workers`` processes (all cores by
+        default; 1 runs in this process). ``max_memory`` defaults to the
+        ``memory_budget`` given to CalcTrend.
+        """
+        if self.annual is None:
+            self.make_yearly()
+
+        da = self.annual.transpose("time", self.lat, self.lon)
+        years = da["time"].dt.year.values.astype(float)
+        T, ny, nx = da.shape
+        Y = np.ascontiguousarray(da.values.reshape(T, ny * nx), dtype=float)
+
+        if tile_size is None:
+            # the reader's budget unless one is given, shared by every worker process
+            max_memory = self._max_memory(max_memory)
+            budget = parse_memory(max_memory) if max_memory is not None else default_memory_budget()
+            n_pairs = max(T * (T - 1) // 2, 1)
+            workers = n_workers if n_workers is not None else os.cpu_count() or 1
+            per_worker = budget // max(workers, 1)
+            tile_size = max(per_worker // (_TEMPORARIES_PER_TILE * 8 * n_pairs), 1)
+
+        names = ("slope", "intercept", "z", "p_value", "s", "tau", "r2", "rmse", "n_obs")
+        out = {k: np.full(ny * nx, np.nan) for k in names}
+        for c0, c1, tile in map_columns(mann_kendall_theil_sen, Y, tile_size, n_workers,
+                                        x=years, min_obs=min_obs):
+            for k in names:
+                out[k][c0:c1] = tile[k]
+
+        out["t_stat"] = out.pop("z")
+        out["s_stat"] = out.pop("s")
+        out["per_decade"] = out["slope"] * 10.0
+        out["total_change"] = out["slope"] * (years[-1] - years[0])
+        order = ("slope", "intercept", "t_stat", "p_value", "r2", "rmse", "n_obs",
+                 "per_decade", "total_change", "s_stat", "tau")
+        self.results = xr.Dataset(
+            {k: ((self.lat, self.lon), out[k].reshape(ny, nx)) for k in order},
+            coords={self.lat: da.coords[self.lat].values, self.lon: da.coords[self.lon].values},
+        )
+        return self.results
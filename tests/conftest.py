@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+from tests.sample_data import make_sample_era5_tg
+
+
+@pytest.fixture
+def sample_tg_dataset():
+    """The two-year 3x3 sample of daily ERA5 2m temperature."""
+    return make_sample_era5_tg()
+
+
+@pytest.fixture
+def sample_file(tmp_path, sample_tg_dataset):
+    """``sample_tg_dataset`` written to a NetCDF file in the test's temporary folder."""
+    p = tmp_path / "sample.nc"
+    sample_tg_dataset.to_netcdf(p)
+    return str(p)
+
+
+@pytest.fixture
+def sample_tg_gaps_dataset(sample_tg_dataset):
+    """``sample_tg_dataset`` with a run of missing days at one pixel and one pixel with no data at all."""
+    ds = sample_tg_dataset.copy(deep=True)
+    ds["tg"][5:40, 0, 1] = np.nan
+    ds["tg"][:, 2, 2] = np.nan
+    return ds
+
+
+@pytest.fixture
+def sample_gaps_file(tmp_path, sample_tg_gaps_dataset):
+    """``sample_tg_gaps_dataset`` written to a NetCDF file in the test's temporary folder."""
+    p = tmp_path / "sample_gaps.nc"
+    sample_tg_gaps_dataset.to_netcdf(p)
+    return str(p)
@@ -0,0 +1,41 @@
+import numpy as np
+import xarray as xr
+import pytest
+
+from simple_climate_package.aggregate import aggregate
+
+
+@pytest.fixture
+def sample_tg(sample_tg_dataset):
+    tg = sample_tg_dataset["tg"]
+    tg[40:45, 0, 0] = np.nan
+    # 1-25 March 2020 are missing for one pixel
+    tg[60:85, 1, 1] = np.nan
+    return tg
+
+
+@pytest.mark.parametrize("how", ["mean", "sum", "count", "min", "max"])
+@pytest.mark.parametrize("freq,rule", [("month", "1ME"), ("year", "1YE")])
+def test_aggregate_matches_resample(sample_tg, how, freq, rule):
+    # a small block size makes bins span several reads
+    got = aggregate(sample_tg, freq, how, block_size=45)
+    expected = getattr(sample_tg.resample(time=rule), how)()
+    xr.testing.assert_allclose(got.astype(float), expected.astype(float))
+
+
+def test_aggregate_start_labels_and_completeness(sample_tg):
+    yearly = aggregate(sample_tg, "year", "mean", label="start")
+    assert [str(t)[:10] for t in yearly.time.values] == ["2020-01-01", "2021-01-01"]
+
+    monthly = aggregate(sample_tg, "month", "mean", min_fraction=0.5)
+    march = monthly.sel(time="2020-03-31")
+    assert np.isnan(march.values[1, 1])
+    assert not np.isnan(march.values[0, 0])
+
+
+@pytest.mark.parametrize("how", ["mean", "max"])
+def test_aggregate_seasons_match_resample(sample_tg, how):
+    got = aggregate(sample_tg, "season", how, label="start", block_size=45)
+    expected = getattr(sample_tg.resample(time="QS-DEC"), how)()
+    xr.testing.assert_allclose(got, expected)
+    assert str(got.time.values[0])[:10] == "2019-12-01"
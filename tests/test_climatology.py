@@ -0,0 +1,102 @@
+import gc
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import os
+import pandas as pd
+from pathlib import Path
+import xarray as xr
+
+from simple_climate_package import mean as mean_module
+from simple_climate_package.climatology import ClimatologyStore, day_slots
+from simple_climate_package.loader import _CACHE
+from simple_climate_package.mean import CalcMean
+
+
+def test_day_slots_align_calendar_dates():
+    times = pd.to_datetime(["2019-02-28", "2019-03-01", "2020-02-28", "2020-02-29",
+                            "2020-03-01", "2020-12-31", "2021-12-31"])
+    slots, n_slots, feb29 = day_slots(times)
+    assert n_slots == 365
+    assert list(slots) == [58, 59, 58, 58, 59, 364, 364]
+    assert list(feb29) == [False, False, False, True, False, False, False]
+
+    slots, n_slots, _ = day_slots(times, drop_feb29=False)
+    assert n_slots == 366
+    assert list(slots) == [58, 60, 58, 59, 60, 365, 365]
+
+
+def test_daily_anomalies_match_month_day_groups(sample_file: str, sample_tg_dataset: xr.Dataset):
+    tm = CalcMean(sample_file, varname="tg")
+
+    tg = sample_tg_dataset["tg"]
+    month_day = tg.time.dt.strftime("%m-%d")
+    not29 = month_day != "02-29"
+    # reference climatology: mean of every calendar date, Feb 29 excluded
+    ref_clim = tg.where(not29).groupby(month_day).mean(dim="time")
+    ref_clim_for = ref_clim.sel(strftime=xr.where(not29, month_day, "02-28")).drop_vars("strftime")
+    ref_anom = tg - ref_clim_for
+
+    clim = tm.daily_clim()
+    assert clim.sizes["dayofyear"] == 365
+    np.testing.assert_allclose(clim.values, ref_clim.drop_sel(strftime="02-29", errors="ignore").values)
+
+    anom = tm.daily_clim_Anom()
+    xr.testing.assert_allclose(anom.transpose(*ref_anom.dims), ref_anom)
+
+    dropped = tm.daily_clim_Anom(keep_feb29=False)
+    assert dropped.sizes["time"] == tg.sizes["time"] - 1
+
+    streamed = np.concatenate([block for _, block in tm.iter_daily_clim_Anom(block_size=50)])
+    np.testing.assert_allclose(streamed, anom.values)
+
+
+def test_climatology_store_reuses_and_invalidates(tmp_path: Path, sample_file: str,
+                                                  sample_tg_dataset: xr.Dataset, monkeypatch):
+    store = ClimatologyStore(tmp_path / "store")
+
+    first = CalcMean(sample_file, varname="tg", clim_store=store)
+    clim = first.daily_clim(baseline=("2020-01-01", "2020-12-31"))
+    monthly = first.monthly_clim()
+    assert len(store._read_manifest()) == 2
+
+    expected = sample_tg_dataset["tg"].sel(time=slice("2020-01-01", "2020-12-31"))
+    np.testing.assert_allclose(clim.sel(dayofyear=1).values, expected.isel(time=0).values)
+
+    # a new instance (or process) reads the stored climatology instead of recomputing
+    def fail(*args, **kwargs):
+        raise AssertionError("climatology was recomputed")
+    monkeypatch.setattr(mean_module, "daily_climatology", fail)
+    second = CalcMean(sample_file, varname="tg", clim_store=str(tmp_path / "store"))
+    xr.testing.assert_allclose(second.daily_clim(baseline=("2020-01-01", "2020-12-31")), clim)
+    xr.testing.assert_allclose(second.monthly_clim(), monthly)
+    monkeypatch.undo()
+
+    # rewriting the source replaces its stale entries
+    del first, second
+    gc.collect()
+    _CACHE.clear()
+    (sample_tg_dataset + 1.0).to_netcdf(sample_file)
+    third = CalcMean(sample_file, varname="tg", clim_store=store)
+    xr.testing.assert_allclose(third.monthly_clim(), monthly + 1.0)
+    assert len(store._read_manifest()) == 1
+
+
+def _fill_store(directory, worker, n):
+    store = ClimatologyStore(directory)
+    clim = xr.DataArray(np.full(12, float(worker)), dims="month", name="tg")
+    for i in range(n):
+        store.put(f"{worker}-{i}", clim, f"source-{worker}-{i}.nc", "checksum")
+
+
+def test_climatology_store_is_shared_between_processes(tmp_path: Path):
+    directory = str(tmp_path / "store")
+    with ProcessPoolExecutor(4) as pool:
+        for future in [pool.submit(_fill_store, directory, w, 20) for w in range(4)]:
+            future.result()
+
+    store = ClimatologyStore(directory)
+    manifest = store._read_manifest()
+    assert len(manifest) == 80
+    stored = {name for name in os.listdir(directory) if name.endswith(".nc")}
+    assert stored == {f"{key}.nc" for key in manifest}
+    assert float(store.get("3-19")[0]) == 3.0
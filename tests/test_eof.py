@@ -0,0 +1,149 @@
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+from numpy.testing import assert_allclose
+
+from simple_climate_package.eof import CalcEOF, randomized_svd
+
+
+def make_mode_dataset(path, seed=0):
+    """Daily data with a seasonal cycle, two spatial modes and noise; one cell is all NaN."""
+    rng = np.random.default_rng(seed)
+    times = pd.date_range("2000-01-01", "2009-12-31", freq="D")
+    lat = np.linspace(40.0, 60.0, 6)
+    lon = np.linspace(0.0, 25.0, 6)
+    Lat, Lon = np.meshgrid(lat, lon, indexing="ij")
+    p1 = np.cos(np.deg2rad(Lat - 50) * 9)
+    p2 = np.sin(np.deg2rad(Lon) * 7)
+    monthly = rng.normal(size=(120, 2)) * [3.0, 1.5]
+    month = np.asarray((times.year - 2000) * 12 + times.month - 1)
+    seasonal = 10 * np.sin(2 * np.pi * np.asarray(times.dayofyear) / 365.25)
+    data = (280 + seasonal[:, None, None] + monthly[month, 0, None, None] * p1
+            + monthly[month, 1, None, None] * p2 + 0.1 * rng.normal(size=(len(times), 6, 6)))
+    data[:, 0, 0] = np.nan
+    ds = xr.Dataset({"tg": (("time", "lat", "lon"), data)},
+                    coords={"time": times, "lat": lat, "lon": lon})
+    ds.to_netcdf(path)
+
+
+def test_randomized_svd_matches_full_svd():
+    rng = np.random.default_rng(1)
+    A = rng.normal(size=(200, 8)) @ (rng.normal(size=(8, 300)) * np.linspace(5, 1, 8)[:, None])
+    A += 0.01 * rng.normal(size=A.shape)
+    U, s, Vt = randomized_svd(A, 4, seed=0)
+    U_ref, s_ref, Vt_ref = np.linalg.svd(A, full_matrices=False)
+    assert_allclose(s, s_ref[:4], rtol=1e-8)
+    assert_allclose(np.abs(np.sum(Vt * Vt_ref[:4], axis=1)), 1.0, atol=1e-8)
+
+
+@pytest.fixture
+def eof_file(tmp_path):
+    p = tmp_path / "modes.nc"
+    make_mode_dataset(p)
+    return str(p)
+
+
+def test_eofs_match_full_decomposition(eof_file):
+    calc = CalcEOF(eof_file)
+    res = calc.eofs(n_modes=3)
+    assert res["eof"].dims == ("mode", "lat", "lon")
+    assert res["pc"].dims == ("time", "mode")
+    assert np.isnan(res["eof"].values[:, 0, 0]).all()
+
+    # reference: full SVD of the centred, weighted monthly anomalies
+    anom = calc.anomalies("monthly")
+    X = anom.values.reshape(anom.sizes["time"], -1)[:, 1:]
+    weights = np.sqrt(np.cos(np.deg2rad(anom["lat"].values)))[:, None].repeat(6, axis=1)
+    X = (X - X.mean(axis=0)) * weights.ravel()[1:]
+    _, s_ref, Vt_ref = np.linalg.svd(X, full_matrices=False)
+    assert_allclose(res["singular_values"].values, s_ref[:3], rtol=1e-8)
+    assert_allclose(res["explained_variance_ratio"].values, s_ref[:3] ** 2 / np.sum(s_ref ** 2), rtol=1e-8)
+    eof = res["eof"].values.reshape(3, -1)[:, 1:]
+    assert_allclose(np.abs(np.sum(eof * Vt_ref[:3], axis=1)), 1.0, atol=1e-8)
+
+    # two modes carry nearly all of the variance
+    assert res["explained_variance_ratio"].values[:2].sum() > 0.99
+    # the patterns and PCs rebuild the weighted anomalies
+    rebuilt = res["pc"].values @ eof
+    assert_allclose(rebuilt, X, atol=0.05 * np.abs(X).max())
+
+
+def test_streaming_eofs_match_in_memory(eof_file):
+    calc = CalcEOF(eof_file)
+    full = calc.eofs(n_modes=2, freq="daily")
+    stream = calc.eofs(n_modes=2, freq="daily", streaming=True, block_size=400)
+
+    assert np.isnan(stream["eof"].values[:, 0, 0]).all()
+    assert_allclose(stream["singular_values"], full["singular_values"], rtol=1e-6)
+    assert_allclose(stream["explained_variance_ratio"], full["explained_variance_ratio"], rtol=1e-6)
+    assert_allclose(stream["eof"], full["eof"], atol=1e-6)
+    assert_allclose(stream["pc"], full["pc"], atol=1e-5 * np.abs(full["pc"]).max())
+    assert_allclose(stream["mean"], full["mean"], atol=1e-10)
+
+
+def test_monthly_streaming_never_holds_the_monthly_anomalies(eof_file, monkeypatch):
+    calc = CalcEOF(eof_file)
+    full = calc.eofs(n_modes=2, freq="monthly")
+    expected = calc.anomalies("monthly")
+
+    calc = CalcEOF(eof_file)
+    monkeypatch.setattr(calc.calc_mean, "monthly_mean",
+                        lambda *args, **kwargs: pytest.fail("monthly means were built whole"))
+    blocks = list(calc.anomaly_blocks("monthly", block_size=100))
+    assert max(len(times) for times, _ in blocks) <= 4
+    assert_allclose(np.concatenate([b for _, b in blocks]), expected.values, atol=1e-10)
+    np.testing.assert_array_equal(np.concatenate([t for t, _ in blocks]), expected["time"].values)
+
+    stream = calc.eofs(n_modes=2, freq="monthly", streaming=True, block_size=400)
+    assert_allclose(stream["singular_values"], full["singular_values"], rtol=1e-6)
+    assert_allclose(stream["eof"], full["eof"], atol=1e-6)
+
+
+def test_basis_round_trip_and_projection(eof_file, tmp_path):
+    from simple_climate_package.eof import EOFBasis
+
+    calc = CalcEOF(eof_file)
+    res = calc.eofs(n_modes=2)
+    path = tmp_path / "basis.nc"
+    calc.basis().save(path)
+    basis = EOFBasis.load(path)
+    assert basis.patterns.dtype == np.float32
+    assert basis.patterns.shape == (2, 35)
+    assert basis.mask.shape == (6, 6) and not basis.mask[0, 0]
+
+    # projecting the original anomalies gives back the PCs
+    pcs = basis.project(calc.anomalies("monthly"), block_size=7)
+    assert pcs.dims == ("time", "mode")
+    assert_allclose(pcs.values, res["pc"].values, atol=1e-4 * np.abs(res["pc"].values).max())
+    streamed = calc.project(str(path), block_size=50)
+    assert_allclose(streamed.values, pcs.values, rtol=1e-5, atol=1e-5)
+
+
+def test_varimax_recovers_simple_structure():
+    from simple_climate_package.eof import varimax
+
+    simple = np.array([[1.0, 0.0], [0.9, 0.0], [0.0, 1.0], [0.0, 0.8], [0.0, 0.7]])
+    angle = np.deg2rad(30)
+    turn = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+    rotated, R, _, converged = varimax(simple @ turn)
+    assert converged
+    assert_allclose(R @ R.T, np.eye(2), atol=1e-12)
+    assert_allclose(np.abs(rotated), simple, atol=1e-6)
+
+
+def test_rotate_keeps_layout_and_reconstruction(eof_file):
+    calc = CalcEOF(eof_file)
+    res = calc.eofs(n_modes=3)
+    rot = calc.rotate()
+    assert set(res.data_vars) == set(rot.data_vars)
+    assert rot["eof"].dims == res["eof"].dims and rot.attrs["converged"]
+    assert np.isnan(rot["eof"].values[:, 0, 0]).all()
+
+    def rebuilt(r):
+        return r["pc"].values @ np.nan_to_num(r["eof"].values.reshape(3, -1))
+
+    assert_allclose(rebuilt(rot), rebuilt(res), atol=1e-8)
+    assert_allclose(rot["explained_variance"].sum(), res["explained_variance"].sum(), rtol=1e-10)
+    assert_allclose(np.linalg.norm(rot["eof"].values.reshape(3, -1)[:, 1:], axis=1), 1.0)
+    assert np.all(np.diff(rot["explained_variance"].values) <= 0)
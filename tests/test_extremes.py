@@ -1,24 +1,13 @@
 import numpy as np
-from pathlib import Path
 import xarray as xr
-import pytest
 
 from simple_climate_package.extremes import CalcExtremes
 # from simple_climate_package.loader import DataReader           # absolute import - run pytest from repo root
-from tests.sample_data import make_sample_era5_tg
 
 
-@pytest.fixture
-def sample_tg_dataset():
-    return make_sample_era5_tg()
-
-def test_temp_extremes_with_tempfile(tmp_path: Path, sample_tg_dataset: xr.Dataset):
-    # Save the in-memory dataset to a temporary NetCDF file
-    file_path = tmp_path / "sample.nc"
-    sample_tg_dataset.to_netcdf(file_path)
-
+def test_temp_extremes_with_tempfile(sample_file: str, sample_tg_dataset: xr.Dataset):
     # Create the TempExtremes object using the temp file (same as real code)
-    te = CalcExtremes(str(file_path), varname="tg")
+    te = CalcExtremes(sample_file, varname="tg")
 
     # choose start/end that are guaranteed to exist in the sample dataset
     start = np.datetime_as_string(sample_tg_dataset.time.min().values, unit='D')
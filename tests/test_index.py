@@ -0,0 +1,75 @@
+import numpy as np
+from pathlib import Path
+import xarray as xr
+
+from simple_climate_package.extremes import CalcExtremes
+from simple_climate_package.index import PrefixSumIndex, RangeExtremesIndex
+from simple_climate_package.mean import CalcMean
+
+
+def test_mean_index_matches_mean_between(sample_gaps_file: str, sample_tg_gaps_dataset: xr.Dataset):
+    tm = CalcMean(sample_gaps_file, varname="tg")
+
+    windows = [("2020-01-01", "2020-01-31"), ("2020-02-15", "2021-03"),
+               ("2020-01-20", "2020-02-10"), ("2021", "2021")]
+    expected = [sample_tg_gaps_dataset["tg"].sel(time=slice(s, e)).mean(dim="time") for s, e in windows]
+
+    index = tm.build_mean_index()
+    assert Path(tm.reader.sidecar_path("meanidx", "tg")).exists()
+    for (start, end), exp in zip(windows, expected):
+        xr.testing.assert_allclose(tm.mean_between(start, end), exp)
+
+    batch = tm.mean_between_many(windows)
+    assert batch.sizes["window"] == len(windows)
+    for i, exp in enumerate(expected):
+        xr.testing.assert_allclose(batch.isel(window=i).reset_coords(drop=True), exp)
+
+    # a second instance reuses the saved index instead of rebuilding
+    again = CalcMean(sample_gaps_file, varname="tg").build_mean_index()
+    assert again.source_hash == index.source_hash
+    np.testing.assert_allclose(again.sums.values, index.sums.values)
+
+
+def test_mean_index_streamed_to_file_matches_in_memory(tmp_path: Path, sample_tg_gaps_dataset: xr.Dataset):
+    tg = sample_tg_gaps_dataset["tg"]
+    in_memory = PrefixSumIndex.build(tg, block_size=50)
+    on_disk = PrefixSumIndex.build(tg, block_size=50, source_hash="abc", path=str(tmp_path / "idx.nc"))
+
+    assert on_disk.source_hash == "abc"
+    xr.testing.assert_allclose(on_disk.sums.load(), in_memory.sums)
+    xr.testing.assert_equal(on_disk.counts.load(), in_memory.counts)
+
+
+def test_extremes_index_matches_min_max_between(sample_gaps_file: str, sample_tg_gaps_dataset: xr.Dataset):
+    tx = CalcExtremes(sample_gaps_file, varname="tg")
+    tx.build_extremes_index(block=8)
+
+    tg = sample_tg_gaps_dataset["tg"]
+    # windows inside one block, across a few blocks and across the whole record
+    windows = [("2020-01-03", "2020-01-05"), ("2020-01-03", "2020-02-20"),
+               ("2020-01-15", "2020-02-20"), ("2020-01-01", "2021-12-31"), ("2020-03", "2021-06"),
+               ("2020-01-12", "2020-02-18")]
+    for start, end in windows:
+        selected = tg.sel(time=slice(start, end))
+        xr.testing.assert_allclose(tx.min_between(start, end), selected.min(dim="time"))
+        xr.testing.assert_allclose(tx.max_between(start, end), selected.max(dim="time"))
+
+    # the saved table is picked up by a fresh instance
+    again = CalcExtremes(sample_gaps_file, varname="tg")
+    again.build_extremes_index(block=8)
+    xr.testing.assert_allclose(again.min_between(*windows[1]), tx.min_between(*windows[1]))
+
+
+def test_extremes_index_random_windows_and_size(sample_tg_gaps_dataset: xr.Dataset):
+    tg = sample_tg_gaps_dataset["tg"]
+    index = RangeExtremesIndex.build(tg, block=5)
+    n_blocks = -(-tg.sizes["time"] // 5)
+    assert index.mins.sizes["node"] < 2 * n_blocks
+
+    times = tg["time"].values
+    rng = np.random.default_rng(0)
+    for i0, i1 in np.sort(rng.integers(0, len(times), size=(40, 2)), axis=1):
+        start, end = times[i0], times[i1]
+        selected = tg.sel(time=slice(start, end))
+        np.testing.assert_allclose(index.min(start, end).values, selected.min(dim="time").values)
+        np.testing.assert_allclose(index.max(start, end).values, selected.max(dim="time").values)
@@ -0,0 +1,109 @@
+import gc
+import os
+from pathlib import Path
+import xarray as xr
+import pytest
+
+from simple_climate_package.loader import DataReader, DatasetCache, _CACHE, parse_memory, plan_chunks
+from simple_climate_package.mean import CalcMean
+from simple_climate_package.extremes import CalcExtremes
+from simple_climate_package.linear_regression import LinReg
+
+
+def test_analysis_classes_share_one_dataset(sample_file: str):
+    tm = CalcMean(sample_file, varname="tg")
+    tx = CalcExtremes(sample_file, varname="tg")
+    tl = LinReg(sample_file, varname="tg")
+
+    # one cache entry, referenced once by each analysis class
+    key = tm.reader.cache_key()
+    assert tx.reader.cache_key() == key
+    assert _CACHE.refcount(key) == 3
+    assert tm.reader.read() is tx.reader.read() is tl.ds
+
+    del tm, tx, tl
+    gc.collect()
+    assert _CACHE.refcount(key) == 0
+
+
+def test_cache_evicts_only_unreferenced_entries():
+    cache = DatasetCache(maxsize=1)
+    a = cache.acquire("a", xr.Dataset)
+    b = cache.acquire("b", xr.Dataset)
+    # both are still referenced, so nothing can be evicted yet
+    assert "a" in cache and "b" in cache
+    assert cache.acquire("a", xr.Dataset) is a
+
+    cache.release("a")
+    cache.release("a")
+    assert "a" not in cache
+    assert cache.acquire("b", xr.Dataset) is b
+
+
+def test_rewritten_file_is_not_served_from_cache(sample_file: str, sample_tg_dataset: xr.Dataset):
+    with DataReader(sample_file) as dr:
+        first_key = dr.cache_key()
+        dr.read()
+
+    # close unreferenced handles so the file can be rewritten in place
+    _CACHE.clear()
+    sample_tg_dataset.isel(time=slice(0, 10)).to_netcdf(sample_file)
+    with DataReader(sample_file) as dr:
+        assert dr.cache_key() != first_key
+        assert dr.read().sizes["time"] == 10
+
+
+def test_checksum_changes_when_the_middle_of_a_file_is_edited(tmp_path: Path):
+    file_path = tmp_path / "data.bin"
+    file_path.write_bytes(bytes(3 * 1024**2))
+    # an older timestamp, as for a file written some time ago
+    os.utime(file_path, ns=(10**18, 10**18))
+    reader = DataReader(str(file_path))
+    before = reader.checksum()
+
+    # same size, first and last MiB untouched
+    with open(file_path, "r+b") as f:
+        f.seek(3 * 1024**2 // 2)
+        f.write(b"corrected")
+    assert file_path.stat().st_size == 3 * 1024**2
+    assert reader.checksum() != before
+
+
+def test_plan_chunks_for_reductions_and_regression():
+    sizes = {"time": 1000, "latitude": 100, "longitude": 200}
+    # 8 chunks of 1.6MB in flight: 10 days of float64 per chunk, whole grid
+    reduce_plan = plan_chunks(sizes, 4, 8 * 1_600_000, operation="reduce")
+    assert reduce_plan == {"time": 10, "latitude": 100, "longitude": 200}
+
+    # regression keeps the whole record and tiles the grid in whole rows
+    regress_plan = plan_chunks(sizes, 8, "128MB", operation="regression")
+    assert regress_plan["time"] == 1000
+    assert regress_plan["longitude"] == 200
+    assert regress_plan["latitude"] * 200 * 1000 * 8 <= parse_memory("128MB") // 8
+
+
+def test_auto_chunks_open_lazily(sample_file: str):
+    pytest.importorskip("dask")
+    lazy = CalcMean(sample_file, varname="tg", chunks="auto", memory_budget="64KB")
+    assert lazy.tg.chunks is not None
+    assert len(lazy.tg.chunks[0]) > 1
+
+    eager = CalcMean(sample_file, varname="tg")
+    xr.testing.assert_allclose(lazy.mean_tot_time().compute(), eager.mean_tot_time())
+
+
+def test_subset_reads_only_the_requested_box_and_window(tmp_path: Path, sample_tg_dataset: xr.Dataset):
+    file_path = tmp_path / "descending.nc"
+    # store latitude descending, as some E-OBS derived files are
+    sample_tg_dataset.sortby("latitude", ascending=False).to_netcdf(file_path)
+
+    tx = CalcExtremes(str(file_path), varname="tg", lat_range=(-10, 0),
+                      lon_range=(104, 111), time_range=("2020-03", "2020-05-31"))
+    assert list(tx.tg.latitude.values) == [0.0, -10.0]
+    assert list(tx.tg.longitude.values) == [105.0, 110.0]
+    assert str(tx.tg.time.values[0])[:10] == "2020-03-01"
+    assert str(tx.tg.time.values[-1])[:10] == "2020-05-31"
+
+    expected = sample_tg_dataset["tg"].sel(time=slice("2020-03", "2020-05-31"),
+                                           latitude=[0.0, -10.0], longitude=[105.0, 110.0])
+    xr.testing.assert_allclose(tx.min_tot(), expected.min(dim="time"))
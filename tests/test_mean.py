@@ -1,27 +1,15 @@
 import numpy as np
-from pathlib import Path
 import xarray as xr
-import pytest
 
 from simple_climate_package.mean import CalcMean           # absolute import - run pytest from repo root
 # from simple_climate_package.loader import DataReader           # absolute import - run pytest from repo root
-from tests.sample_data import make_sample_era5_tg
 
 
-@pytest.fixture
-def sample_tg_dataset():
-    return make_sample_era5_tg()
-
 # def test_mean()
     
-def test_mean_anom(tmp_path: Path, sample_tg_dataset: xr.Dataset):
-    # Save the in-memory dataset to a temporary NetCDF file
-    file_path = tmp_path / "sample.nc"
-    sample_tg_dataset.to_netcdf(file_path)
-    print(sample_tg_dataset)
-
+def test_mean_anom(sample_file: str, sample_tg_dataset: xr.Dataset):
     # Create the TempExtremes object using the temp file (same as real code)
-    te = CalcMean(str(file_path), varname="tg")
+    te = CalcMean(sample_file, varname="tg")
 
     # choose start/end that are guaranteed to exist in the sample dataset
     start = np.datetime_as_string(sample_tg_dataset.time.min().values, unit='D')
@@ -0,0 +1,125 @@
+import os
+
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+import simple_climate_package.mean as mean_module
+from simple_climate_package.mean import CalcMean
+from simple_climate_package.pipeline import Pipeline, main
+
+
+def spec_for(sample_file, *products):
+    return {"output_dir": "out", "max_workers": 4,
+            "data": {"path": os.path.basename(sample_file), "varname": "tg"},
+            "products": list(products)}
+
+
+def test_shared_intermediates_are_computed_once(sample_file, tmp_path, monkeypatch):
+    calls = []
+    aggregate = mean_module.aggregate
+    monkeypatch.setattr(mean_module, "aggregate",
+                        lambda da, freq, how, **kw: calls.append((freq, how)) or aggregate(da, freq, how, **kw))
+
+    pipeline = Pipeline(spec_for(sample_file,
+                                 "plot_mean_tot_time",
+                                 "plot_max_tot",
+                                 {"step": "plot_yearly_mean", "n_workers": 1},
+                                 "yearly_mean",
+                                 "regression",
+                                 {"step": "summary", "start": "2020-03-01", "end": "2020-05-31",
+                                  "file": "spring.nc"},
+                                 {"step": "plot_max_between", "start": "2020-03-01", "end": "2020-05-31"}),
+                        base_dir=tmp_path)
+    names = [name for name, _ in pipeline.graph]
+    assert names.count("yearly_mean") == 1
+    assert names.count("summary") == 2      # whole record and the spring window
+
+    outputs = pipeline.run(progress=False)
+    assert calls == [("year", "mean")]
+
+    out = tmp_path / "out"
+    expected = CalcMean(sample_file).yearly_mean()
+    xr.testing.assert_allclose(xr.open_dataarray(out / "yearly_mean.nc"), expected)
+    assert str(out / "spring.nc") in outputs.values()
+    assert "slope" in xr.open_dataset(out / "regression.nc")
+    assert (out / "plots" / "mean_time_tot_tg.png").exists()
+    assert (out / "plots" / "Max_tg_tot_time.png").exists()
+    assert (out / "plots" / "Max_tg_values_between_2020-03-01_and_2020-05-31.png").exists()
+    assert len([f for f in os.listdir(out / "plots" / "yearly_mean") if f.endswith(".png")]) == 2
+
+
+def test_bad_specs_are_rejected(sample_file, tmp_path):
+    with pytest.raises(ValueError, match="unknown step"):
+        Pipeline(spec_for(sample_file, "plot_everything"), base_dir=tmp_path)
+    with pytest.raises(ValueError, match="takes"):
+        Pipeline(spec_for(sample_file, {"step": "yearly_mean", "baseline": ["2020", "2021"]}), base_dir=tmp_path)
+    with pytest.raises(ValueError, match="give each a 'file'"):
+        Pipeline(spec_for(sample_file, "monthly_clim", {"step": "monthly_clim", "baseline": ["2020", "2020"]}),
+                 base_dir=tmp_path)
+
+
+def test_command_line_runs_toml_and_yaml_jobs(sample_file, tmp_path, capsys):
+    toml_job = tmp_path / "job.toml"
+    toml_job.write_text('output_dir = "toml_out"\n'
+                        '[data]\npath = "sample.nc"\n'
+                        '[[products]]\nstep = "monthly_clim_anom"\n'
+                        '[[products]]\nstep = "plot_min_between"\nstart = "2020-01-01"\nend = "2020-06-30"\n')
+    assert main([str(toml_job), "--dry-run"]) == 0
+    listed = capsys.readouterr().out.splitlines()
+    assert listed.index("mean") < listed.index("monthly_mean") < listed.index("monthly_clim_anom *")
+
+    pytest.importorskip("yaml")
+    yaml_job = tmp_path / "job.yaml"
+    yaml_job.write_text("output_dir: yaml_out\ndata:\n  path: sample.nc\nproducts:\n  - monthly_clim\n")
+    assert main([str(yaml_job), "--quiet"]) == 0
+    clim = xr.open_dataarray(tmp_path / "yaml_out" / "monthly_clim.nc")
+    np.testing.assert_allclose(clim.values, CalcMean(sample_file).monthly_clim().values)
+
+
+def test_trend_plot_draws_its_own_regression(tmp_path, monkeypatch):
+    times = pd.date_range("2000-01-01", "2009-12-31", freq="D")
+    lats, lons = np.linspace(-10, 10, 3), np.linspace(100, 110, 3)
+    data = (times.year.values - 2000)[:, None, None] * 0.1 + np.random.default_rng(0).normal(size=(len(times), 3, 3))
+    xr.Dataset({"tg": (("time", "latitude", "longitude"), data)},
+               coords={"time": times, "latitude": lats, "longitude": lons}).to_netcdf(tmp_path / "decade.nc")
+    drawn = []
+    monkeypatch.setattr(plt, "savefig", lambda *args, **kwargs: drawn.append(plt.get_backend().lower()))
+
+    # plot_trend needs the min_obs=3 fit; the min_obs=50 fit has no valid slopes
+    backend = plt.get_backend()
+    plt.switch_backend("svg")
+    try:
+        pipeline = Pipeline(spec_for(str(tmp_path / "decade.nc"), "plot_trend",
+                                     {"step": "regression", "min_obs": 50}), base_dir=tmp_path)
+        pipeline.max_workers = 1
+        pipeline.run(progress=False)
+        assert plt.get_backend() == "svg"
+    finally:
+        plt.switch_backend(backend)
+
+    assert [name for name, _ in pipeline.graph].count("regression") == 2
+    assert drawn == ["agg"]
+    assert np.isnan(xr.open_dataset(tmp_path / "out" / "regression.nc")["slope"]).all()
+
+
+def test_series_workers_are_not_forked_from_pipeline_threads(sample_file, tmp_path, monkeypatch):
+    import multiprocessing
+    import simple_climate_package.plotting as plotting_module
+
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        pytest.skip("this platform has no fork server")
+    methods = []
+    pool = plotting_module.ProcessPoolExecutor
+
+    def recording_pool(n_workers, mp_context=None, **kwargs):
+        methods.append(mp_context.get_start_method() if mp_context else None)
+        return pool(n_workers, mp_context=mp_context, **kwargs)
+    monkeypatch.setattr(plotting_module, "ProcessPoolExecutor", recording_pool)
+
+    Pipeline(spec_for(sample_file, {"step": "plot_yearly_mean", "n_workers": 2}, "plot_mean_tot_time"),
+             base_dir=tmp_path).run(progress=False)
+    assert methods == ["forkserver"]
+    assert len([f for f in os.listdir(tmp_path / "out" / "plots" / "yearly_mean") if f.endswith(".png")]) == 2
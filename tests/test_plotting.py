@@ -0,0 +1,131 @@
+import os
+import re
+
+import numpy as np
+import pytest
+import xarray as xr
+
+from simple_climate_package.extremes import CalcExtremes
+from simple_climate_package.mean import CalcMean
+from simple_climate_package.plotting import (
+    FrameRenderer, axes_pixels, block_reduce, display_factors, display_map, render_frames)
+
+
+def listing(path):
+    return sorted(name for name in os.listdir(path) if not name.startswith("."))
+
+
+@pytest.mark.parametrize("n_workers", [1, 2])
+def test_render_frames_writes_every_frame(tmp_path, n_workers):
+    frames = np.random.default_rng(0).normal(size=(5, 4, 6))
+    paths = [str(tmp_path / f"frame_{i}.png") for i in range(5)]
+    written = render_frames(frames, np.arange(6.0), np.arange(4.0), [f"frame {i}" for i in range(5)],
+                            paths, n_workers=n_workers, progress=False)
+    assert written == paths
+    assert all(os.path.getsize(p) > 0 for p in paths)
+
+
+def test_series_plots_file_names(sample_file, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    CalcMean(sample_file).plot_yearly_mean(n_workers=2)
+    CalcMean(sample_file).plot_monthly_climatology(n_workers=1)
+    CalcExtremes(sample_file, varname="tg").plot_yearly_max(n_workers=1)
+
+    plots = tmp_path / "plots"
+    assert listing(plots / "yearly_mean") == ["mean_tg_for_2020.png", "mean_tg_for_2021.png"]
+    assert len(listing(plots / "monthly_clim")) == 12
+    assert (plots / "monthly_clim" / "mean_tg_for_Jan.png").exists()
+    assert listing(plots / "yearly_max") == ["max_tg_for_2020.png", "max_tg_for_2021.png"]
+
+
+def test_combined_outputs(sample_file, tmp_path, monkeypatch):
+    from PIL import Image
+
+    monkeypatch.chdir(tmp_path)
+    tm = CalcMean(sample_file)
+    [gif] = tm.plot_monthly_climatology(combined="gif")
+    assert gif.endswith("monthly_clim_tg.gif")
+    with Image.open(gif) as im:
+        assert im.n_frames == 12
+
+    [pdf] = CalcExtremes(sample_file, varname="tg").plot_yearly_min(combined="pdf")
+    with open(pdf, "rb") as f:
+        assert len(re.findall(rb"/Type\s*/Page\b(?!s)", f.read())) == 2
+    # only the combined file is written
+    assert listing(tmp_path / "plots" / "yearly_min") == ["yearly_min_tg.pdf"]
+
+
+def test_unchanged_figures_are_not_redrawn(sample_file, tmp_path, monkeypatch):
+    import simple_climate_package.plotting as plotting
+
+    monkeypatch.chdir(tmp_path)
+    drawn = []
+    draw_frames = plotting._draw_frames
+    monkeypatch.setattr(plotting, "_draw_frames",
+                        lambda frames, *args: drawn.append(len(frames)) or draw_frames(frames, *args))
+
+    tm = CalcMean(sample_file)
+    tm.plot_yearly_mean(n_workers=1)
+    tm.plot_yearly_mean(n_workers=1)
+    tm.plot_yearly_mean(n_workers=1, redraw=True)
+    assert drawn == [2, 0, 2]
+
+    single = tmp_path / "plots" / "mean_time_tot_tg.png"
+    tm.plot_mean_tot_time()
+    first = os.stat(single).st_mtime_ns
+    tm.plot_mean_tot_time()
+    assert os.stat(single).st_mtime_ns == first
+    tm.plot_mean_tot_time(redraw=True)
+    assert os.stat(single).st_mtime_ns != first
+
+
+@pytest.mark.parametrize("how", ["mean", "min", "max"])
+def test_block_reduce_matches_blockwise_reduction(how):
+    a = np.random.default_rng(1).normal(size=(2, 7, 10))
+    a[0, :3, :2] = np.nan
+    got = block_reduce(a, (3, 4), how)
+
+    assert got.shape == (2, 3, 3)
+    reduce = {"mean": np.nanmean, "min": np.nanmin, "max": np.nanmax}[how]
+    for i, r in enumerate(range(0, 7, 3)):
+        for j, c in enumerate(range(0, 10, 4)):
+            block = a[:, r:r + 3, c:c + 4].reshape(2, -1)
+            for k in range(2):
+                expected = reduce(block[k]) if not np.isnan(block[k]).all() else np.nan
+                np.testing.assert_allclose(got[k, i, j], expected)
+
+
+def test_display_factors_leave_no_more_cells_than_pixels():
+    assert display_factors((400, 700), (184, 198)) == (3, 4)
+    assert display_factors((368, 396), (184, 198)) == (2, 2)
+    assert display_factors((100, 50), (184, 198)) == (1, 1)
+
+
+def test_dense_grids_are_coarsened_to_display_resolution(tmp_path):
+    lats, lons = np.linspace(35, 70, 400), np.linspace(-25, 45, 700)
+    # a 6.4 x 4.8 inch figure at 50 dpi draws its map on 198 x 184 pixels
+    renderer = FrameRenderer(lons, lats, 0, 1, dpi=50)
+    assert axes_pixels(renderer.fig, 50) == (184, 198)
+    assert renderer.factors == (3, 4)
+    assert renderer.mesh.get_array().shape == (134, 175)
+    full = FrameRenderer(lons, lats, 0, 1, dpi=50, full_resolution=True)
+    assert full.factors == (1, 1)
+
+    frames = np.random.default_rng(2).normal(size=(2, 400, 700))
+    paths = [str(tmp_path / f"frame_{i}.png") for i in range(2)]
+    render_frames(frames, lons, lats, ["a", "b"], paths, dpi=50, n_workers=1, progress=False)
+    assert all(os.path.getsize(p) > 0 for p in paths)
+
+    # a default figure (6.4 x 4.8 inches at 100 dpi) draws its map on 396 x 369 pixels
+    field = np.random.default_rng(3).normal(size=(1000, 1400))
+    da = xr.DataArray(field, coords={"latitude": np.linspace(35, 70, 1000),
+                                     "longitude": np.linspace(-25, 45, 1400)},
+                      dims=("latitude", "longitude"))
+    shown = display_map(da, "max")
+    assert shown.shape == (334, 350)
+    np.testing.assert_allclose(float(shown.max()), field.max())
+    xr.testing.assert_identical(display_map(da, "max", full_resolution=True), da)
+
+    # the map is (lat, lon) whether or not it is coarsened
+    assert display_map(da.T, "max").dims == ("latitude", "longitude")
+    assert display_map(da.T, "max", full_resolution=True).dims == ("latitude", "longitude")
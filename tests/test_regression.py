@@ -2,6 +2,7 @@
 import numpy as np
 import pandas as pd
 import xarray as xr
+import pytest
 from numpy.testing import assert_allclose
 
 from simple_climate_package.linear_regression import LinReg
@@ -104,3 +105,197 @@ def test_regress_yearly_recovers_slope_and_masks(tmp_path):
 
     # Another cell (0,1) should still have slope ~1
     assert_allclose(res2["slope"].values[0, 1], 1.0, atol=1e-12)
+
+
+def test_regress_annual_blocks_match_per_cell_fit():
+    from scipy.stats import linregress
+    from simple_climate_package.linear_regression import regress_annual
+
+    rng = np.random.default_rng(0)
+    times = pd.date_range("1990-01-01", periods=12, freq="YS")
+    data = 0.3 * np.arange(12.0)[:, None, None] + rng.normal(size=(12, 3, 4))
+    data[[1, 5, 6], 0, 2] = np.nan
+    data[:10, 2, 3] = np.nan  # too few years
+    annual = xr.DataArray(data, dims=("time", "lat", "lon"),
+                          coords={"time": times, "lat": [0.0, 1.0, 2.0], "lon": [0.0, 1.0, 2.0, 3.0]})
+
+    whole = regress_annual(annual, "lat", "lon")
+    for block_size in (1, 5):
+        xr.testing.assert_allclose(regress_annual(annual, "lat", "lon", block_size=block_size), whole)
+
+    years = times.year.values.astype(float)
+    for i in range(3):
+        for j in range(4):
+            y = data[:, i, j]
+            ok = ~np.isnan(y)
+            if ok.sum() < 3:
+                assert np.isnan(whole["slope"].values[i, j])
+                continue
+            ref = linregress(years[ok], y[ok])
+            resid = y[ok] - (ref.intercept + ref.slope * years[ok])
+            assert_allclose(whole["slope"].values[i, j], ref.slope, rtol=1e-10)
+            assert_allclose(whole["intercept"].values[i, j], ref.intercept, rtol=1e-8)
+            assert_allclose(whole["p_value"].values[i, j], ref.pvalue, rtol=1e-8)
+            assert_allclose(whole["r2"].values[i, j], ref.rvalue ** 2, rtol=1e-8)
+            assert_allclose(whole["rmse"].values[i, j], np.sqrt(np.mean(resid ** 2)), rtol=1e-8)
+
+
+def test_grid_multi_regression_matches_per_cell_lstsq(tmp_path):
+    from scipy.stats import t as t_dist
+
+    rng = np.random.default_rng(3)
+    times = pd.date_range("1980-01-01", "1999-12-31", freq="D")
+    years = np.arange(1980, 2000)
+    nao = pd.Series(rng.normal(size=20), index=years)
+    enso = pd.Series(rng.normal(size=240), index=pd.date_range("1980-01-01", periods=240, freq="MS"))
+    enso.iloc[:12] = np.nan  # 1980 has no ENSO value
+
+    enso_mean = enso.groupby(enso.index.year).mean().fillna(0).values
+    annual = (0.5 * nao.values[:, None, None] + 0.2 * enso_mean[:, None, None]
+              + rng.normal(size=(20, 2, 3)))
+    daily = np.repeat(annual, np.bincount(times.year - 1980), axis=0)
+    daily[times.year == 1990, 0, 1] = np.nan
+    ds = xr.Dataset({"tg": (("time", "lat", "lon"), daily)},
+                    coords={"time": times, "lat": [0.0, 1.0], "lon": [0.0, 1.0, 2.0]})
+    p = tmp_path / "multi.nc"
+    ds.to_netcdf(p)
+
+    lr = LinReg(str(p))
+    res = lr.grid_multi_regression(pd.DataFrame({"nao": nao, "enso": enso.groupby(enso.index.year).mean()}))
+    assert list(res["predictor"].values) == ["intercept", "nao", "enso"]
+    assert res["coef"].dims == ("predictor", "lat", "lon")
+    assert res["n_obs"].values[0, 1] == 18 and res["n_obs"].values[0, 0] == 19
+
+    # dict input with a dated series gives the same answer
+    res2 = lr.grid_multi_regression({"nao": nao, "enso": enso}, block_size=2)
+    xr.testing.assert_allclose(res, res2)
+
+    enso_y = enso.groupby(enso.index.year).mean().reindex(years).values
+    X = np.column_stack([np.ones(20), nao.values, enso_y])
+    for i in range(2):
+        for j in range(3):
+            y = lr.annual.values[:, i, j]
+            ok = ~np.isnan(y) & ~np.isnan(enso_y)
+            beta, ssr, _, _ = np.linalg.lstsq(X[ok], y[ok], rcond=None)
+            df = ok.sum() - 3
+            se = np.sqrt(np.diag(np.linalg.inv(X[ok].T @ X[ok])) * ssr[0] / df)
+            assert_allclose(res["coef"].values[:, i, j], beta, rtol=1e-10)
+            assert_allclose(res["std_err"].values[:, i, j], se, rtol=1e-10)
+            assert_allclose(res["p_value"].values[:, i, j],
+                            2 * t_dist.sf(np.abs(beta / se), df), rtol=1e-8)
+            sst = ((y[ok] - y[ok].mean()) ** 2).sum()
+            assert_allclose(res["r2"].values[i, j], 1 - ssr[0] / sst, rtol=1e-10)
+
+
+def test_grid_linear_regression_by_period_matches_single_periods(tmp_path):
+    from simple_climate_package.linear_regression import regress_annual
+
+    rng = np.random.default_rng(5)
+    times = pd.date_range("1990-01-01", "1999-12-31", freq="D")
+    data = (0.05 * (times.year.values - 1990) * (times.month.values == 7))[:, None, None] \
+        + rng.normal(size=(len(times), 2, 2))
+    ds = xr.Dataset({"tg": (("time", "lat", "lon"), data)},
+                    coords={"time": times, "lat": [0.0, 1.0], "lon": [0.0, 1.0]})
+    p = tmp_path / "periods.nc"
+    ds.to_netcdf(p)
+    lr = LinReg(str(p))
+
+    seasons = lr.grid_linear_regression_by_period("season", block_size=3)
+    assert list(seasons["season"].values) == ["DJF", "MAM", "JJA", "SON"]
+    # DJF belongs to the year of its January; the first DJF has no December
+    djf = ds["tg"].resample(time="QS-DEC").mean()
+    djf = djf.isel(time=djf.time.dt.month == 12)
+    annual = djf.assign_coords(time=pd.to_datetime([f"{y + 1}-01-01" for y in djf.time.dt.year.values]))
+    expected = regress_annual(annual, "lat", "lon")
+    xr.testing.assert_allclose(seasons.sel(season="DJF", drop=True), expected)
+
+    months = lr.grid_linear_regression_by_period("month")
+    assert list(months["month"].values) == list(range(1, 13))
+    july = ds["tg"].isel(time=ds.time.dt.month == 7).resample(time="1YS").mean()
+    xr.testing.assert_allclose(months.sel(month=7, drop=True), regress_annual(july, "lat", "lon"))
+
+
+def test_running_trend_matches_windowed_regressions(tmp_path):
+    from simple_climate_package.linear_regression import regress_annual
+
+    rng = np.random.default_rng(7)
+    times = pd.date_range("1950-01-01", "1969-12-31", freq="D")
+    data = 280 + 0.03 * (times.year.values - 1950)[:, None, None] + rng.normal(size=(len(times), 2, 2))
+    data[times.year == 1955, 1, 0] = np.nan
+    ds = xr.Dataset({"tg": (("time", "lat", "lon"), data)},
+                    coords={"time": times, "lat": [0.0, 1.0], "lon": [0.0, 1.0]})
+    p = tmp_path / "running.nc"
+    ds.to_netcdf(p)
+
+    lr = LinReg(str(p))
+    running = lr.running_trend(window=8, block_size=3)
+    assert running["slope"].dims == ("window_start", "lat", "lon")
+    assert list(running["window_start"].values) == list(range(1950, 1963))
+    for k, start in enumerate(running["window_start"].values):
+        expected = regress_annual(lr.annual.isel(time=slice(k, k + 8)), "lat", "lon")
+        got = running.isel(window_start=k, drop=True)
+        for v in ("slope", "intercept", "p_value", "r2", "rmse", "n_obs"):
+            assert_allclose(got[v].values, expected[v].values, rtol=1e-7, atol=1e-9)
+
+
+def test_field_significance_resampling(tmp_path):
+    from simple_climate_package.linear_regression import (
+        bh_fdr, resample_indices, resample_weights)
+
+    idx = resample_indices(10, 5, "block_bootstrap", block_length=3, seed=0)
+    assert idx.shape == (5, 10) and idx.max() < 10
+    x = np.arange(10.0)
+    C, M, M2 = resample_weights(idx, x)
+    y = np.random.default_rng(0).normal(size=10)
+    assert_allclose(M @ y, (y[idx] * x).sum(axis=1))
+    assert_allclose(C.sum(axis=1), 10)
+
+    assert list(bh_fdr([0.001, 0.02, 0.03, 0.5, np.nan], alpha=0.05)) == [True, True, True, False, False]
+
+    rng = np.random.default_rng(2)
+    times = pd.date_range("1980-01-01", "2009-12-31", freq="D")
+    trend = np.zeros((1, 2, 3))
+    trend[0, 0, :] = 0.2  # a strong trend in the first row of pixels only
+    data = (times.year.values - 1980)[:, None, None] * trend + rng.normal(size=(len(times), 2, 3))
+    ds = xr.Dataset({"tg": (("time", "lat", "lon"), data)},
+                    coords={"time": times, "lat": [0.0, 1.0], "lon": [0.0, 1.0, 2.0]})
+    p = tmp_path / "signif.nc"
+    ds.to_netcdf(p)
+
+    lr = LinReg(str(p))
+    res = lr.field_significance(n_resamples=199, seed=1, block_size=2)
+    assert res["p_value"].dims == ("lat", "lon")
+    assert (res["p_value"].values[0] <= 0.01).all()
+    assert res["fdr_mask"].values[0].all() and not res["fdr_mask"].values[1].any()
+    assert res.attrs["field_p_value"] < 0.05
+
+    # the result depends on the seed only, not on how the work is split
+    parallel = lr.field_significance(n_resamples=199, seed=1, block_size=2, n_workers=2)
+    xr.testing.assert_identical(parallel, res)
+
+    boot = lr.field_significance("block_bootstrap", n_resamples=99, block_length=3, seed=1)
+    assert boot.attrs["method"] == "block_bootstrap"
+
+    with pytest.raises(ValueError, match="stipple"):
+        lr.quick_plot_signif_stippling(stipple="fdr_bh")
+
+
+def test_fits_default_to_the_reader_memory_budget(tmp_path, monkeypatch):
+    from simple_climate_package import linear_regression as lr
+
+    p = tmp_path / "synthetic_daily.nc"
+    make_synthetic_daily_dataset().to_netcdf(p)
+    seen = []
+    column_block_size = lr.column_block_size
+
+    def spy(n_rows, block_size=None, max_memory=None):
+        seen.append(max_memory)
+        return column_block_size(n_rows, block_size, max_memory)
+    monkeypatch.setattr(lr, "column_block_size", spy)
+
+    tl = LinReg(str(p), varname="tg", memory_budget="1KB")
+    tl.grid_linear_regression()
+    tl.running_trend(window=2)
+    tl.grid_linear_regression(max_memory="1MB")
+    assert seen == ["1KB", "1KB", "1MB"]
+    assert_allclose(tl.results["slope"].values, 1.0)
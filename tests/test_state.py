@@ -0,0 +1,57 @@
+import numpy as np
+from pathlib import Path
+import xarray as xr
+import pytest
+
+from simple_climate_package.extremes import CalcExtremes
+from simple_climate_package.linear_regression import LinReg
+from simple_climate_package.mean import CalcMean
+from simple_climate_package.state import StatsState
+
+
+def test_incremental_update_matches_full_recompute(tmp_path: Path, sample_gaps_file: str,
+                                                   sample_tg_gaps_dataset: xr.Dataset):
+    # first release ends mid-month, the next one extends the record
+    state = StatsState(varname="tg")
+    assert state.update(sample_tg_gaps_dataset["tg"].sel(time=slice(None, "2021-03-14"))) > 0
+    state.save(tmp_path / "state.nc")
+    state = StatsState.load(tmp_path / "state.nc")
+    n_new = state.update(sample_gaps_file, block_size=40)
+    assert n_new == sample_tg_gaps_dataset.sizes["time"] - sample_tg_gaps_dataset["tg"].sel(time=slice(None, "2021-03-14")).sizes["time"]
+    # nothing is counted twice
+    assert state.update(sample_gaps_file) == 0
+
+    tm = CalcMean(sample_gaps_file, varname="tg")
+    tx = CalcExtremes(sample_gaps_file, varname="tg")
+    tl = LinReg(sample_gaps_file, varname="tg")
+
+    xr.testing.assert_allclose(state.mean_tot(), tm.mean_tot_time())
+    xr.testing.assert_allclose(state.monthly_mean(), tm.monthly_mean())
+    xr.testing.assert_allclose(state.yearly_mean(), tm.yearly_mean())
+    xr.testing.assert_allclose(state.monthly_clim(), tm.monthly_clim())
+    xr.testing.assert_allclose(state.daily_clim(), tm.daily_clim().drop_attrs())
+    xr.testing.assert_allclose(state.yearly_max(), tx.yearly_max())
+    xr.testing.assert_allclose(state.monthly_min(), tx.monthly_min())
+
+    tl.make_yearly()
+    np.testing.assert_allclose(state.regression()["slope"].values,
+                               tl.grid_linear_regression()["slope"].values)
+
+
+def test_update_rejects_a_shifted_grid(sample_tg_gaps_dataset: xr.Dataset):
+    tg = sample_tg_gaps_dataset["tg"]
+    state = StatsState(varname="tg")
+    state.update(tg.sel(time=slice(None, "2020-06-30")))
+
+    # same shape, but on a grid moved by half a cell
+    shifted = tg.sel(time=slice("2020-07-01", None))
+    shifted = shifted.assign_coords(longitude=shifted.longitude + 0.5 * float(shifted.longitude.diff("longitude")[0]))
+    with pytest.raises(ValueError, match="longitude"):
+        state.update(shifted)
+
+
+def test_save_refuses_an_empty_state(tmp_path: Path):
+    path = tmp_path / "state.nc"
+    with pytest.raises(ValueError, match="nothing to save"):
+        StatsState(varname="tg").save(path)
+    assert not path.exists()
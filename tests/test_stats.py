@@ -0,0 +1,49 @@
+import numpy as np
+import xarray as xr
+
+from simple_climate_package.extremes import CalcExtremes
+from simple_climate_package.mean import CalcMean
+from simple_climate_package.stats import time_summary, _SUMMARIES
+
+
+def test_time_summary_matches_xarray_reductions(sample_tg_gaps_dataset: xr.Dataset):
+    tg = sample_tg_gaps_dataset["tg"]
+    # a block size that does not divide the record tests the merging
+    summary = time_summary(tg, block_size=17)
+
+    xr.testing.assert_allclose(summary["min"], tg.min(dim="time"))
+    xr.testing.assert_allclose(summary["max"], tg.max(dim="time"))
+    xr.testing.assert_allclose(summary["mean"], tg.mean(dim="time"))
+    xr.testing.assert_allclose(summary["std"], tg.std(dim="time"))
+    np.testing.assert_array_equal(summary["count"], tg.count(dim="time"))
+
+    ok = tg.count(dim="time") > 0
+    np.testing.assert_array_equal(summary["time_of_min"].where(ok, drop=True),
+                                  tg.idxmin(dim="time").where(ok, drop=True))
+    np.testing.assert_array_equal(summary["time_of_max"].where(ok, drop=True),
+                                  tg.idxmax(dim="time").where(ok, drop=True))
+    assert np.isnat(summary["time_of_max"].values[2, 2])
+
+
+def test_mean_and_extremes_share_one_pass(sample_gaps_file: str, sample_tg_gaps_dataset: xr.Dataset):
+    _SUMMARIES.clear()
+
+    tm = CalcMean(sample_gaps_file, varname="tg")
+    tx = CalcExtremes(sample_gaps_file, varname="tg")
+    tm.mean_tot_time()
+    tx.min_tot()
+    tx.max_tot()
+    assert len(_SUMMARIES) == 1
+
+    tx.max_between("2020-01-01", "2020-06-30")
+    assert len(_SUMMARIES) == 2
+
+
+def test_editing_a_summary_leaves_the_cache_intact(sample_gaps_file: str):
+    _SUMMARIES.clear()
+
+    tm = CalcMean(sample_gaps_file, varname="tg")
+    expected = tm.summary()["mean"].values.copy()
+    tm.summary()["mean"].values[:] = 0.0
+    tx = CalcExtremes(sample_gaps_file, varname="tg")
+    np.testing.assert_array_equal(tx.summary()["mean"].values, expected)
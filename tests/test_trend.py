@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+from numpy.testing import assert_allclose
+from scipy.stats import norm, theilslopes
+
+from simple_climate_package.trend import CalcTrend, mann_kendall_theil_sen
+
+
+def reference_mann_kendall(y):
+    """Textbook Mann-Kendall with tie correction, one series at a time."""
+    y = y[~np.isnan(y)]
+    n = len(y)
+    s = sum(np.sign(y[j] - y[i]) for i in range(n) for j in range(i + 1, n))
+    _, t = np.unique(y, return_counts=True)
+    var = (n * (n - 1) * (2 * n + 5) - np.sum(t * (t - 1) * (2 * t + 5))) / 18.0
+    z = (s - np.sign(s)) / np.sqrt(var)
+    return s, 2 * norm.sf(abs(z))
+
+
+def make_annual_file(path):
+    rng = np.random.default_rng(1)
+    times = pd.date_range("1980-01-01", "1999-12-31", freq="D")
+    trend = 0.02 * (times.year.values - 1980)
+    data = 280 + trend[:, None, None] + rng.normal(size=(len(times), 3, 3))
+    data[times.year == 1985, 0, 0] = np.nan
+    ds = xr.Dataset({"tg": (("time", "lat", "lon"), data)},
+                    coords={"time": times, "lat": [50.0, 51.0, 52.0], "lon": [0.0, 1.0, 2.0]})
+    ds.to_netcdf(path)
+
+
+def test_mann_kendall_theil_sen_matches_reference():
+    rng = np.random.default_rng(0)
+    x = np.arange(1990.0, 2010.0)
+    Y = np.round(0.1 * (x - 1990)[:, None] + rng.normal(size=(20, 6)), 1)  # rounding makes ties
+    Y[[2, 7], 3] = np.nan
+    Y[:18, 5] = np.nan  # too few values
+
+    out = mann_kendall_theil_sen(Y, x, min_obs=3)
+    for c in range(5):
+        ok = ~np.isnan(Y[:, c])
+        s, p = reference_mann_kendall(Y[:, c])
+        slope, intercept, _, _ = theilslopes(Y[ok, c], x[ok], method="joint")
+        assert out["s"][c] == s
+        assert_allclose(out["p_value"][c], p, rtol=1e-12)
+        assert_allclose(out["slope"][c], slope, rtol=1e-12)
+        assert_allclose(out["intercept"][c], intercept, rtol=1e-9)
+    assert np.isnan(out["slope"][5]) and out["n_obs"][5] == 2
+
+
+def test_grid_trend_layout_and_workers(tmp_path):
+    p = tmp_path / "trend.nc"
+    make_annual_file(p)
+    tr = CalcTrend(str(p))
+
+    serial = tr.grid_trend(n_workers=1)
+    for v in ("slope", "intercept", "t_stat", "p_value", "r2", "rmse", "n_obs",
+              "per_decade", "total_change"):
+        assert v in serial.data_vars
+        assert serial[v].dims == ("lat", "lon")
+    assert serial["n_obs"].values[0, 0] == 19
+
+    parallel = tr.grid_trend(n_workers=2, tile_size=2)
+    xr.testing.assert_allclose(parallel, serial)
+
+
+def test_tile_size_splits_the_reader_budget_between_all_workers(tmp_path, monkeypatch):
+    from simple_climate_package import trend as trend_module
+    from simple_climate_package.loader import parse_memory
+
+    p = tmp_path / "trend.nc"
+    make_annual_file(p)
+    tiles = []
+    map_columns = trend_module.map_columns
+    monkeypatch.setattr(trend_module, "map_columns",
+                        lambda func, Y, tile_size, n_workers, **kw:
+                        tiles.append(tile_size) or map_columns(func, Y, tile_size, 1, **kw))
+    monkeypatch.setattr(trend_module.os, "cpu_count", lambda: 4)
+
+    CalcTrend(str(p), memory_budget="1MB").grid_trend()
+    # 20 years: 190 pairs, 3 float64 temporaries each per column
+    assert tiles == [parse_memory("1MB") // 4 // (3 * 8 * 190)]